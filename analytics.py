@@ -0,0 +1,60 @@
+from datetime import date, datetime, timedelta
+
+from aiogram.utils.markdown import hbold
+
+import config
+
+# Периоды отчета: ключ -> (название, дней)
+PERIODS = {
+    'week': ("неделю", 7),
+    'month': ("месяц", 30),
+    'year': ("год", 365),
+}
+
+def period_range(period: str, today: date = None):
+    """Дни [since, until] периода, заканчивающегося сегодня"""
+    today = today or date.today()
+    _, days = PERIODS[period]
+    return today - timedelta(days=days - 1), today
+
+def day_capacity_minutes() -> int:
+    """Рабочих минут в дне: от первого слота до закрытия"""
+    opening = datetime.strptime(config.TIME_SLOTS[0], "%H:%M")
+    closing = datetime.strptime(config.CLOSING_TIME, "%H:%M")
+    return int((closing - opening).total_seconds() // 60)
+
+def format_report(period: str, rows) -> str:
+    """Текст отчета по строкам get_service_report"""
+    title, days = PERIODS[period]
+    since, until = period_range(period)
+
+    text = f"📊 {hbold(f'Статистика за {title}')}\n{since:%d.%m.%Y} - {until:%d.%m.%Y}\n\n"
+    if not rows:
+        return text + "За этот период записей нет"
+
+    total = dict.fromkeys(
+        ('bookings', 'confirmed', 'cancelled', 'noshows', 'revenue', 'discount_given', 'booked_minutes'), 0)
+    for row in sorted(rows, key=lambda row: row.revenue or 0, reverse=True):
+        service = config.SERVICES.get(row.service, {})
+        text += (
+            f"{service.get('emoji', '💅')} {hbold(service.get('name', row.service))}\n"
+            f"   Записей: {row.bookings} (подтверждено {row.confirmed}, отменено {row.cancelled}, "
+            f"неявок {row.noshows})\n"
+            f"   Выручка: {row.revenue}₽, скидки: {row.discount_given}₽\n"
+        )
+        for field in total:
+            total[field] += getattr(row, field) or 0
+
+    occupancy = total['booked_minutes'] / (day_capacity_minutes() * days)
+    cancel_rate = total['cancelled'] / total['bookings'] if total['bookings'] else 0
+    # Неявки - от записей, до которых дошел клиент: подтвержденных и неявок
+    attended = total['confirmed'] + total['noshows']
+    noshow_rate = total['noshows'] / attended if attended else 0
+    text += (
+        f"\n{hbold('Итого:')}\n"
+        f"📅 Записей: {total['bookings']}, отмен: {cancel_rate:.0%}, неявок: {noshow_rate:.0%}\n"
+        f"💰 Выручка: {total['revenue']}₽\n"
+        f"🎁 Отдано скидками: {total['discount_given']}₽\n"
+        f"⏰ Загрузка времени: {occupancy:.0%}"
+    )
+    return text
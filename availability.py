@@ -0,0 +1,155 @@
+from bisect import bisect_left, insort
+from datetime import date, datetime, timedelta
+from time import monotonic
+import config
+
+def _to_minutes(value: str) -> int:
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+SLOT_MINUTES = [_to_minutes(slot) for slot in config.TIME_SLOTS]
+CLOSING_MINUTES = _to_minutes(config.CLOSING_TIME)
+
+class AvailabilityIndex:
+    """Индекс занятого времени по дням.
+
+    Для каждого дня хранится отсортированный список интервалов (начало, конец, id записи)
+    в минутах от полуночи. Свободные слоты для пары (день, услуга) кэшируются и
+    сбрасываются только при изменении интервалов этого дня.
+    Поверх занятого времени действуют короткие удержания (holds): пока клиент
+    подтверждает запись, выбранное время не предлагается другим. Удержания
+    видны только своему процессу; при нескольких процессах bot.hold_slot
+    дублирует их арендами в БД.
+    Все методы синхронные и вызываются из event loop, поэтому изменения атомарны
+    относительно других обработчиков.
+    """
+
+    def __init__(self):
+        self._days = {}          # date -> [(start, end, appointment_id)]
+        self._appointments = {}  # appointment_id -> (date, start, end)
+        self._free_cache = {}    # (date, service_id) -> [time_slot]
+        self._holds = {}         # date -> {owner: (start, end, expires_at)}
+        self._hold_days = {}     # owner -> date
+
+    def warm(self, intervals):
+        """Заполняет индекс из БД: [(appointment_id, starts_at, ends_at)]"""
+        self._days.clear()
+        self._appointments.clear()
+        self._free_cache.clear()
+        for appointment_id, starts_at, ends_at in intervals:
+            self.add(appointment_id, starts_at, ends_at)
+
+    def load_day(self, day: date, intervals):
+        """Заменяет занятое время дня свежими данными из БД (когда записи создают другие процессы)"""
+        for _, _, appointment_id in list(self._days.get(day, ())):
+            self._appointments.pop(appointment_id, None)
+        self._days.pop(day, None)
+        for appointment_id, starts_at, ends_at in intervals:
+            self.add(appointment_id, starts_at, ends_at)
+        self._invalidate(day)
+
+    def add(self, appointment_id: int, starts_at: datetime, ends_at: datetime):
+        """Отмечает время записи занятым"""
+        if appointment_id in self._appointments:
+            self.remove(appointment_id)
+        day = starts_at.date()
+        start = starts_at.hour * 60 + starts_at.minute
+        end = start + int((ends_at - starts_at) / timedelta(minutes=1))
+        insort(self._days.setdefault(day, []), (start, end, appointment_id))
+        self._appointments[appointment_id] = (day, start, end)
+        self._invalidate(day)
+
+    def remove(self, appointment_id: int):
+        """Освобождает время отмененной/отклоненной записи"""
+        entry = self._appointments.pop(appointment_id, None)
+        if not entry:
+            return
+        day, start, end = entry
+        intervals = self._days.get(day, [])
+        position = bisect_left(intervals, (start, end, appointment_id))
+        if position < len(intervals) and intervals[position][2] == appointment_id:
+            del intervals[position]
+        if not intervals:
+            self._days.pop(day, None)
+        self._invalidate(day)
+
+    def is_free(self, day: date, start: int, duration: int) -> bool:
+        """Свободен ли интервал [start, start + duration) в минутах от полуночи"""
+        end = start + duration
+        if end > CLOSING_MINUTES:
+            return False
+        for busy_start, busy_end, _ in self._days.get(day, ()):
+            if busy_start >= end:
+                break
+            if busy_end > start:
+                return False
+        return True
+
+    def free_slots(self, service_id: str, day: date, owner: int = None):
+        """Время начала, на которое можно записать услугу в этот день.
+
+        Время, удерживаемое другими клиентами, исключается; удержание owner - нет."""
+        key = (day, service_id)
+        cached = self._free_cache.get(key)
+        if cached is None:
+            duration = config.SERVICES[service_id].get('duration', 60)
+            cached = [
+                slot for slot, start in zip(config.TIME_SLOTS, SLOT_MINUTES)
+                if self.is_free(day, start, duration)
+            ]
+            self._free_cache[key] = cached
+
+        if not self._active_holds(day):
+            return cached
+        duration = config.SERVICES[service_id].get('duration', 60)
+        return [
+            slot for slot in cached
+            if not self._held_by_others(day, _to_minutes(slot), duration, owner)
+        ]
+
+    def is_slot_free(self, service_id: str, day: date, time_slot: str, owner: int = None) -> bool:
+        """Можно ли записать услугу на указанное время"""
+        return time_slot in self.free_slots(service_id, day, owner)
+
+    def hold(self, owner: int, service_id: str, day: date, time_slot: str) -> bool:
+        """Удерживает время за клиентом на SLOT_HOLD_MINUTES. False - время уже занято"""
+        if not self.is_slot_free(service_id, day, time_slot, owner):
+            return False
+        self.release(owner)
+        start = _to_minutes(time_slot)
+        end = start + config.SERVICES[service_id].get('duration', 60)
+        expires_at = monotonic() + config.SLOT_HOLD_MINUTES * 60
+        self._holds.setdefault(day, {})[owner] = (start, end, expires_at)
+        self._hold_days[owner] = day
+        return True
+
+    def release(self, owner: int):
+        """Снимает удержание клиента (отмена, выбор другой даты или запись создана)"""
+        day = self._hold_days.pop(owner, None)
+        if day is None:
+            return
+        holds = self._holds.get(day, {})
+        holds.pop(owner, None)
+        if not holds:
+            self._holds.pop(day, None)
+
+    def _active_holds(self, day: date):
+        """Удержания дня без истекших"""
+        holds = self._holds.get(day)
+        if not holds:
+            return None
+        now = monotonic()
+        for owner in [owner for owner, (_, _, expires_at) in holds.items() if expires_at <= now]:
+            self.release(owner)
+        return self._holds.get(day)
+
+    def _held_by_others(self, day: date, start: int, duration: int, owner: int) -> bool:
+        end = start + duration
+        for other, (hold_start, hold_end, _) in self._holds.get(day, {}).items():
+            if other != owner and hold_start < end and hold_end > start:
+                return True
+        return False
+
+    def _invalidate(self, day: date):
+        for service_id in config.SERVICES:
+            self._free_cache.pop((day, service_id), None)
@@ -0,0 +1,111 @@
+"""Обработка фото отзывов: объем на диске, время обработки и отзывчивость бота.
+
+Запуск: python bench_images.py [папка с фото] [количество]
+
+Без папки генерируется набор снимков 4000x3000 с EXIF (поворот, камера,
+геометка), похожих на фото с телефона. Каждое фото обрабатывается
+images.render так же, как в боте; печатаются:
+- объем исходников и результатов и оценка времени отправки альбома из
+  10 фото при 10 Мбит/с (при показе отзывов бот отправляет файлы с диска);
+- время обработки одного фото и пропускная способность ImagePipeline;
+- наибольшая задержка цикла событий, пока пул обрабатывает набор.
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+UPLOAD_MBIT = 10
+ALBUM_SIZE = 10
+
+def _sample_set(folder: str, count: int) -> list:
+    from PIL import Image
+
+    paths = []
+    for i in range(count):
+        noise = Image.effect_noise((4000, 3000), 10 + i)
+        gradient = Image.linear_gradient("L").resize((4000, 3000))
+        image = Image.merge("RGB", (noise, gradient, Image.blend(noise, gradient, 0.5)))
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: повернуть на 90°
+        exif[0x010F] = "Phone"
+        exif[0x8825] = {1: "N", 2: (55.0, 54.0, 0.0)}
+        path = os.path.join(folder, f"sample_{i}.jpg")
+        image.save(path, "JPEG", quality=92, exif=exif)
+        paths.append(path)
+    return paths
+
+def _upload_seconds(size: int) -> float:
+    return size * ALBUM_SIZE * 8 / (UPLOAD_MBIT * 10 ** 6)
+
+async def _loop_lag(stop: asyncio.Event) -> float:
+    """Наибольшая задержка срабатывания таймера 10 мс"""
+    lag = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lag = max(lag, time.perf_counter() - started - 0.01)
+    return lag
+
+async def _pipeline_run(pipeline, jobs) -> tuple:
+    stop = asyncio.Event()
+    lag = asyncio.create_task(_loop_lag(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(pipeline.process(source, target) for source, target in jobs))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return elapsed, await lag
+
+def main():
+    from PIL import Image
+    from images import ImagePipeline, render
+    import config
+
+    workdir = tempfile.mkdtemp(prefix="bench_images_")
+    if len(sys.argv) > 1:
+        sources = sorted(os.path.join(sys.argv[1], name) for name in os.listdir(sys.argv[1])
+                         if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")))
+        sources = sources[:int(sys.argv[2])] if len(sys.argv) > 2 else sources
+    else:
+        sources = _sample_set(workdir, int(sys.argv[2]) if len(sys.argv) > 2 else 12)
+    if not sources:
+        print("нет фото")
+        return 1
+
+    # render удаляет исходник - работаем с копиями
+    def copies(tag: str) -> list:
+        jobs = []
+        for i, source in enumerate(sources):
+            original = os.path.join(workdir, f"{tag}_{i}.orig")
+            shutil.copyfile(source, original)
+            jobs.append((original, os.path.join(workdir, f"{tag}_{i}.jpg")))
+        return jobs
+
+    original_size = sum(os.path.getsize(source) for source in sources)
+    started = time.perf_counter()
+    result_size = sum(render(source, target) for source, target in copies("serial"))
+    serial = time.perf_counter() - started
+    with Image.open(os.path.join(workdir, "serial_0.jpg")) as image:
+        print(f"результат: {image.size[0]}x{image.size[1]}, EXIF: {dict(image.getexif()) or 'нет'}")
+
+    pipeline = ImagePipeline(workers=config.IMAGE_WORKERS)
+    asyncio.run(_pipeline_run(pipeline, copies("warmup")[:config.IMAGE_WORKERS]))
+    elapsed, lag = asyncio.run(_pipeline_run(pipeline, copies("pool")))
+    pipeline.shutdown()
+
+    count = len(sources)
+    print(f"фото: {count}, ядер: {os.cpu_count()}, IMAGE_WORKERS: {config.IMAGE_WORKERS}")
+    print(f"на диске: исходники {original_size / 2 ** 20:.1f} МБ, после обработки {result_size / 2 ** 20:.1f} МБ "
+          f"({result_size / original_size:.0%})")
+    print(f"альбом из {ALBUM_SIZE} фото при {UPLOAD_MBIT} Мбит/с: "
+          f"{_upload_seconds(original_size / count):.1f} с -> {_upload_seconds(result_size / count):.1f} с")
+    print(f"обработка: {serial / count * 1000:.0f} мс на фото в одном процессе, "
+          f"пул - {count / elapsed:.1f} фото/с")
+    print(f"наибольшая задержка цикла событий во время обработки: {lag * 1000:.1f} мс")
+    shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""Кэш клавиатур: время и память построения с кэшем и без.
+
+Запуск: python bench_keyboards.py [вызовов]
+
+Для profile_keyboard (static) и booking_dates_keyboard (кэш на день)
+сравнивается вызов через кэш с построением заново (__wrapped__ у lru_cache):
+- timeit: микросекунд на вызов;
+- tracemalloc: пик памяти одного вызова и память, которую держат 1000
+  клавиатур, отданных в ответы (из кэша это одна и та же разметка).
+"""
+import gc
+import sys
+import timeit
+import tracemalloc
+from datetime import date
+
+HELD = 1000
+
+def _peak(call) -> int:
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - before
+
+def _held(call) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    markups = [call() for _ in range(HELD)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del markups
+    return current - before
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    import keyboards as kb
+
+    today = date.today()
+    cases = [
+        ("profile_keyboard", kb.profile_keyboard, kb.profile_keyboard.__wrapped__),
+        ("booking_dates_keyboard", kb.booking_dates_keyboard,
+         lambda: kb._booking_dates_keyboard.__wrapped__(today)),
+    ]
+    kb.warm_up()
+    print(f"вызовов: {number}")
+    for name, cached, uncached in cases:
+        print(name)
+        for title, call in (("без кэша", uncached), ("с кэшем", cached)):
+            seconds = timeit.timeit(call, number=number)
+            print(f"  {title:9}: {seconds / number * 1e6:7.2f} мкс/вызов, "
+                  f"пик {_peak(call) / 1024:6.1f} КБ, {HELD} ответов держат {_held(call) / 1024:7.1f} КБ")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
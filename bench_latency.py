@@ -0,0 +1,97 @@
+"""Задержка «обновление -> ответ» в режимах polling и webhook.
+
+Запуск: python bench_latency.py [пользователей] [сообщений на пользователя] [задержка API, мс]
+
+Бот (python bot.py) запускается отдельным процессом на временной БД и
+ходит в заглушку Bot API (fake_telegram.FakeBotAPI, TELEGRAM_API_URL).
+Каждый пользователь нажимает «Контакты» и ждет ответ, прежде чем отправить
+следующее сообщение. Задержка - от передачи обновления боту (в очередь
+getUpdates или POST на вебхук) до первого sendMessage в чат пользователя.
+Сообщений на пользователя - не больше OUTBOUND_CHAT_BURST, иначе в замер
+попадет пауза лимитера для одного чата.
+"""
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+API_PORT = 8181
+WEBHOOK_PORT = 8182
+TEXT = "📞 Контакты"
+
+async def _wait_for(condition, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("бот не запустился")
+        await asyncio.sleep(0.05)
+
+async def bench(mode: str, users: int, per_user: int, latency: float) -> list:
+    from fake_telegram import FakeBotAPI, user_message
+
+    waiting = {}  # chat_id -> future первого ответа
+
+    def on_reply(chat_id, method):
+        future = waiting.pop(chat_id, None)
+        if future and not future.done():
+            future.set_result(time.perf_counter())
+
+    api = FakeBotAPI(latency, on_reply)
+    api_url = await api.start(port=API_PORT)
+    workdir = tempfile.mkdtemp(prefix="bench_latency_")
+    env = dict(
+        os.environ,
+        BOT_TOKEN="1:bench",
+        TELEGRAM_API_URL=api_url,
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        RUN_MODE=mode,
+        WEBHOOK_URL=f"http://127.0.0.1:{WEBHOOK_PORT}",
+        WEBHOOK_SECRET="bench",
+        WEBAPP_HOST="127.0.0.1",
+        WEBAPP_PORT=str(WEBHOOK_PORT),
+        OUTBOUND_RATE="100000"
+    )
+    process = subprocess.Popen([sys.executable, "bot.py"], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    samples = []
+    try:
+        ready = "getUpdates" if mode == "polling" else "setWebhook"
+        await _wait_for(lambda: api.requests[ready] > 0)
+        update_ids = iter(range(1, 10 ** 9))
+
+        async def client(user_id: int):
+            for _ in range(per_user):
+                future = asyncio.get_running_loop().create_future()
+                waiting[user_id] = future
+                started = time.perf_counter()
+                await api.push(user_message(next(update_ids), user_id, TEXT))
+                samples.append(await asyncio.wait_for(future, timeout=30) - started)
+
+        await asyncio.gather(*(client(1000 + i) for i in range(users)))
+    finally:
+        process.terminate()
+        process.wait()
+        await api.stop()
+    return samples
+
+def _report(mode: str, samples: list):
+    samples = sorted(s * 1000 for s in samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{mode:8}: ответов {len(samples)}, среднее {statistics.mean(samples):.1f} мс, "
+          f"медиана {statistics.median(samples):.1f} мс, p95 {p95:.1f} мс")
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.02
+
+    print(f"пользователей: {users}, сообщений на пользователя: {per_user}, задержка API: {latency * 1000:.0f} мс")
+    for mode in ("polling", "webhook"):
+        _report(mode, asyncio.run(bench(mode, users, per_user, latency)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
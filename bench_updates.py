@@ -0,0 +1,81 @@
+"""Пропускная способность обработки обновлений: N пользователей одновременно.
+
+Запуск: python bench_updates.py [пользователей] [обновлений на пользователя] [задержка API, мс]
+
+Работает на временной БД. Обновления подаются в dp.feed_update, ответы
+бота получает FakeSession (fake_telegram.py) с заданной задержкой. Каждый
+пользователь пишет /start, затем ходит по меню, дожидаясь ответа на
+предыдущее сообщение. Сравниваются два режима:
+inline - запросы к БД выполняются прямо в цикле событий (как было до run_db),
+pool   - через run_db в пуле из DB_POOL_SIZE потоков.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+MENU = ["👤 Мой профиль", "⭐ Отзывы", "📞 Контакты", "💅 Услуги и цены"]
+
+async def _inline_run_db(func, *args, **kwargs):
+    import database as db
+    return db._call_in_session(func, args, kwargs)
+
+def _use_inline_db(inline: bool):
+    """Подменяет run_db во всех модулях, импортировавших его по имени"""
+    import database as db
+    for module in list(sys.modules.values()):
+        if getattr(module, "run_db", None) in (db.run_db, _inline_run_db):
+            module.run_db = _inline_run_db if inline else db.run_db
+
+async def _run(app, mode: str, users: int, per_user: int, first_id: int) -> float:
+    from aiogram.types import Update
+    from fake_telegram import user_message
+
+    _use_inline_db(mode == "inline")
+    update_ids = iter(range(first_id * 1000, 10 ** 12))
+
+    async def client(user_id: int):
+        texts = ["/start"] + [MENU[i % len(MENU)] for i in range(per_user - 1)]
+        for text in texts:
+            update = Update.model_validate(user_message(next(update_ids), user_id, text), context={"bot": app.bot})
+            await app.dp.feed_update(app.bot, update)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(first_id + i) for i in range(users)))
+    return time.perf_counter() - started
+
+async def bench(users: int, per_user: int, latency: float):
+    import bot as app
+    from fake_telegram import FakeSession
+
+    app.bot.session = FakeSession(latency)
+    await app.prepare()
+    # Прогрев: первые запросы открывают соединения и компилируют SQL
+    await _run(app, "pool", 10, 2, 10 ** 6)
+
+    for index, mode in enumerate(("inline", "pool")):
+        elapsed = await _run(app, mode, users, per_user, (index + 1) * 10 ** 7)
+        total = users * per_user
+        print(f"{mode:6}: {total} обновлений за {elapsed:.2f} с - {total / elapsed:.0f} обн/с")
+    print(f"запросов к API: {dict(app.bot.session.requests)}")
+
+    await app.dp.storage.close()
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.05
+
+    workdir = tempfile.mkdtemp(prefix="bench_updates_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault("BOT_TOKEN", "1:bench")
+    import logging
+    logging.disable(logging.WARNING)
+
+    print(f"пользователей: {users}, обновлений на пользователя: {per_user}, задержка API: {latency * 1000:.0f} мс")
+    asyncio.run(bench(users, per_user, latency))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
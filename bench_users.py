@@ -0,0 +1,68 @@
+"""Скорость регистрации пользователей через db.save_user.
+
+Запуск: python bench_users.py [пользователей]
+
+Работает на временной БД. Сравнивает прежний путь регистрации (SELECT,
+коммит пользователя, отдельный коммит скидки) с одной транзакцией
+save_user, затем замеряет повторный /start тех же пользователей.
+Каждый вызов - в своей сессии, как в обработчике.
+"""
+import os
+import secrets
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+def _legacy_save_user(session, db, telegram_id: int, first_name: str):
+    """Регистрация в три обращения к БД, как до единой транзакции"""
+    user = session.query(db.User).filter_by(telegram_id=telegram_id).first()
+    if not user:
+        user = db.User(telegram_id=telegram_id, first_name=first_name, referral_code=secrets.token_hex(6))
+        session.add(user)
+        session.commit()
+        session.add(db.UserDiscount(
+            user_id=user.id,
+            discount_type='first_visit',
+            discount_percent=20,
+            valid_until=datetime.now() + timedelta(days=30)
+        ))
+        session.commit()
+    return user
+
+def _timed(db, count: int, first_id: int, save) -> float:
+    started = time.perf_counter()
+    for i in range(count):
+        with db.Session() as session:
+            save(session, first_id + i)
+    return time.perf_counter() - started
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    workdir = tempfile.mkdtemp(prefix="bench_users_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    import database as db
+
+    db.init_db()
+    runs = [
+        ("прежний путь, новые", 10 ** 6,
+         lambda session, tg_id: _legacy_save_user(session, db, tg_id, f"client{tg_id}")),
+        ("save_user, новые", 2 * 10 ** 6,
+         lambda session, tg_id: db.save_user(session, tg_id, None, f"client{tg_id}", None)),
+        ("save_user, повторно", 2 * 10 ** 6,
+         lambda session, tg_id: db.save_user(session, tg_id, "nick", f"client{tg_id}", None)),
+    ]
+    print(f"пользователей: {count}")
+    for title, first_id, save in runs:
+        elapsed = _timed(db, count, first_id, save)
+        print(f"{title:20}: {elapsed:.2f} с, {elapsed / count * 1e6:.0f} мкс на пользователя")
+
+    with db.Session() as session:
+        users = session.query(db.User).count()
+        discounts = session.query(db.UserDiscount).count()
+    print(f"в БД: пользователей {users}, строк скидок {discounts}")
+    return 0 if users == discounts == 2 * count else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""Пропускная способность workers.py при разном числе обработчиков.
+
+Запуск: python bench_workers.py [пользователей] [сообщений на пользователя] [задержка API, мс]
+
+Для WORKERS = 1, 2, 4 бот (python workers.py, polling) запускается на
+временной БД против заглушки Bot API (fake_telegram.FakeBotAPI). Сначала
+прогревочная пачка (процессы-обработчики успевают запуститься), затем все
+обновления выкладываются в getUpdates разом; замер идет до последнего
+ответа. Каждое сообщение - «Контакты», на него бот отвечает одним
+sendMessage. Ускорение ограничено числом ядер: os.cpu_count() печатается.
+"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+API_PORT = 8183
+TEXT = "📞 Контакты"
+WORKER_COUNTS = (1, 2, 4)
+
+async def bench(workers: int, users: int, per_user: int, latency: float) -> float:
+    from fake_telegram import FakeBotAPI, user_message
+
+    replies = 0
+    done = asyncio.Event()
+    expected = 0
+
+    def on_reply(chat_id, method):
+        nonlocal replies
+        replies += 1
+        if replies >= expected:
+            done.set()
+
+    api = FakeBotAPI(latency, on_reply)
+    api_url = await api.start(port=API_PORT)
+    workdir = tempfile.mkdtemp(prefix="bench_workers_")
+    env = dict(
+        os.environ,
+        BOT_TOKEN="1:bench",
+        TELEGRAM_API_URL=api_url,
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        RUN_MODE="polling",
+        WORKERS=str(workers),
+        OUTBOUND_RATE="100000"
+    )
+    process = subprocess.Popen([sys.executable, "workers.py"], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def send(first_user: int, count: int) -> float:
+        nonlocal replies, expected
+        replies, expected = 0, count
+        done.clear()
+        started = time.perf_counter()
+        for i in range(count):
+            await api.push(user_message(next(update_ids), first_user + i % users, TEXT))
+        await asyncio.wait_for(done.wait(), timeout=120)
+        return time.perf_counter() - started
+
+    try:
+        # Прогрев: по сообщению на каждый обработчик с запасом
+        await send(10 ** 6, 20 * workers)
+        return await send(1000, users * per_user)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        await api.stop()
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.02
+
+    total = users * per_user
+    print(f"ядер: {os.cpu_count()}, обновлений: {total}, задержка API: {latency * 1000:.0f} мс")
+    for workers in WORKER_COUNTS:
+        elapsed = asyncio.run(bench(workers, users, per_user, latency))
+        print(f"WORKERS={workers}: {elapsed:.2f} с - {total / elapsed:.0f} обн/с")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
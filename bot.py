@@ -1,25 +1,42 @@
 import asyncio
+import html
 import logging
 import os
 import random
 import json
+from collections import Counter
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict
 from pathlib import Path
 
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command, CommandStart
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.filters import Command, CommandStart, CommandObject
 from aiogram.types import (
     Message, CallbackQuery, ReplyKeyboardRemove,
     FSInputFile, Contact, Location, InputMediaPhoto
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.markdown import hbold, hitalic, hlink
 
 import config
-from database import Session, User, Appointment, ServiceImage, Review, UserDiscount, Reminder, AdminMessage, init_db
+from database import User, Appointment, Reminder, run_db, init_db
+from availability import AvailabilityIndex
+from scheduler import ReminderScheduler
+from broadcast import BroadcastEngine
+from fsm_storage import SQLiteStorage
+from user_cache import UserCache
+from images import ImagePipeline
+from gallery import GalleryIndex, store_stream
+from discounts import DiscountRules
+from webhook import run_webhook
+from outbound import OutboundLimiter, Priority
+import outbound
+import analytics
+import database as db
 import keyboards as kb
 
 # Настройка логирования
@@ -30,8 +47,42 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Инициализация бота
-bot = Bot(token=config.BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+bot = Bot(token=config.BOT_TOKEN, session=AiohttpSession(
+    api=TelegramAPIServer.from_base(config.TELEGRAM_API_URL)
+) if config.TELEGRAM_API_URL else None)
+
+# Все исходящие сообщения идут через общий лимитер с приоритетами
+outbound_limiter = OutboundLimiter(
+    rate=config.OUTBOUND_RATE,
+    chat_interval=config.OUTBOUND_CHAT_INTERVAL,
+    chat_burst=config.OUTBOUND_CHAT_BURST,
+    max_retries=config.OUTBOUND_MAX_RETRIES
+)
+bot.session.middleware(outbound_limiter)
+
+dp = Dispatcher(storage=SQLiteStorage(
+    flush_interval=config.FSM_FLUSH_INTERVAL,
+    ttl=timedelta(hours=config.FSM_TTL_HOURS)
+))
+
+# Занятое время по дням для клавиатуры выбора времени
+slot_index = AvailabilityIndex()
+
+# Фоновые рассылки
+broadcasts = BroadcastEngine(bot)
+
+# Каталог фото работ для галереи
+gallery = GalleryIndex()
+
+# Сжатие и миниатюры фото
+image_pipeline = ImagePipeline(workers=config.IMAGE_WORKERS)
+_background_tasks = set()
+
+# Пользователи, к которым недавно обращались
+user_cache = UserCache(max_size=config.USER_CACHE_SIZE, ttl=config.USER_CACHE_TTL)
+
+# Правила скидок программы лояльности
+discount_rules = DiscountRules(config.LOYALTY_SYSTEM)
 
 # Создаем папки
 Path("images/reviews").mkdir(parents=True, exist_ok=True)
@@ -63,53 +114,120 @@ class AdminStates(StatesGroup):
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
-async def save_user(telegram_user: types.User, phone: str = None) -> User:
-    """Сохраняет или обновляет пользователя в БД"""
-    session = Session()
+async def get_user(telegram_id: int) -> Optional[User]:
+    """Пользователь по telegram_id: из кэша, при промахе из БД"""
+    user = user_cache.get(telegram_id)
+    if user is None:
+        user = await run_db(db.get_user, telegram_id)
+        user_cache.put(user)
+    return user
+
+async def register_user(telegram_user: types.User, phone: str = None, referrer_code: str = None):
+    """Сохраняет или обновляет пользователя в БД.
+
+    Возвращает (user, referred): referred - новый пользователь этим вызовом
+    привязан к пригласившему по referrer_code."""
+    if not phone:
+        # Без телефона существующий пользователь не меняется
+        user = user_cache.get(telegram_user.id)
+        if user is not None:
+            return user, False
     try:
-        user = session.query(User).filter_by(telegram_id=telegram_user.id).first()
-
-        if not user:
-            # Создаем нового пользователя
-            referral_code = kb.generate_referral_code()
-            user = User(
-                telegram_id=telegram_user.id,
-                username=telegram_user.username,
-                first_name=telegram_user.first_name,
-                last_name=telegram_user.last_name,
-                phone=phone,
-                referral_code=referral_code,
-                discount_percent=0
-            )
-            session.add(user)
-            session.commit()
-
-            # Создаем скидку на первую запись
-            discount = UserDiscount(
-                user_id=user.id,
-                discount_type='first_visit',
-                discount_percent=config.LOYALTY_SYSTEM['first_visit_discount'],
-                valid_until=datetime.now() + timedelta(days=30)
-            )
-            session.add(discount)
-            session.commit()
-
+        user, created, referred = await run_db(
+            db.save_user,
+            telegram_user.id,
+            telegram_user.username,
+            telegram_user.first_name,
+            telegram_user.last_name,
+            phone=phone,
+            referrer_code=referrer_code
+        )
+        if created:
             logger.info(f"Создан новый пользователь: {user.id} ({user.first_name})")
-        elif phone:
-            # Обновляем телефон если изменился
-            user.phone = phone
-            user.username = telegram_user.username
-            user.first_name = telegram_user.first_name
-            user.last_name = telegram_user.last_name
-            session.commit()
-
-        return user
+        user_cache.put(user)
+        return user, referred
     except Exception as e:
         logger.error(f"Ошибка сохранения пользователя: {e}")
-        session.rollback()
-        return None
-    finally:
-        session.close()
+        return None, False
+
+async def save_user(telegram_user: types.User, phone: str = None) -> User:
+    """Сохраняет или обновляет пользователя в БД"""
+    user, _ = await register_user(telegram_user, phone)
+    return user
+
+async def referral_link(user: User) -> str:
+    """Ссылка-приглашение: открывает бота с /start <код>"""
+    me = await bot.me()
+    return f"https://t.me/{me.username}?start={user.referral_code}"
+
+async def get_available_discounts(user) -> list:
+    """Скидки пользователя по правилам, сверенные с журналом user_discounts"""
+    ledger = await run_db(db.get_discount_ledger, user.id)
+    return discount_rules.evaluate(user, ledger)
+
+def _photo_source(file_id: Optional[str], path: Optional[str], upload: bool):
+    """Что отправить: file_id или, при upload и без file_id, файл с диска"""
+    if file_id and not upload:
+        return file_id
+    if path and os.path.exists(path):
+        return FSInputFile(path)
+    return None
+
+async def send_album(message: Message, items) -> Dict:
+    """Отправляет фото [(ключ, file_id, путь, подпись)] альбомом (до 10 штук).
+
+    Фото отправляются по сохраненному file_id. Если Telegram его не принял,
+    фото загружаются с диска заново. Возвращает {ключ: file_id} показанных фото."""
+    for upload in (False, True):
+        media = [
+            (key, InputMediaPhoto(media=source, caption=caption, parse_mode='HTML'))
+            for key, file_id, path, caption in items[:10]
+            if (source := _photo_source(file_id, path, upload)) is not None
+        ]
+        if not media:
+            return {}
+
+        try:
+            if len(media) == 1:
+                photo = media[0][1]
+                sent = [await message.answer_photo(photo.media, caption=photo.caption, parse_mode='HTML')]
+            else:
+                sent = await message.answer_media_group([photo for _, photo in media])
+        except TelegramBadRequest as e:
+            if upload:
+                raise
+            logger.warning(f"Telegram не принял file_id фото, загружаем заново: {e}")
+            continue
+
+        return {key: reply.photo[-1].file_id for (key, _), reply in zip(media, sent) if reply.photo}
+    return {}
+
+async def refresh_day_slots(day):
+    """В режиме нескольких процессов записи создают и другие процессы - перечитываем день из БД"""
+    if config.WORKERS > 1:
+        slot_index.load_day(day, await run_db(db.get_day_intervals, day))
+
+async def hold_slot(user_id: int, service_id: str, day, time_slot: str) -> bool:
+    """Удерживает время за клиентом. В режиме нескольких процессов удержание
+    дублируется в БД: индекс занятого времени у каждого процесса свой"""
+    if not slot_index.hold(user_id, service_id, day, time_slot):
+        return False
+    if config.WORKERS > 1:
+        starts_at = datetime.combine(day, datetime.strptime(time_slot, "%H:%M").time())
+        held = await run_db(
+            db.hold_slot_cells, f"user:{user_id}", starts_at,
+            db.service_ends_at(service_id, starts_at), config.SLOT_HOLD_MINUTES * 60
+        )
+        if not held:
+            slot_index.release(user_id)
+            return False
+    return True
+
+async def release_slot(user_id: int):
+    """Снимает удержание времени клиента"""
+    slot_index.release(user_id)
+    if config.WORKERS > 1:
+        await run_db(db.release_slot_holds, f"user:{user_id}")
 
 async def notify_admins(appointment: Appointment, user: User):
     """Отправляет уведомление администраторам о новой записи"""
@@ -124,76 +242,57 @@ async def notify_admins(appointment: Appointment, user: User):
 
 💅 Услуга: {appointment.service_name}
 💰 Цена: {appointment.final_price}₽ (скидка {appointment.discount_applied}%)
-📅 Дата: {appointment.date}
-⏰ Время: {appointment.time}
+📅 Дата: {appointment.date_str}
+⏰ Время: {appointment.time_str}
 
 🕐 Создано: {appointment.created_at.strftime('%H:%M')}
 📍 Адрес: {config.SALON_INFO['address']}
     """
 
-    for admin_id in config.ADMIN_IDS:
-        try:
-            await bot.send_message(
-                admin_id,
-                admin_message,
-                reply_markup=kb.admin_appointment_actions(appointment.id)
-            )
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+    with outbound.priority(Priority.ALERT):
+        for admin_id in config.ADMIN_IDS:
+            try:
+                await bot.send_message(
+                    admin_id,
+                    admin_message,
+                    reply_markup=kb.admin_appointment_actions(appointment.id)
+                )
+            except Exception as e:
+                logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
 
 async def schedule_reminders(appointment: Appointment):
     """Планирует напоминания о записи"""
     if not config.REMINDERS['24_hours'] and not config.REMINDERS['3_hours']:
         return
 
-    session = Session()
     try:
-        # Парсим дату и время записи
-        appointment_datetime = datetime.strptime(f"{appointment.date} {appointment.time}", "%d.%m.%Y %H:%M")
-
+        scheduled = {}
         # Напоминание за 24 часа
         if config.REMINDERS['24_hours']:
-            reminder_24h = Reminder(
-                user_id=appointment.user_id,
-                appointment_id=appointment.id,
-                reminder_type='24h_before',
-                scheduled_for=appointment_datetime - timedelta(hours=24)
-            )
-            session.add(reminder_24h)
+            scheduled['24h_before'] = appointment.starts_at - timedelta(hours=24)
 
         # Напоминание за 3 часа
         if config.REMINDERS['3_hours']:
-            reminder_3h = Reminder(
-                user_id=appointment.user_id,
-                appointment_id=appointment.id,
-                reminder_type='3h_before',
-                scheduled_for=appointment_datetime - timedelta(hours=3)
-            )
-            session.add(reminder_3h)
+            scheduled['3h_before'] = appointment.starts_at - timedelta(hours=3)
 
-        session.commit()
+        reminders = await run_db(db.create_reminders, appointment.user_id, appointment.id, scheduled)
+        for reminder in reminders:
+            reminder_scheduler.push(reminder.id, reminder.scheduled_for)
     except Exception as e:
         logger.error(f"Ошибка планирования напоминаний: {e}")
-        session.rollback()
-    finally:
-        session.close()
 
-async def send_reminder(reminder: Reminder):
-    """Отправляет напоминание пользователю"""
-    session = Session()
-    try:
-        appointment = session.query(Appointment).filter_by(id=reminder.appointment_id).first()
-        user = session.query(User).filter_by(id=reminder.user_id).first()
-
-        if not appointment or appointment.status != 'confirmed':
-            return
+async def send_reminder(reminder: Reminder, appointment: Appointment, user: User) -> str:
+    """Отправляет напоминание пользователю.
 
+    Возвращает "sent", "failed" (повторять бессмысленно: бот заблокирован,
+    чат не найден) или "retry" (временная ошибка)."""
+    try:
         if reminder.reminder_type == '24h_before':
             message = f"""
 🔔 Напоминание о записи #{appointment.id}
 
 💅 Услуга: {appointment.service_name}
-📅 Завтра в {appointment.time}
+📅 Завтра в {appointment.time_str}
 📍 Адрес: {config.SALON_INFO['address']}
 
 📞 Телефон салона: {config.SALON_INFO['phone']}
@@ -211,21 +310,23 @@ async def send_reminder(reminder: Reminder):
             """
 
         await bot.send_message(user.telegram_id, message)
-        reminder.sent_at = datetime.now()
-        session.commit()
+        return "sent"
 
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        logger.warning(f"Напоминание #{reminder.id} не доставлено: {e}")
+        return "failed"
     except Exception as e:
-        logger.error(f"Ошибка отправки напоминания: {e}")
-    finally:
-        session.close()
+        logger.error(f"Ошибка отправки напоминания #{reminder.id}: {e}")
+        return "retry"
 
 # ==================== ОБРАБОТЧИКИ КОМАНД ====================
 
 @dp.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext):
-    """Обработка команды /start"""
+async def cmd_start(message: Message, state: FSMContext, command: CommandObject):
+    """Обработка команды /start (в том числе по ссылке-приглашению /start <код>)"""
+    await release_slot(message.from_user.id)
     await state.clear()
-    user = await save_user(message.from_user)
+    _, referred = await register_user(message.from_user, referrer_code=command.args)
 
     welcome_text = f"""
 ✨ {hbold('Добро пожаловать в Nail Studio!')} ✨
@@ -245,6 +346,12 @@ async def cmd_start(message: Message, state: FSMContext):
 
     await message.answer(welcome_text, reply_markup=kb.main_menu(), parse_mode='HTML')
 
+    if referred:
+        await message.answer(
+            f"🤝 Вы пришли по приглашению друга - вам начислена скидка "
+            f"{config.LOYALTY_SYSTEM['referral_bonus']}%!"
+        )
+
 @dp.message(Command("admin"))
 async def cmd_admin(message: Message):
     """Панель администратора"""
@@ -252,30 +359,24 @@ async def cmd_admin(message: Message):
         await message.answer("⛔ У вас нет доступа к этой команде")
         return
 
-    session = Session()
-    try:
-        # Статистика
-        total_users = session.query(User).count()
-        total_appointments = session.query(Appointment).count()
-        pending_appointments = session.query(Appointment).filter_by(status="pending").count()
-        today_appointments = session.query(Appointment).filter(
-            Appointment.date == datetime.now().strftime("%d.%m.%Y"),
-            Appointment.status.in_(["confirmed", "pending"])
-        ).count()
-
-        stats_text = f"""
+    # Статистика
+    stats = await run_db(db.get_admin_stats)
+    queue = outbound_limiter.stats()
+    cache = user_cache.stats()
+
+    stats_text = f"""
 👑 Панель администратора
 
 📊 {hbold('Статистика:')}
-👥 Пользователей: {total_users}
-📅 Всего записей: {total_appointments}
-⏳ Ожидают подтверждения: {pending_appointments}
-📌 На сегодня: {today_appointments}
-        """
+👥 Пользователей: {stats['users']}
+📅 Всего записей: {stats['appointments']}
+⏳ Ожидают подтверждения: {stats['pending']}
+📌 На сегодня: {stats['today']}
+📤 В очереди отправки: {queue['queued']} (повторов из-за лимитов: {queue['retries']})
+🗂 Кэш пользователей: {cache['size']} (попаданий {cache['hit_rate']:.0%})
+    """
 
-        await message.answer(stats_text, reply_markup=kb.admin_menu_keyboard(), parse_mode='HTML')
-    finally:
-        session.close()
+    await message.answer(stats_text, reply_markup=kb.admin_menu_keyboard(), parse_mode='HTML')
 
 # ==================== ГЛАВНОЕ МЕНЮ ====================
 
@@ -306,6 +407,95 @@ async def show_gallery(message: Message):
         reply_markup=kb.gallery_keyboard()
     )
 
+async def reload_gallery(version=None):
+    """Перечитывает каталог галереи из БД"""
+    version = version or await run_db(db.get_gallery_version)
+    gallery.load(await run_db(db.get_gallery_images), version)
+
+async def sync_gallery():
+    """В режиме нескольких процессов фото могли загрузить в другом процессе"""
+    if config.WORKERS > 1:
+        version = await run_db(db.get_gallery_version)
+        if version != gallery.version:
+            await reload_gallery(version)
+
+@dp.callback_query(F.data.startswith("gallery_"))
+async def gallery_callback(callback: CallbackQuery):
+    """Категории галереи, страницы работ и случайная работа"""
+    await sync_gallery()
+    data = callback.data
+
+    if data == "gallery_menu":
+        await callback.message.answer(
+            "🖼️ Галерея наших работ\n\nВыберите категорию для просмотра:",
+            reply_markup=kb.gallery_keyboard()
+        )
+        await callback.answer()
+        return
+
+    if data == "gallery_random":
+        image = gallery.random()
+        if not image:
+            await callback.answer("Фото работ пока нет", show_alert=True)
+            return
+        service = config.SERVICES.get(image['service_type'], {})
+        images = [image]
+        caption = f"{service.get('emoji', '🎨')} {service.get('name', image['service_type'])}"
+        keyboard = kb.gallery_random_keyboard()
+    else:
+        service_type, _, offset = data.removeprefix("gallery_").partition("_")
+        if service_type not in config.SERVICES:
+            await callback.answer()
+            return
+        offset = int(offset or 0)
+        images = gallery.page(service_type, offset, config.GALLERY_PAGE_SIZE)
+        if not images:
+            await callback.answer("В этой категории пока нет фото", show_alert=True)
+            return
+        service = config.SERVICES[service_type]
+        total = gallery.count(service_type)
+        shown = offset + len(images)
+        caption = f"{service['emoji']} {service['name']}"
+        keyboard = kb.gallery_page_keyboard(service_type, shown if shown < total else None)
+
+    file_ids = await send_album(
+        callback.message,
+        [(index, image['file_id'], image['image_path'], caption if index == 0 else None)
+         for index, image in enumerate(images)]
+    )
+    changed = {}
+    for index, file_id in file_ids.items():
+        if images[index]['file_id'] != file_id:
+            images[index]['file_id'] = file_id
+            changed[images[index]['id']] = file_id
+    if changed:
+        await run_db(db.set_image_file_ids, changed)
+
+    if not file_ids:
+        await callback.answer("Фото временно недоступны", show_alert=True)
+        return
+    if data == "gallery_random":
+        await callback.message.answer("Хотите посмотреть еще?", reply_markup=keyboard)
+    else:
+        await callback.message.answer(f"Показано {shown} из {total}", reply_markup=keyboard)
+    await callback.answer()
+
+@dp.message(Command("rebuild_stats"))
+async def cmd_rebuild_stats(message: Message):
+    """Пересчет счетчиков панели администратора с нуля (для сверки)"""
+    if message.from_user.id not in config.ADMIN_IDS:
+        await message.answer("⛔ У вас нет доступа к этой команде")
+        return
+
+    mismatches = await run_db(db.rebuild_stats)
+    await run_db(db.rebuild_rollups)
+    if not mismatches:
+        await message.answer("✅ Счетчики пересчитаны, расхождений нет")
+        return
+
+    lines = [f"• {key}: {old} → {new}" for key, (old, new) in sorted(mismatches.items())]
+    await message.answer("⚠️ Счетчики пересчитаны, исправлены расхождения:\n" + "\n".join(lines[:50]))
+
 @dp.message(F.text == "📅 Записаться онлайн")
 async def start_booking(message: Message, state: FSMContext):
     """Начинает процесс записи"""
@@ -315,24 +505,19 @@ async def start_booking(message: Message, state: FSMContext):
 @dp.message(F.text == "👤 Мой профиль")
 async def show_profile(message: Message):
     """Показывает профиль пользователя"""
-    session = Session()
-    try:
-        user = session.query(User).filter_by(telegram_id=message.from_user.id).first()
+    user = await get_user(message.from_user.id)
 
-        if not user:
-            await message.answer("Сначала зарегистрируйтесь через /start")
-            return
+    if not user:
+        await message.answer("Сначала зарегистрируйтесь через /start")
+        return
 
-        # Получаем ближайшие записи
-        upcoming_appointments = session.query(Appointment).filter(
-            Appointment.user_id == user.id,
-            Appointment.status.in_(["pending", "confirmed"])
-        ).order_by(Appointment.date).limit(3).all()
+    # Получаем ближайшие записи
+    upcoming_appointments = await run_db(db.get_upcoming_appointments, user.id)
 
-        # Получаем доступные скидки
-        available_discounts = kb.get_discounts_for_user(user)
+    # Получаем доступные скидки
+    available_discounts = await get_available_discounts(user)
 
-        profile_text = f"""
+    profile_text = f"""
 👤 {hbold('Ваш профиль')}
 
 📋 {hbold('Информация:')}
@@ -344,47 +529,49 @@ async def show_profile(message: Message):
 
 🎫 {hbold('Реферальный код:')}
 Пригласите друга: {user.referral_code}
+{await referral_link(user)}
 Вы оба получите {config.LOYALTY_SYSTEM['referral_bonus']}% скидку!
 
 🎁 {hbold('Доступные скидки:')}
 """
 
-        for discount in available_discounts:
-            profile_text += f"• {discount['name']}: {discount['percent']}%\n"
-
-        if not available_discounts:
-            profile_text += "Пока нет доступных скидок\n"
-
-        if upcoming_appointments:
-            profile_text += f"\n📅 {hbold('Ближайшие записи:')}\n"
-            for app in upcoming_appointments:
-                status_icon = "⏳" if app.status == "pending" else "✅"
-                profile_text += f"{status_icon} {app.date} {app.time} - {app.service_name}\n"
-
-        await message.answer(profile_text, reply_markup=kb.profile_keyboard(), parse_mode='HTML')
-
-    finally:
-        session.close()
+    for discount in available_discounts:
+        profile_text += f"• {discount['name']}: {discount['percent']}%\n"
+
+    if not available_discounts:
+        profile_text += "Пока нет доступных скидок\n"
+
+    if upcoming_appointments:
+        profile_text += f"\n📅 {hbold('Ближайшие записи:')}\n"
+        for app in upcoming_appointments:
+            status_icon = "⏳" if app.status == "pending" else "✅"
+            profile_text += f"{status_icon} {app.date_str} {app.time_str} - {app.service_name}\n"
+
+    await message.answer(profile_text, reply_markup=kb.profile_keyboard(), parse_mode='HTML')
+
+async def reviews_menu_text() -> str:
+    """Текст меню отзывов: рейтинг и распределение оценок по счетчикам"""
+    total, average, stars = await run_db(db.get_review_summary)
+    text = f"⭐ {hbold('Отзывы наших клиентов')}\n\n"
+    if total:
+        text += f"Рейтинг: {hbold(f'{average:.1f}')} из 5 · отзывов: {total}\n\n"
+        for rating in range(5, 0, -1):
+            bar = "▇" * round(8 * stars[rating] / total)
+            text += f"{rating}⭐ {bar} {stars[rating]}\n"
+    else:
+        text += "Отзывов пока нет\n"
+    return text + "\n💖 Только реальные отзывы от наших клиентов.\nОставляйте свои впечатления и фотографии работ!"
 
 @dp.message(F.text == "⭐ Отзывы")
 async def show_reviews_menu(message: Message):
     """Показывает меню отзывов"""
-    session = Session()
-    try:
-        total_reviews = session.query(Review).filter_by(is_approved=True).count()
+    await message.answer(await reviews_menu_text(), reply_markup=kb.review_keyboard(), parse_mode='HTML')
 
-        reviews_text = f"""
-⭐ {hbold('Отзывы наших клиентов')}
-
-Всего отзывов: {total_reviews}
-
-💖 Только реальные отзывы от наших клиентов.
-Оставляйте свои впечатления и фотографии работ!
-        """
-
-        await message.answer(reviews_text, reply_markup=kb.review_keyboard(), parse_mode='HTML')
-    finally:
-        session.close()
+@dp.callback_query(F.data == "reviews_menu")
+async def back_to_reviews_menu(callback: CallbackQuery):
+    """Возвращает ленту отзывов к меню"""
+    await callback.message.edit_text(await reviews_menu_text(), reply_markup=kb.review_keyboard(), parse_mode='HTML')
+    await callback.answer()
 
 @dp.message(F.text == "📞 Контакты")
 async def show_contacts(message: Message):
@@ -466,13 +653,22 @@ async def choose_service(callback: CallbackQuery, state: FSMContext):
 async def choose_date(callback: CallbackQuery, state: FSMContext):
     """Выбор даты"""
     date_str = callback.data.split("_")[1]
+    data = await state.get_data()
+    day = datetime.strptime(date_str, "%d.%m.%Y").date()
+    await refresh_day_slots(day)
+    free_slots = slot_index.free_slots(data['service_id'], day, owner=callback.from_user.id)
+
+    if not free_slots:
+        await callback.answer("😔 На эту дату нет свободного времени, выберите другую", show_alert=True)
+        return
+
     await state.update_data(date=date_str)
     await state.set_state(BookingStates.choosing_time)
 
     await callback.message.edit_text(
         f"📅 Дата: {hbold(date_str)}\n\n"
         f"⏰ Выберите удобное время:",
-        reply_markup=kb.booking_times_keyboard(),
+        reply_markup=kb.booking_times_keyboard(free_slots),
         parse_mode='HTML'
     )
 
@@ -480,11 +676,23 @@ async def choose_date(callback: CallbackQuery, state: FSMContext):
 async def choose_time(callback: CallbackQuery, state: FSMContext):
     """Выбор времени"""
     time_slot = callback.data.split("_")[1]
+    data = await state.get_data()
+    day = datetime.strptime(data['date'], "%d.%m.%Y").date()
+    await refresh_day_slots(day)
+
+    # Придерживаем время, пока клиент подтверждает запись
+    if not await hold_slot(callback.from_user.id, data['service_id'], day, time_slot):
+        await callback.answer("😔 Это время только что заняли, выберите другое", show_alert=True)
+        await callback.message.edit_reply_markup(
+            reply_markup=kb.booking_times_keyboard(
+                slot_index.free_slots(data['service_id'], day, owner=callback.from_user.id)
+            )
+        )
+        return
+
     await state.update_data(time=time_slot)
     await state.set_state(BookingStates.confirming)
 
-    data = await state.get_data()
-
     summary = f"""
 📋 {hbold('Ваша заявка на запись:')}
 
@@ -524,62 +732,55 @@ async def confirm_booking(callback: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "apply_discount")
 async def apply_discount(callback: CallbackQuery, state: FSMContext):
     """Применение скидки к записи"""
-    session = Session()
-    try:
-        user = session.query(User).filter_by(telegram_id=callback.from_user.id).first()
-        if not user:
-            await callback.answer("❌ Пользователь не найден", show_alert=True)
-            return
-
-        available_discounts = kb.get_discounts_for_user(user)
+    user = await get_user(callback.from_user.id)
+    if not user:
+        await callback.answer("❌ Пользователь не найден", show_alert=True)
+        return
 
-        if not available_discounts:
-            await callback.answer("🎫 У вас нет доступных скидок", show_alert=True)
-            return
+    available_discounts = await get_available_discounts(user)
 
-        await state.set_state(BookingStates.applying_discount)
+    if not available_discounts:
+        await callback.answer("🎫 У вас нет доступных скидок", show_alert=True)
+        return
 
-        discounts_text = "🎁 Доступные скидки:\n\n"
-        for discount in available_discounts:
-            discounts_text += f"• {discount['name']}: {discount['percent']}%\n"
+    await state.set_state(BookingStates.applying_discount)
 
-        await callback.message.edit_text(
-            discounts_text,
-            reply_markup=kb.discount_keyboard(available_discounts)
-        )
+    discounts_text = "🎁 Доступные скидки:\n\n"
+    for discount in available_discounts:
+        discounts_text += f"• {discount['name']}: {discount['percent']}%\n"
 
-    finally:
-        session.close()
+    await callback.message.edit_text(
+        discounts_text,
+        reply_markup=kb.discount_keyboard(available_discounts)
+    )
 
 @dp.callback_query(F.data.startswith("use_discount_"), BookingStates.applying_discount)
 async def use_selected_discount(callback: CallbackQuery, state: FSMContext):
     """Применение выбранной скидки"""
-    discount_id = callback.data.split("_")[2]
+    discount_id = callback.data.removeprefix("use_discount_")
     data = await state.get_data()
 
-    session = Session()
-    try:
-        user = session.query(User).filter_by(telegram_id=callback.from_user.id).first()
-        available_discounts = kb.get_discounts_for_user(user)
+    user = await get_user(callback.from_user.id)
+    available_discounts = await get_available_discounts(user) if user else []
 
-        selected_discount = next((d for d in available_discounts if d['id'] == discount_id), None)
+    selected_discount = next((d for d in available_discounts if d['id'] == discount_id), None)
 
-        if not selected_discount:
-            await callback.answer("❌ Скидка не найдена", show_alert=True)
-            return
+    if not selected_discount:
+        await callback.answer("❌ Скидка не найдена", show_alert=True)
+        return
 
-        # Рассчитываем цену со скидкой
-        original_price = data['original_price']
-        discount_percent = selected_discount['percent']
-        final_price = int(original_price * (1 - discount_percent / 100))
+    # Рассчитываем цену со скидкой
+    original_price = data['original_price']
+    discount_percent = selected_discount['percent']
+    final_price = int(original_price * (1 - discount_percent / 100))
 
-        await state.update_data(
-            discount_id=discount_id,
-            discount_percent=discount_percent,
-            final_price=final_price
-        )
+    await state.update_data(
+        discount_id=discount_id,
+        discount_percent=discount_percent,
+        final_price=final_price
+    )
 
-        summary = f"""
+    summary = f"""
 📋 {hbold('Заявка со скидкой:')}
 
 💅 Услуга: {data['service_name']}
@@ -590,17 +791,14 @@ async def use_selected_discount(callback: CallbackQuery, state: FSMContext):
 ⏰ Время: {data['time']}
 
 {hitalic('Всё верно?')}
-        """
-
-        await callback.message.edit_text(
-            summary,
-            reply_markup=kb.confirm_booking_keyboard(),
-            parse_mode='HTML'
-        )
-        await state.set_state(BookingStates.confirming)
+    """
 
-    finally:
-        session.close()
+    await callback.message.edit_text(
+        summary,
+        reply_markup=kb.confirm_booking_keyboard(),
+        parse_mode='HTML'
+    )
+    await state.set_state(BookingStates.confirming)
 
 @dp.callback_query(F.data == "no_discount", BookingStates.applying_discount)
 async def no_discount(callback: CallbackQuery, state: FSMContext):
@@ -628,6 +826,7 @@ async def no_discount(callback: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "cancel_booking")
 async def cancel_booking(callback: CallbackQuery, state: FSMContext):
     """Отмена записи"""
+    await release_slot(callback.from_user.id)
     await state.clear()
     await callback.message.edit_text("❌ Запись отменена")
     await callback.message.answer("Вы вернулись в главное меню", reply_markup=kb.main_menu())
@@ -654,35 +853,22 @@ async def process_contact(message: Message, state: FSMContext):
         discount_percent = data.get('discount_percent', 0)
 
         # Сохраняем запись в БД
-        session = Session()
         try:
-            appointment = Appointment(
+            appointment = await run_db(
+                db.create_appointment,
                 user_id=user.id,
                 service=data['service_id'],
                 service_name=data['service_name'],
                 original_price=data['original_price'],
                 final_price=final_price,
                 discount_applied=discount_percent,
-                date=data['date'],
-                time=data['time'],
-                status="pending"
+                starts_at=datetime.strptime(f"{data['date']} {data['time']}", "%d.%m.%Y %H:%M"),
+                discount_id=data.get('discount_id')
             )
-            session.add(appointment)
-            session.commit()
-
-            # Если была применена скидка, помечаем ее как использованную
-            if data.get('discount_id'):
-                if data['discount_id'] == 'first_visit':
-                    discount = session.query(UserDiscount).filter_by(
-                        user_id=user.id,
-                        discount_type='first_visit',
-                        is_used=False
-                    ).first()
-                    if discount:
-                        discount.is_used = True
-                # Обновляем общий процент скидки пользователя
-                user.discount_percent = max(user.discount_percent, discount_percent)
-                session.commit()
+            slot_index.add(appointment.id, appointment.starts_at, appointment.ends_at)
+            await release_slot(message.from_user.id)
+            # Запись со скидкой меняет скидку пользователя
+            user_cache.invalidate(message.from_user.id)
 
             # Планируем напоминания
             await schedule_reminders(appointment)
@@ -715,11 +901,15 @@ async def process_contact(message: Message, state: FSMContext):
                 parse_mode='HTML'
             )
 
+        except db.SlotTakenError:
+            await release_slot(message.from_user.id)
+            await message.answer(
+                "😔 Это время только что заняли. Пожалуйста, выберите другое время.",
+                reply_markup=kb.main_menu()
+            )
         except Exception as e:
             logger.error(f"Ошибка сохранения записи: {e}")
             await message.answer("❌ Ошибка при создании заявки. Попробуйте снова.")
-        finally:
-            session.close()
 
     except Exception as e:
         logger.error(f"Ошибка обработки контакта: {e}")
@@ -732,125 +922,107 @@ async def process_contact(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "my_appointments")
 async def show_my_appointments(callback: CallbackQuery):
     """Показывает записи пользователя"""
-    session = Session()
-    try:
-        user = session.query(User).filter_by(telegram_id=callback.from_user.id).first()
-        if not user:
-            await callback.answer("❌ Пользователь не найден", show_alert=True)
-            return
+    user = await get_user(callback.from_user.id)
+    if not user:
+        await callback.answer("❌ Пользователь не найден", show_alert=True)
+        return
 
-        appointments = session.query(Appointment).filter_by(user_id=user.id)\
-            .order_by(Appointment.date.desc()).limit(10).all()
+    appointments = await run_db(db.get_user_appointments, user.id)
 
-        if not appointments:
-            await callback.message.edit_text(
-                "📭 У вас пока нет записей\n\n"
-                "Запишитесь на услугу через меню 💅",
-                reply_markup=kb.profile_keyboard()
-            )
-            return
+    if not appointments:
+        await callback.message.edit_text(
+            "📭 У вас пока нет записей\n\n"
+            "Запишитесь на услугу через меню 💅",
+            reply_markup=kb.profile_keyboard()
+        )
+        return
 
-        appointments_text = f"""
+    appointments_text = f"""
 📋 {hbold('Ваши записи:')}
 
 """
-        for app in appointments:
-            status_icons = {
-                "pending": "⏳",
-                "confirmed": "✅",
-                "completed": "🎉",
-                "cancelled": "❌",
-                "noshow": "🚫"
-            }
-            status_icon = status_icons.get(app.status, "📝")
-
-            appointments_text += f"""
-{status_icon} #{app.id} - {app.date} {app.time}
+    for app in appointments:
+        status_icons = {
+            "pending": "⏳",
+            "confirmed": "✅",
+            "completed": "🎉",
+            "cancelled": "❌",
+            "noshow": "🚫"
+        }
+        status_icon = status_icons.get(app.status, "📝")
+
+        appointments_text += f"""
+{status_icon} #{app.id} - {app.date_str} {app.time_str}
 💅 {app.service_name}
 💰 {app.final_price}₽ (скидка {app.discount_applied}%)
 📊 Статус: {app.status}
 ──────────────
 """
 
-        await callback.message.edit_text(
-            appointments_text,
-            reply_markup=kb.profile_keyboard(),
-            parse_mode='HTML'
-        )
-
-    finally:
-        session.close()
+    await callback.message.edit_text(
+        appointments_text,
+        reply_markup=kb.profile_keyboard(),
+        parse_mode='HTML'
+    )
 
 @dp.callback_query(F.data == "my_discounts")
 async def show_my_discounts(callback: CallbackQuery):
     """Показывает скидки пользователя"""
-    session = Session()
-    try:
-        user = session.query(User).filter_by(telegram_id=callback.from_user.id).first()
-        if not user:
-            await callback.answer("❌ Пользователь не найден", show_alert=True)
-            return
+    user = await get_user(callback.from_user.id)
+    if not user:
+        await callback.answer("❌ Пользователь не найден", show_alert=True)
+        return
 
-        available_discounts = kb.get_discounts_for_user(user)
-        used_discounts = session.query(UserDiscount).filter_by(user_id=user.id, is_used=True).all()
+    available_discounts = await get_available_discounts(user)
+    used_discounts = await run_db(db.get_used_discounts, user.id)
 
-        discounts_text = f"""
+    discounts_text = f"""
 🎁 {hbold('Ваши скидки:')}
 
 🎫 {hbold('Доступные:')}
 """
 
-        if available_discounts:
-            for discount in available_discounts:
-                discounts_text += f"• {discount['name']}: {discount['percent']}%\n"
-        else:
-            discounts_text += "Нет доступных скидок\n"
-
-        discounts_text += f"\n📋 {hbold('Использованные:')}\n"
+    if available_discounts:
+        for discount in available_discounts:
+            discounts_text += f"• {discount['name']}: {discount['percent']}%\n"
+    else:
+        discounts_text += "Нет доступных скидок\n"
 
-        if used_discounts:
-            for discount in used_discounts:
-                discounts_text += f"• {discount.discount_type}: {discount.discount_percent}%\n"
-        else:
-            discounts_text += "Вы еще не использовали скидки\n"
+    discounts_text += f"\n📋 {hbold('Использованные:')}\n"
 
-        discounts_text += f"\n🎫 {hbold('Реферальный код:')}\n{user.referral_code}"
-        discounts_text += f"\nПригласите друга и получите {config.LOYALTY_SYSTEM['referral_bonus']}% скидку!"
+    if used_discounts:
+        for discount in used_discounts:
+            discounts_text += f"• {discount.discount_type}: {discount.discount_percent}%\n"
+    else:
+        discounts_text += "Вы еще не использовали скидки\n"
 
-        await callback.message.edit_text(
-            discounts_text,
-            reply_markup=kb.profile_keyboard(),
-            parse_mode='HTML'
-        )
+    discounts_text += f"\n🎫 {hbold('Реферальный код:')}\n{user.referral_code}\n{await referral_link(user)}"
+    discounts_text += f"\nПригласите друга и получите {config.LOYALTY_SYSTEM['referral_bonus']}% скидку!"
 
-    finally:
-        session.close()
+    await callback.message.edit_text(
+        discounts_text,
+        reply_markup=kb.profile_keyboard(),
+        parse_mode='HTML'
+    )
 
 @dp.callback_query(F.data.startswith("cancel_"))
 async def cancel_my_appointment(callback: CallbackQuery):
     """Отмена записи пользователем"""
     try:
         appointment_id = int(callback.data.split("_")[1])
-        session = Session()
 
-        try:
-            user = session.query(User).filter_by(telegram_id=callback.from_user.id).first()
-            appointment = session.query(Appointment).filter_by(id=appointment_id, user_id=user.id).first()
-
-            if not appointment:
-                await callback.answer("❌ Запись не найдена", show_alert=True)
-                return
+        appointment, user, error = await run_db(
+            db.cancel_user_appointment, callback.from_user.id, appointment_id
+        )
 
-            # Можно отменять только pending и confirmed записи
-            if appointment.status not in ["pending", "confirmed"]:
-                await callback.answer(f"❌ Нельзя отменить запись со статусом {appointment.status}", show_alert=True)
-                return
+        if error:
+            await callback.answer(error, show_alert=True)
+            return
 
-            appointment.status = "cancelled"
-            appointment.cancelled_at = datetime.now()
-            session.commit()
+        slot_index.remove(appointment.id)
 
-            # Уведомляем админов
+        # Уведомляем админов
+        with outbound.priority(Priority.ALERT):
             for admin_id in config.ADMIN_IDS:
                 try:
                     await bot.send_message(
@@ -858,16 +1030,13 @@ async def cancel_my_appointment(callback: CallbackQuery):
                         f"⚠️ Отмена записи #{appointment_id}\n\n"
                         f"Клиент: {user.first_name}\n"
                         f"Услуга: {appointment.service_name}\n"
-                        f"Дата: {appointment.date} {appointment.time}"
+                        f"Дата: {appointment.date_str} {appointment.time_str}"
                     )
                 except:
                     pass
 
-            await callback.answer("✅ Запись отменена", show_alert=True)
-            await show_my_appointments(callback)
-
-        finally:
-            session.close()
+        await callback.answer("✅ Запись отменена", show_alert=True)
+        await show_my_appointments(callback)
 
     except Exception as e:
         logger.error(f"Ошибка отмены записи: {e}")
@@ -878,35 +1047,30 @@ async def reschedule_appointment(callback: CallbackQuery, state: FSMContext):
     """Перенос записи"""
     try:
         appointment_id = int(callback.data.split("_")[1])
-        session = Session()
-
-        try:
-            user = session.query(User).filter_by(telegram_id=callback.from_user.id).first()
-            appointment = session.query(Appointment).filter_by(id=appointment_id, user_id=user.id).first()
 
-            if not appointment:
-                await callback.answer("❌ Запись не найдена", show_alert=True)
-                return
+        user = await get_user(callback.from_user.id)
+        appointment = await run_db(db.get_user_appointment, user.id, appointment_id) if user else None
 
-            # Сохраняем данные записи для переноса
-            await state.update_data(
-                reschedule_appointment_id=appointment_id,
-                service_id=appointment.service,
-                service_name=appointment.service_name,
-                original_price=appointment.original_price,
-                final_price=appointment.final_price
-            )
+        if not appointment:
+            await callback.answer("❌ Запись не найдена", show_alert=True)
+            return
 
-            # Показываем выбор новой даты
-            await state.set_state(BookingStates.choosing_date)
-            await callback.message.edit_text(
-                f"🔄 Перенос записи #{appointment_id}\n\n"
-                f"📅 Выберите новую дату:",
-                reply_markup=kb.booking_dates_keyboard()
-            )
+        # Сохраняем данные записи для переноса
+        await state.update_data(
+            reschedule_appointment_id=appointment_id,
+            service_id=appointment.service,
+            service_name=appointment.service_name,
+            original_price=appointment.original_price,
+            final_price=appointment.final_price
+        )
 
-        finally:
-            session.close()
+        # Показываем выбор новой даты
+        await state.set_state(BookingStates.choosing_date)
+        await callback.message.edit_text(
+            f"🔄 Перенос записи #{appointment_id}\n\n"
+            f"📅 Выберите новую дату:",
+            reply_markup=kb.booking_dates_keyboard()
+        )
 
     except Exception as e:
         logger.error(f"Ошибка переноса записи: {e}")
@@ -962,16 +1126,16 @@ async def choose_rating(callback: CallbackQuery, state: FSMContext):
 async def process_review_photo(message: Message, state: FSMContext):
     """Обработка фото для отзыва"""
     if message.photo:
-        # Сохраняем фото
         photo = message.photo[-1]
-        file_info = await bot.get_file(photo.file_id)
-        file_ext = file_info.file_path.split('.')[-1]
 
-        # Создаем уникальное имя файла
-        filename = f"images/reviews/review_{message.from_user.id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{file_ext}"
-        await bot.download_file(file_info.file_path, filename)
+        # Создаем уникальное имя файла; скачивание и обработка идут в фоне
+        filename = f"images/reviews/review_{message.from_user.id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
+        task = asyncio.create_task(store_review_photo(photo.file_id, filename))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
 
-        await state.update_data(photo_path=filename)
+        # file_id позволяет отправлять фото повторно без загрузки, файл - запасной вариант
+        await state.update_data(photo_path=filename, photo_file_id=photo.file_id)
         await state.set_state(ReviewStates.writing_text)
 
         await message.answer(
@@ -983,6 +1147,19 @@ async def process_review_photo(message: Message, state: FSMContext):
     else:
         await message.answer("Пожалуйста, отправьте фото вашего маникюра")
 
+async def store_review_photo(file_id: str, path: str):
+    """Скачивает фото отзыва и сохраняет сжатую версию (в фоне)"""
+    original = f"{path}.orig"
+    try:
+        file_info = await bot.get_file(file_id)
+        await bot.download_file(file_info.file_path, original)
+        size = await image_pipeline.process(original, path)
+        logger.info(f"Фото отзыва сохранено: {path} ({size // 1024} КБ)")
+    except Exception as e:
+        logger.error(f"Ошибка обработки фото отзыва {path}: {e}")
+        # Исходник удаляет только успешная обработка
+        Path(original).unlink(missing_ok=True)
+
 @dp.message(ReviewStates.writing_text)
 async def process_review_text(message: Message, state: FSMContext):
     """Обработка текста отзыва"""
@@ -999,40 +1176,39 @@ async def process_review_text(message: Message, state: FSMContext):
         return
 
     # Сохраняем отзыв
-    session = Session()
     try:
         user = await save_user(message.from_user)
 
-        review = Review(
+        await run_db(
+            db.create_review,
             user_id=user.id,
             rating=data['rating'],
             text=message.text,
             photo_path=data.get('photo_path'),
-            is_approved=True
+            photo_file_id=data.get('photo_file_id')
         )
-        session.add(review)
-        session.commit()
 
         # Уведомляем админов
-        for admin_id in config.ADMIN_IDS:
-            try:
-                admin_msg = f"""
+        with outbound.priority(Priority.ALERT):
+            for admin_id in config.ADMIN_IDS:
+                try:
+                    admin_msg = f"""
 ⭐ Новый отзыв!
 
 👤 От: {user.first_name}
 ⭐ Оценка: {'⭐' * data['rating']}
 📝 Текст: {message.text}
 """
-                if data.get('photo_path'):
-                    await bot.send_photo(
-                        admin_id,
-                        photo=FSInputFile(data['photo_path']),
-                        caption=admin_msg
-                    )
-                else:
-                    await bot.send_message(admin_id, admin_msg)
-            except Exception as e:
-                logger.error(f"Ошибка уведомления админа: {e}")
+                    if data.get('photo_path'):
+                        await bot.send_photo(
+                            admin_id,
+                            photo=data.get('photo_file_id') or FSInputFile(data['photo_path']),
+                            caption=admin_msg
+                        )
+                    else:
+                        await bot.send_message(admin_id, admin_msg)
+                except Exception as e:
+                    logger.error(f"Ошибка уведомления админа: {e}")
 
         await message.answer(
             f"✅ {hbold('Спасибо за ваш отзыв!')}\n\n"
@@ -1045,16 +1221,60 @@ async def process_review_text(message: Message, state: FSMContext):
         logger.error(f"Ошибка сохранения отзыва: {e}")
         await message.answer("❌ Ошибка сохранения отзыва")
     finally:
-        session.close()
         await state.clear()
 
-@dp.callback_query(F.data == "read_reviews")
+def _keyset_cursor(row) -> str:
+    """Ключ (created_at, id) строки для callback_data"""
+    return f"{row.created_at:%Y%m%d%H%M%S%f}_{row.id}"
+
+def _parse_keyset_cursor(cursor: str):
+    created_at, row_id = cursor.split("_")
+    return datetime.strptime(created_at, "%Y%m%d%H%M%S%f"), int(row_id)
+
+def review_caption(review, first_name: Optional[str], limit: int = 900) -> str:
+    """Текст отзыва для сообщения или подписи к фото (подпись - до 1024 символов)"""
+    header = f"{'⭐' * review.rating} {hbold(first_name or 'Аноним')} ({review.created_at:%d.%m.%Y}):"
+    text = review.text or ""
+    if len(text) > limit:
+        text = text[:limit] + "…"
+    text = html.escape(text)
+    return f"{header}\n\n{text}"
+
+async def send_review_album(message: Message, reviews) -> set:
+    """Отправляет отзывы с фото альбомом и возвращает id показанных отзывов"""
+    items = [
+        (review.id, review.photo_file_id, review.photo_path, review_caption(review, name))
+        for review, name in reviews
+    ]
+    file_ids = await send_album(message, items)
+    known = {review.id: review.photo_file_id for review, _ in reviews}
+    changed = {review_id: file_id for review_id, file_id in file_ids.items() if file_id != known[review_id]}
+    if changed:
+        await run_db(db.set_review_photo_ids, changed)
+    return set(file_ids)
+
+async def load_reviews_page(page: str):
+    """Страница ленты: first - самые новые, next_<ключ> / prev_<ключ> - старее/новее отзыва с ключом"""
+    after = before = None
+    if page.startswith("next_"):
+        after = _parse_keyset_cursor(page.removeprefix("next_"))
+    elif page.startswith("prev_"):
+        before = _parse_keyset_cursor(page.removeprefix("prev_"))
+    return await run_db(db.get_reviews_page, config.REVIEWS_PAGE_SIZE, after=after, before=before)
+
+@dp.callback_query((F.data == "read_reviews") | F.data.startswith("reviews_page_"))
 async def show_all_reviews(callback: CallbackQuery):
-    """Показывает все отзывы"""
-    session = Session()
+    """Лента отзывов одним сообщением с листанием.
+
+    read_reviews - первая страница, reviews_page_next_<ключ> / reviews_page_prev_<ключ> -
+    страница старее/новее отзыва с ключом (created_at, id)."""
+    page = callback.data.removeprefix("reviews_page_") if callback.data != "read_reviews" else "first"
     try:
-        reviews = session.query(Review).filter_by(is_approved=True)\
-            .order_by(Review.created_at.desc()).limit(10).all()
+        reviews, has_prev, has_next = await load_reviews_page(page)
+        if not reviews and page != "first":
+            # Страница опустела - начинаем сначала
+            page = "first"
+            reviews, has_prev, has_next = await load_reviews_page(page)
 
         if not reviews:
             await callback.message.edit_text(
@@ -1063,49 +1283,45 @@ async def show_all_reviews(callback: CallbackQuery):
             )
             return
 
-        for review in reviews:
-            user = session.query(User).filter_by(id=review.user_id).first()
-            name = user.first_name if user else "Аноним"
-            date = review.created_at.strftime("%d.%m.%Y")
-
-            review_text = f"""
-{'⭐' * review.rating} {hbold(name)} ({date}):
-
-{review.text}
-"""
-
-            if review.photo_path and os.path.exists(review.photo_path):
-                try:
-                    await callback.message.answer_photo(
-                        FSInputFile(review.photo_path),
-                        caption=review_text,
-                        parse_mode='HTML'
-                    )
-                except:
-                    await callback.message.answer(
-                        review_text,
-                        parse_mode='HTML'
-                    )
-            else:
-                await callback.message.answer(
-                    review_text,
-                    parse_mode='HTML'
-                )
-
-        await callback.message.answer(
-            f"📊 Всего отзывов: {len(reviews)}",
-            reply_markup=kb.review_keyboard()
+        # Текст страницы укладывается в лимит сообщения 4096 символов
+        limit = 3500 // config.REVIEWS_PAGE_SIZE
+        text = f"⭐ {hbold('Отзывы')}\n\n" + "\n\n".join(
+            ("📷 " if review.photo_file_id or review.photo_path else "") + review_caption(review, name, limit)
+            for review, name in reviews
+        )
+        has_photos = any(review.photo_file_id or review.photo_path for review, _ in reviews)
+        await callback.message.edit_text(
+            text,
+            reply_markup=kb.reviews_feed_keyboard(
+                prev_data=f"reviews_page_prev_{_keyset_cursor(reviews[0][0])}" if has_prev else None,
+                next_data=f"reviews_page_next_{_keyset_cursor(reviews[-1][0])}" if has_next else None,
+                photos_data=f"reviews_photos_{page}" if has_photos else None
+            ),
+            parse_mode='HTML'
         )
+        await callback.answer()
 
+    except TelegramBadRequest:
+        # Страница не изменилась
+        await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка загрузки отзывов: {e}")
         await callback.answer("❌ Ошибка загрузки отзывов", show_alert=True)
-    finally:
-        session.close()
+
+@dp.callback_query(F.data.startswith("reviews_photos_"))
+async def show_reviews_photos(callback: CallbackQuery):
+    """Отправляет альбомом фото отзывов со страницы ленты"""
+    reviews, _, _ = await load_reviews_page(callback.data.removeprefix("reviews_photos_"))
+    with_photos = [(review, name) for review, name in reviews if review.photo_file_id or review.photo_path]
+    if not with_photos:
+        await callback.answer("На этой странице нет фото")
+        return
+    await callback.answer()
+    await send_review_album(callback.message, with_photos)
 
 # ==================== АДМИН-ПАНЕЛЬ ====================
 
-@dp.callback_query(F.data.startswith("admin_"))
+@dp.callback_query(F.data.startswith("admin_") | (F.data == "broadcast_all"))
 async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
     """Обработка админ-колбэков"""
     if callback.from_user.id not in config.ADMIN_IDS:
@@ -1114,8 +1330,34 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
     data = callback.data
 
-    if data == "admin_pending":
-        await show_pending_appointments(callback)
+    if data == "admin_pending" or data.startswith("admin_pending_"):
+        await show_pending_appointments(callback, data)
+
+    elif data == "admin_gallery":
+        await callback.message.edit_text(
+            "🖼️ Управление галереей\n\n"
+            f"Сейчас фото: {sum(gallery.count(service_id) for service_id in config.SERVICES)}\n"
+            "Выберите категорию, в которую будете загружать фото:",
+            reply_markup=kb.admin_gallery_keyboard()
+        )
+
+    elif data.startswith("admin_gallery_"):
+        service_id = data.removeprefix("admin_gallery_")
+        if service_id in config.SERVICES:
+            await state.set_state(AdminStates.adding_photo)
+            await state.update_data(gallery_service=service_id)
+            await callback.message.edit_text(
+                f"📤 Загрузка в «{config.SERVICES[service_id]['name']}»\n\n"
+                "Отправляйте фото по одному или альбомами - сколько угодно.\n"
+                "Повторы одного и того же фото пропускаются.\n"
+                "Когда закончите, напишите «готово»."
+            )
+
+    elif data == "admin_stats" or data.startswith("admin_stats_"):
+        await show_stats_report(callback, data.removeprefix("admin_stats").lstrip("_") or "week")
+
+    elif data == "admin_discounts":
+        await show_discount_summary(callback)
 
     elif data == "admin_broadcast":
         await callback.message.edit_text(
@@ -1137,37 +1379,93 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
     elif data.startswith("admin_reject_"):
         await reject_appointment(callback)
 
+    elif data.startswith("admin_noshow_"):
+        await mark_noshow(callback)
+
+# ---------- Загрузка фото в галерею ----------
+
+_ingest_reports = {}  # chat_id -> {'added', 'duplicates', 'failed', 'task'}
+
+def _count_ingest(chat_id: int, outcome: str):
+    """Считает результат загрузки; отчет уходит после паузы в поступлении фото"""
+    report = _ingest_reports.setdefault(chat_id, {'added': 0, 'duplicates': 0, 'failed': 0, 'task': None})
+    report[outcome] += 1
+    if report['task']:
+        report['task'].cancel()
+    report['task'] = asyncio.create_task(_send_ingest_report(chat_id))
+
+async def _send_ingest_report(chat_id: int):
+    await asyncio.sleep(config.GALLERY_REPORT_DELAY)
+    report = _ingest_reports.pop(chat_id, None)
+    if not report:
+        return
+    text = f"🖼️ Добавлено фото: {report['added']}"
+    if report['duplicates']:
+        text += f"\n♻️ Уже были в галерее: {report['duplicates']}"
+    if report['failed']:
+        text += f"\n❌ Не удалось загрузить: {report['failed']}"
+    await bot.send_message(chat_id, text + "\n\nМожно отправить еще или написать «готово».")
+
+async def ingest_gallery_photo(media, service_id: str) -> str:
+    """Скачивает фото (PhotoSize или Document) потоком в хранилище по хэшу и добавляет в каталог.
+
+    Возвращает итог"""
+    file = await bot.get_file(media.file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    content_hash, path = await store_stream(bot.session.stream_content(url))
+
+    # file_id документа нельзя отправить как фото - его запомнит первая отправка из файла
+    file_id = media.file_id if isinstance(media, types.PhotoSize) else None
+    image_id = await run_db(db.add_gallery_image, service_id, path, content_hash, file_id)
+    if image_id is None:
+        return 'duplicates'
+    gallery.add(image_id, service_id, path, file_id)
+    return 'added'
+
+@dp.message(AdminStates.adding_photo, F.photo | F.document.mime_type.in_(config.GALLERY_DOCUMENT_TYPES))
+async def process_gallery_photo(message: Message, state: FSMContext):
+    """Фото для галереи (каждое фото альбома приходит отдельным сообщением)"""
+    if message.from_user.id not in config.ADMIN_IDS:
+        return
+    data = await state.get_data()
+    try:
+        media = message.photo[-1] if message.photo else message.document
+        outcome = await ingest_gallery_photo(media, data['gallery_service'])
+    except Exception as e:
+        logger.error(f"Ошибка загрузки фото в галерею: {e}")
+        outcome = 'failed'
+    _count_ingest(message.chat.id, outcome)
+
+@dp.message(AdminStates.adding_photo, F.text.lower().strip() == "готово")
+async def finish_gallery_upload(message: Message, state: FSMContext):
+    """Завершение загрузки фото в галерею"""
+    await state.clear()
+    await message.answer("✅ Загрузка в галерею завершена", reply_markup=kb.admin_menu_keyboard())
+
+@dp.message(AdminStates.adding_photo)
+async def gallery_upload_hint(message: Message):
+    """Подсказка на остальные сообщения во время загрузки"""
+    await message.answer(
+        "📤 Отправьте фото (можно файлом JPEG, PNG или WebP).\n"
+        "Чтобы закончить загрузку, напишите «готово»."
+    )
+
 @dp.message(AdminStates.broadcast_all)
 async def process_broadcast_all(message: Message, state: FSMContext):
     """Обработка рассылки всем пользователям"""
-    session = Session()
     try:
-        users = session.query(User).all()
-        success_count = 0
+        # Рассылка сохраняется в историю сразу и дальше идет в фоне
+        broadcast = await run_db(db.create_broadcast, message.from_user.id, message.text)
 
-        for user in users:
-            try:
-                await bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=f"📢 Сообщение от салона:\n\n{message.text}"
-                )
-                success_count += 1
-            except:
-                pass
-
-        # Сохраняем в историю
-        admin_msg = AdminMessage(
-            admin_id=message.from_user.id,
-            message_type='broadcast_all',
-            message_text=message.text,
-            sent_count=success_count,
-            sent_at=datetime.now()
+        progress = await message.answer(
+            f"📢 Рассылка #{broadcast.id} запущена\n\n"
+            f"📨 Отправлено: 0 из {broadcast.total_count}"
         )
-        session.add(admin_msg)
-        session.commit()
+        await run_db(db.set_broadcast_progress_message, broadcast.id, progress.chat.id, progress.message_id)
+        broadcasts.start(broadcast.id)
 
         await message.answer(
-            f"✅ Рассылка отправлена {success_count} пользователям из {len(users)}",
+            "Прогресс рассылки обновляется в сообщении выше 👆",
             reply_markup=kb.admin_menu_keyboard()
         )
 
@@ -1175,144 +1473,178 @@ async def process_broadcast_all(message: Message, state: FSMContext):
         logger.error(f"Ошибка рассылки: {e}")
         await message.answer("❌ Ошибка рассылки")
     finally:
-        session.close()
         await state.clear()
 
-async def show_pending_appointments(callback: CallbackQuery):
-    """Показывает ожидающие подтверждения записи"""
-    session = Session()
-    try:
-        appointments = session.query(Appointment).filter_by(status="pending")\
-            .order_by(Appointment.created_at).all()
-
-        if not appointments:
-            await callback.message.edit_text(
-                "✅ Нет новых заявок на подтверждение",
-                reply_markup=kb.admin_menu_keyboard()
-            )
-            return
 
-        for appointment in appointments[:5]:
-            user = session.query(User).filter_by(id=appointment.user_id).first()
+async def show_pending_appointments(callback: CallbackQuery, data: str = "admin_pending"):
+    """Очередь заявок на подтверждение одним сообщением с листанием.
 
-            text = f"""
-📝 Заявка #{appointment.id}
-👤 {user.first_name} {user.last_name or ''}
-📱 {user.phone or 'Нет телефона'}
-🎫 Визитов: {user.visits_count}
-💅 {appointment.service_name}
-💰 {appointment.final_price}₽ (скидка {appointment.discount_applied}%)
-📅 {appointment.date} в {appointment.time}
-🕐 {appointment.created_at.strftime('%H:%M')}
-            """
+    data: admin_pending - первая страница, admin_pending_next_<ключ> /
+    admin_pending_prev_<ключ> - страница после/до заявки с ключом (created_at, id)."""
+    after = before = None
+    if data.startswith("admin_pending_next_"):
+        after = _parse_keyset_cursor(data.removeprefix("admin_pending_next_"))
+    elif data.startswith("admin_pending_prev_"):
+        before = _parse_keyset_cursor(data.removeprefix("admin_pending_prev_"))
 
-            await callback.message.answer(
-                text,
-                reply_markup=kb.admin_appointment_actions(appointment.id)
-            )
+    rows, has_prev, has_next = await run_db(
+        db.get_pending_page, config.ADMIN_PAGE_SIZE, after=after, before=before
+    )
+    if not rows and (after or before):
+        # Страница опустела - начинаем сначала
+        data = "admin_pending"
+        rows, has_prev, has_next = await run_db(db.get_pending_page, config.ADMIN_PAGE_SIZE)
 
-        await callback.message.answer(
-            f"📊 Всего заявок: {len(appointments)}",
+    if not rows:
+        await callback.message.edit_text(
+            "✅ Нет новых заявок на подтверждение",
             reply_markup=kb.admin_menu_keyboard()
         )
+        return
 
-    finally:
-        session.close()
+    total = (await run_db(db.get_stats, ['status:pending']))['status:pending']
+    text = f"📝 {hbold('Заявки на подтверждение')} (всего {total})\n"
+    for appointment, user in rows:
+        text += f"""
+{hbold(f'#{appointment.id}')} {appointment.service_name} - {appointment.date_str} в {appointment.time_str}
+👤 {html.escape(f"{user.first_name} {user.last_name or ''}")} · 📱 {user.phone or 'Нет телефона'} · 🎫 Визитов: {user.visits_count}
+💰 {appointment.final_price}₽ (скидка {appointment.discount_applied}%) · 🕐 {appointment.created_at.strftime('%d.%m %H:%M')}
+"""
+
+    try:
+        await callback.message.edit_text(
+            text,
+            reply_markup=kb.pending_queue_keyboard(
+                [appointment.id for appointment, _ in rows],
+                prev_data=f"admin_pending_prev_{_keyset_cursor(rows[0][0])}" if has_prev else None,
+                next_data=f"admin_pending_next_{_keyset_cursor(rows[-1][0])}" if has_next else None,
+                refresh_data=data
+            ),
+            parse_mode='HTML'
+        )
+    except TelegramBadRequest:
+        # Очередь не изменилась
+        pass
+
+async def refresh_pending_queue(callback: CallbackQuery):
+    """Перерисовывает очередь заявок, если действие нажато в ней"""
+    markup = callback.message.reply_markup
+    for row in (markup.inline_keyboard if markup else []):
+        for button in row:
+            if button.text == kb.REFRESH_BUTTON:
+                await show_pending_appointments(callback, button.callback_data)
+                return
+
+async def show_stats_report(callback: CallbackQuery, period: str):
+    """Отчет по выручке и загрузке за период"""
+    if period not in analytics.PERIODS:
+        await callback.answer()
+        return
+
+    since, until = analytics.period_range(period)
+    rows = await run_db(db.get_service_report, since, until)
+    try:
+        await callback.message.edit_text(
+            analytics.format_report(period, rows),
+            reply_markup=kb.admin_stats_keyboard(),
+            parse_mode='HTML'
+        )
+    except TelegramBadRequest:
+        # Отчет не изменился
+        pass
+    await callback.answer()
+
+async def show_discount_summary(callback: CallbackQuery):
+    """Сколько клиентов сейчас могут воспользоваться каждой скидкой - для планирования акций"""
+    subjects = await run_db(db.get_discount_subjects)
+    ledger = await run_db(db.get_discount_ledger)
+    # Все клиенты считаются одним проходом вне цикла событий
+    available = await asyncio.to_thread(discount_rules.evaluate_batch, subjects, ledger)
+
+    counts = Counter(discount['name'] for discounts in available.values() for discount in discounts)
+    text = f"🎁 {hbold('Скидки клиентов сейчас')}\n\n"
+    for name, count in counts.most_common():
+        text += f"• {name}: {count}\n"
+    if not counts:
+        text += "Ни у кого нет доступных скидок\n"
+    text += f"\nКлиентов со скидками: {sum(1 for discounts in available.values() if discounts)} из {len(available)}"
+    await callback.message.edit_text(text, reply_markup=kb.admin_menu_keyboard(), parse_mode='HTML')
 
 async def approve_appointment(callback: CallbackQuery):
     """Подтверждение записи администратором"""
     appointment_id = int(callback.data.split("_")[2])
-    session = Session()
+    appointment, user, error = await run_db(db.confirm_appointment, appointment_id)
+    if error:
+        await callback.answer(error, show_alert=True)
+        await refresh_pending_queue(callback)
+        return
+    user_cache.put(user)
+    # Уведомляем клиента
     try:
-        appointment = session.query(Appointment).filter_by(id=appointment_id).first()
-        if appointment:
-            appointment.status = "confirmed"
-            appointment.confirmed_at = datetime.now()
-            session.commit()
-
-            user = session.query(User).filter_by(id=appointment.user_id).first()
-
-            # Увеличиваем счетчик визитов пользователя
-            user.visits_count += 1
-            user.total_spent += appointment.final_price
-            user.last_visit = datetime.now()
-
-            # Проверяем достижения по визитам для скидок
-            for milestone, discount in config.LOYALTY_SYSTEM['visit_milestones'].items():
-                if user.visits_count == milestone:
-                    user.discount_percent = max(user.discount_percent, discount)
-                    # Создаем запись о скидке
-                    new_discount = UserDiscount(
-                        user_id=user.id,
-                        discount_type='milestone',
-                        discount_percent=discount
-                    )
-                    session.add(new_discount)
-
-            session.commit()
+        with outbound.priority(Priority.ALERT):
+            await bot.send_message(
+                user.telegram_id,
+                f"✅ {hbold('Ваша запись подтверждена!')} #{appointment.id}\n\n"
+                f"💅 Услуга: {appointment.service_name}\n"
+                f"💰 Цена: {appointment.final_price}₽\n"
+                f"📅 Дата: {appointment.date_str}\n"
+                f"⏰ Время: {appointment.time_str}\n\n"
+                f"📍 {hbold('Адрес:')}\n"
+                f"{config.SALON_INFO['address']}\n\n"
+                f"📞 {hbold('Телефон:')}\n"
+                f"{config.SALON_INFO['phone']}\n\n"
+                f"🎫 Теперь у вас {user.visits_count} визитов!\n"
+                f"🎁 Ваша скидка: {user.discount_percent}%\n\n"
+                f"{hitalic('Ждем вас! Приходите за 5-10 минут до записи.')} 💖",
+                parse_mode='HTML'
+            )
+    except:
+        pass
 
-            # Уведомляем клиента
-            try:
-                await bot.send_message(
-                    user.telegram_id,
-                    f"✅ {hbold('Ваша запись подтверждена!')} #{appointment.id}\n\n"
-                    f"💅 Услуга: {appointment.service_name}\n"
-                    f"💰 Цена: {appointment.final_price}₽\n"
-                    f"📅 Дата: {appointment.date}\n"
-                    f"⏰ Время: {appointment.time}\n\n"
-                    f"📍 {hbold('Адрес:')}\n"
-                    f"{config.SALON_INFO['address']}\n\n"
-                    f"📞 {hbold('Телефон:')}\n"
-                    f"{config.SALON_INFO['phone']}\n\n"
-                    f"🎫 Теперь у вас {user.visits_count} визитов!\n"
-                    f"🎁 Ваша скидка: {user.discount_percent}%\n\n"
-                    f"{hitalic('Ждем вас! Приходите за 5-10 минут до записи.')} 💖",
-                    parse_mode='HTML'
-                )
-            except:
-                pass
+    await callback.answer("✅ Запись подтверждена!", show_alert=True)
+    await refresh_pending_queue(callback)
 
-            await callback.answer("✅ Запись подтверждена!", show_alert=True)
-        else:
-            await callback.answer("❌ Запись не найдена", show_alert=True)
-    finally:
-        session.close()
+async def mark_noshow(callback: CallbackQuery):
+    """Отметка неявки клиента на подтвержденную запись"""
+    appointment_id = int(callback.data.split("_")[2])
+    appointment, user, error = await run_db(db.mark_noshow, appointment_id)
+    if error:
+        await callback.answer(error, show_alert=True)
+        return
+    user_cache.put(user)
+    await callback.answer(f"🚫 Неявка по записи #{appointment.id} отмечена", show_alert=True)
 
 async def reject_appointment(callback: CallbackQuery):
     """Отклонение записи администратором"""
     appointment_id = int(callback.data.split("_")[2])
-    session = Session()
-    try:
-        appointment = session.query(Appointment).filter_by(id=appointment_id).first()
-        if appointment:
-            appointment.status = "cancelled"
-            appointment.cancelled_at = datetime.now()
-            session.commit()
-
-            user = session.query(User).filter_by(id=appointment.user_id).first()
+    appointment, user, error = await run_db(db.reject_appointment, appointment_id)
+    if error:
+        await callback.answer(error, show_alert=True)
+        await refresh_pending_queue(callback)
+        return
+    slot_index.remove(appointment.id)
 
-            # Уведомляем клиента
-            try:
-                await bot.send_message(
-                    user.telegram_id,
-                    f"😔 {hbold('Ваша запись отклонена.')} #{appointment.id}\n\n"
-                    f"Пожалуйста, выберите другое время или свяжитесь с нами.\n\n"
-                    f"📞 {config.SALON_INFO['phone']}"
-                )
-            except:
-                pass
+    # Уведомляем клиента
+    try:
+        with outbound.priority(Priority.ALERT):
+            await bot.send_message(
+                user.telegram_id,
+                f"😔 {hbold('Ваша запись отклонена.')} #{appointment.id}\n\n"
+                f"Пожалуйста, выберите другое время или свяжитесь с нами.\n\n"
+                f"📞 {config.SALON_INFO['phone']}"
+            )
+    except:
+        pass
 
-            await callback.answer("❌ Запись отклонена", show_alert=True)
-        else:
-            await callback.answer("❌ Запись не найдена", show_alert=True)
-    finally:
-        session.close()
+    await callback.answer("❌ Запись отклонена", show_alert=True)
+    await refresh_pending_queue(callback)
 
 # ==================== НАВИГАЦИЯ ====================
 
 @dp.callback_query(F.data == "back_to_main")
 async def back_to_main(callback: CallbackQuery, state: FSMContext):
     """Возврат в главное меню"""
+    await release_slot(callback.from_user.id)
     await state.clear()
     await callback.message.edit_text("Главное меню:")
     await callback.message.answer("Выберите действие:", reply_markup=kb.main_menu())
@@ -1326,6 +1658,7 @@ async def back_to_services(callback: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "back_to_dates")
 async def back_to_dates(callback: CallbackQuery, state: FSMContext):
     """Возврат к выбору даты"""
+    await release_slot(callback.from_user.id)
     await state.set_state(BookingStates.choosing_date)
     data = await state.get_data()
 
@@ -1362,48 +1695,103 @@ async def back_to_confirmation(callback: CallbackQuery, state: FSMContext):
 
 # ==================== СИСТЕМА НАПОМИНАНИЙ ====================
 
-async def check_reminders():
-    """Проверяет и отправляет напоминания"""
-    session = Session()
-    try:
-        now = datetime.now()
-        reminders = session.query(Reminder).filter(
-            Reminder.scheduled_for <= now,
-            Reminder.sent_at.is_(None)
-        ).all()
+async def send_due_reminders(reminder_ids: List[int]):
+    """Отправляет пачку наступивших напоминаний.
 
-        for reminder in reminders:
-            await send_reminder(reminder)
+    Напоминания загружаются одним запросом вместе с записями и клиентами,
+    отправляются параллельно (не более REMINDER_SEND_CONCURRENCY одновременно)
+    и отмечаются одним UPDATE на каждый итоговый статус."""
+    started = asyncio.get_running_loop().time()
+    batch = await run_db(db.get_reminder_batch, reminder_ids)
 
-    except Exception as e:
-        logger.error(f"Ошибка проверки напоминаний: {e}")
-    finally:
-        session.close()
+    # Напоминания неподтвержденных и уже начавшихся визитов не отправляются
+    now = datetime.now()
+    to_send = [(r, a, u) for r, a, u in batch if a.status == 'confirmed' and a.starts_at > now]
+    skipped_ids = [r.id for r, a, u in batch if a.status != 'confirmed' or a.starts_at <= now]
 
-# ==================== ЗАПУСК БОТА ====================
+    semaphore = asyncio.Semaphore(config.REMINDER_SEND_CONCURRENCY)
 
-async def scheduled_tasks():
-    """Планировщик задач"""
-    while True:
-        try:
-            await check_reminders()
-        except Exception as e:
-            logger.error(f"Ошибка в планировщике: {e}")
+    async def send_limited(reminder, appointment, user):
+        async with semaphore:
+            return await send_reminder(reminder, appointment, user)
 
-        await asyncio.sleep(60)  # Проверяем каждую минуту
+    with outbound.priority(Priority.REMINDER):
+        results = await asyncio.gather(*(send_limited(*row) for row in to_send))
+    outcomes = {"sent": [], "failed": [], "retry": []}
+    for (reminder, _, _), result in zip(to_send, results):
+        outcomes[result].append(reminder.id)
 
-async def main():
-    """Основная функция запуска бота"""
+    await run_db(db.finish_reminders, outcomes["sent"], skipped_ids, outcomes["failed"], outcomes["retry"])
+
+    elapsed = asyncio.get_running_loop().time() - started
+    logger.info(
+        f"Напоминания: пачка {len(reminder_ids)}, отправлено {len(outcomes['sent'])}, "
+        f"пропущено {len(skipped_ids)}, не доставлено {len(outcomes['failed'])}, "
+        f"повтор {len(outcomes['retry'])} за {elapsed:.2f} с"
+    )
+
+async def load_pending_reminders(until: datetime):
+    """Неотправленные напоминания для очереди планировщика"""
+    return await run_db(db.get_pending_reminders, until)
+
+reminder_scheduler = ReminderScheduler(
+    dispatch=send_due_reminders,
+    load_pending=load_pending_reminders,
+    resync_interval=config.REMINDER_RESYNC_SECONDS
+)
+
+# ==================== ЗАПУСК БОТА ====================
+
+async def prepare():
+    """Инициализация БД и кэшей процесса"""
     # Инициализируем БД
     init_db()
+    # Прогреваем индекс занятого времени
+    today_start, _ = db.day_range(datetime.now().date())
+    slot_index.warm(await run_db(db.get_active_intervals, today_start))
+    # Загружаем каталог галереи
+    await reload_gallery()
+    # Строим постоянные клавиатуры
+    kb.warm_up()
+
+@dp.shutdown()
+async def on_shutdown():
+    """Останавливает пул обработки фото"""
+    image_pipeline.shutdown()
+
+async def start_background_jobs():
+    """Фоновые задачи, которые должны работать ровно в одном процессе"""
+    # Запускаем планировщик напоминаний в фоне
+    scheduler_task = asyncio.create_task(reminder_scheduler.run())
+
+    # Продолжаем прерванные рассылки
+    await broadcasts.resume_unfinished()
+    return scheduler_task
 
-    logger.info("🤖 Бот запускается...")
+async def main():
+    """Основная функция запуска бота"""
+    await prepare()
 
-    # Запускаем планировщик задач в фоне
-    asyncio.create_task(scheduled_tasks())
+    logger.info("🤖 Бот запускается...")
 
-    # Запускаем polling
-    await dp.start_polling(bot)
+    await start_background_jobs()
+
+    if config.RUN_MODE == "webhook":
+        if not config.WEBHOOK_URL or not config.WEBHOOK_SECRET:
+            raise RuntimeError("Для режима webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+        await run_webhook(
+            dp, bot,
+            base_url=config.WEBHOOK_URL,
+            path=config.WEBHOOK_PATH,
+            secret=config.WEBHOOK_SECRET,
+            host=config.WEBAPP_HOST,
+            port=config.WEBAPP_PORT,
+            max_concurrent=config.WEBHOOK_MAX_CONCURRENT
+        )
+    else:
+        # Polling не работает, пока зарегистрирован webhook
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+
+import config
+import database as db
+from database import run_db
+from outbound import Priority
+import outbound
+
+logger = logging.getLogger(__name__)
+
+# Не чаще одного обновления сообщения с прогрессом за столько секунд
+PROGRESS_INTERVAL = 3
+# Аренда рассылки в режиме нескольких процессов продлевается перед каждой пачкой
+LEASE_SECONDS = 120
+
+class BroadcastEngine:
+    """Фоновые рассылки всем пользователям.
+
+    Получатели читаются пачками по users.id, сообщения пачки ставятся в общую
+    очередь отправки (outbound) с низшим приоритетом BROADCAST: темп, лимиты
+    Telegram и повторы при flood control обеспечивает OutboundLimiter, а
+    ответы пользователям и уведомления обгоняют рассылку.
+    После каждой пачки курсор и счетчики сохраняются в AdminMessage, поэтому
+    после перезапуска рассылка продолжается с места остановки (повторно может
+    уйти не больше одной пачки). Прогресс показывается админу в сообщении,
+    которое редактируется по ходу рассылки.
+    Если задан holder (несколько процессов), рассылку ведет тот процесс,
+    который держит ее аренду, - возобновление не запустит ее дважды.
+    """
+
+    def __init__(self, bot: Bot, holder: str = None):
+        self.bot = bot
+        self.holder = holder
+        self._tasks = {}
+
+    def start(self, broadcast_id: int):
+        """Запускает рассылку в фоне"""
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def resume_unfinished(self):
+        """Продолжает рассылки, прерванные перезапуском"""
+        for broadcast in await run_db(db.get_running_broadcasts):
+            logger.info(f"Продолжаем рассылку #{broadcast.id} с пользователя {broadcast.last_user_id}")
+            self.start(broadcast.id)
+
+    async def _run(self, broadcast_id: int):
+        with outbound.priority(Priority.BROADCAST):
+            await self._send_all(broadcast_id)
+
+    async def _send_all(self, broadcast_id: int):
+        try:
+            broadcast = await run_db(db.get_broadcast, broadcast_id)
+            text = f"📢 Сообщение от салона:\n\n{broadcast.message_text}"
+            cursor = broadcast.last_user_id or 0
+            loop = asyncio.get_running_loop()
+            last_progress = 0.0
+
+            while True:
+                if not await self._lease(broadcast_id):
+                    logger.info(f"Рассылку #{broadcast_id} ведет другой процесс")
+                    return
+                recipients = await run_db(db.get_broadcast_recipients, cursor, config.BROADCAST_CHUNK_SIZE)
+                if not recipients:
+                    break
+
+                results = await asyncio.gather(*[
+                    self._send(telegram_id, text) for _, telegram_id in recipients
+                ])
+                cursor = recipients[-1][0]
+                sent = sum(results)
+                await run_db(db.save_broadcast_progress, broadcast_id, cursor, sent, len(results) - sent)
+
+                if loop.time() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = loop.time()
+                    await self._show_progress(await run_db(db.get_broadcast, broadcast_id))
+
+            broadcast = await run_db(db.finish_broadcast, broadcast_id)
+            await self._show_progress(broadcast)
+            logger.info(f"Рассылка #{broadcast_id} завершена: {broadcast.sent_count} из {broadcast.total_count}")
+            if self.holder:
+                await run_db(db.release_lease, f"broadcast:{broadcast_id}", self.holder)
+
+        except Exception as e:
+            logger.error(f"Ошибка рассылки #{broadcast_id}: {e}")
+            broadcast = await run_db(db.finish_broadcast, broadcast_id, "failed")
+            await self._show_progress(broadcast)
+
+    async def _lease(self, broadcast_id: int) -> bool:
+        if not self.holder:
+            return True
+        return await run_db(db.acquire_lease, f"broadcast:{broadcast_id}", self.holder, LEASE_SECONDS)
+
+    async def _send(self, chat_id: int, text: str) -> bool:
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text)
+            return True
+        except (TelegramForbiddenError, TelegramBadRequest):
+            # Пользователь заблокировал бота или чат недоступен
+            return False
+        except Exception as e:
+            logger.error(f"Ошибка отправки рассылки пользователю {chat_id}: {e}")
+            return False
+
+    async def _show_progress(self, broadcast):
+        if not broadcast or not broadcast.progress_message_id:
+            return
+
+        if broadcast.status == "running":
+            header = f"📢 Рассылка #{broadcast.id} идет..."
+        elif broadcast.status == "done":
+            header = f"✅ Рассылка #{broadcast.id} завершена"
+        else:
+            header = f"❌ Рассылка #{broadcast.id} прервана из-за ошибки"
+
+        try:
+            await self.bot.edit_message_text(
+                f"{header}\n\n"
+                f"📨 Отправлено: {broadcast.sent_count} из {broadcast.total_count}\n"
+                f"🚫 Не доставлено: {broadcast.failed_count}",
+                chat_id=broadcast.progress_chat_id,
+                message_id=broadcast.progress_message_id
+            )
+        except TelegramBadRequest:
+            # Текст не изменился или сообщение удалено
+            pass
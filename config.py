@@ -6,6 +6,21 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = [int(id.strip()) for id in os.getenv("ADMIN_IDS", "").split(",") if id.strip()]
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///manicure.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))  # Потоков для запросов к БД
+
+# Режим работы: polling (для разработки) или webhook
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_MAX_CONCURRENT = int(os.getenv("WEBHOOK_MAX_CONCURRENT", "100"))  # Обновлений в обработке одновременно
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Свой сервер Bot API (локальный или заглушка для замеров)
+
+# Несколько процессов-обработчиков (python workers.py)
+WORKERS = int(os.getenv("WORKERS", "1"))
+LEADER_LEASE_SECONDS = 30  # Аренда роли лидера (напоминания, возобновление рассылок)
 
 # Услуги и цены
 SERVICES = {
@@ -19,6 +34,9 @@ TIME_SLOTS = [
     "10:00", "11:00", "12:00", "13:00", "14:00", "15:00",
     "16:00", "17:00", "18:00", "19:00", "20:00"
 ]
+CLOSING_TIME = "21:00"  # Услуга должна закончиться до закрытия
+SLOT_STEP_MINUTES = 60  # Шаг сетки бронирования (ячейки appointment_slots)
+SLOT_HOLD_MINUTES = 10  # Сколько держим выбранное время до подтверждения
 
 # Контакты салона
 SALON_INFO = {
@@ -47,3 +65,41 @@ REMINDERS = {
     "3_hours": True,
     "after_visit": True,
 }
+REMINDER_RESYNC_SECONDS = 300  # Как часто очередь напоминаний сверяется с БД
+REMINDER_WORKERS_RESYNC_SECONDS = 30  # То же при WORKERS > 1: напоминания других процессов лидер видит только при сверке
+REMINDER_SEND_CONCURRENCY = 20  # Одновременных отправок в пачке напоминаний
+REMINDER_MAX_ATTEMPTS = 3  # Попыток отправки при временных ошибках (повтор - при сверке с БД)
+
+# Хранилище состояний диалогов (FSM)
+FSM_FLUSH_INTERVAL = 1.0  # Секунд между сбросами изменений в БД
+FSM_TTL_HOURS = 24        # Через сколько часов бездействия незавершенный диалог забывается
+
+# Кэш пользователей в памяти процесса
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60       # Секунд; столько видны устаревшие данные, измененные другим процессом
+
+# Кэш клавиатур с параметрами (id записи, набор свободных слотов)
+KEYBOARD_CACHE_SIZE = 1024
+
+# Исходящие сообщения (лимиты Telegram)
+OUTBOUND_RATE = int(os.getenv("OUTBOUND_RATE", "30"))  # Сообщений в секунду на всего бота
+OUTBOUND_CHAT_INTERVAL = 1.0  # Секунд между сообщениями в один чат
+OUTBOUND_CHAT_BURST = 3       # Сколько сообщений в чат можно отправить подряд без паузы
+OUTBOUND_MAX_RETRIES = 3      # Повторов при flood control
+
+# Галерея работ
+GALLERY_PAGE_SIZE = 6  # Фото в одном альбоме
+GALLERY_REPORT_DELAY = 3  # Секунд тишины после последнего фото до итогового отчета загрузки
+GALLERY_DOCUMENT_TYPES = ("image/jpeg", "image/png", "image/webp")  # Фото, присланные файлом (без сжатия)
+
+# Отзывы
+REVIEWS_PAGE_SIZE = 5  # Отзывов на странице ленты
+
+# Обработка фото (Pillow в пуле процессов)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# Панель администратора
+ADMIN_PAGE_SIZE = 5  # Заявок на странице очереди
+
+# Рассылки
+BROADCAST_CHUNK_SIZE = 100  # Получателей в пачке; прогресс сохраняется после каждой
@@ -1,13 +1,39 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text, ForeignKey, Float, JSON
+from sqlalchemy import case, create_engine, event, func, inspect, or_, select, text, tuple_, Column, Integer, String, Date, DateTime, Boolean, Text, ForeignKey, Float, JSON, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime, date
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+import asyncio
+import functools
 import config
 import json
+from referral import encode_referral_code, decode_referral_code
+from discounts import LEDGER_TYPES, parse_birthday
+import logging
+
+logger = logging.getLogger(__name__)
 
 engine = create_engine(config.DATABASE_URL)
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
+# expire_on_commit=False: объекты остаются читаемыми после закрытия сессии,
+# т.к. в обработчики они возвращаются уже из потока БД
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+# Пул потоков для работы с БД, чтобы запросы не блокировали event loop
+_db_executor = ThreadPoolExecutor(max_workers=config.DB_POOL_SIZE, thread_name_prefix="db")
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragma(dbapi_connection, connection_record):
+        """WAL позволяет читать параллельно с записью, busy_timeout - ждать блокировку вместо ошибки"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
 
 class User(Base):
     __tablename__ = 'users'
@@ -18,6 +44,8 @@ class User(Base):
     last_name = Column(String(100))
     phone = Column(String(20))
     birthday = Column(String(10), nullable=True)  # ДД.ММ.ГГГГ
+    birth_month = Column(Integer, nullable=True)  # Разобранный birthday для правил скидок
+    birth_day = Column(Integer, nullable=True)
     visits_count = Column(Integer, default=0)
     total_spent = Column(Integer, default=0)
     discount_percent = Column(Integer, default=0)
@@ -41,8 +69,8 @@ class Appointment(Base):
     original_price = Column(Integer)
     final_price = Column(Integer)
     discount_applied = Column(Integer, default=0)
-    date = Column(String(20))
-    time = Column(String(10))
+    starts_at = Column(DateTime, nullable=False)
+    ends_at = Column(DateTime, nullable=False)  # starts_at + длительность услуги
     status = Column(String(20), default="pending", index=True)  # pending, confirmed, completed, cancelled, noshow
     created_at = Column(DateTime, default=datetime.now)
     confirmed_at = Column(DateTime, nullable=True)
@@ -51,10 +79,45 @@ class Appointment(Base):
     admin_comment = Column(Text, nullable=True)
     reminder_sent_24h = Column(Boolean, default=False)
     reminder_sent_3h = Column(Boolean, default=False)
+    # Строка user_discounts, погашенная этой записью; возвращается при отмене
+    discount_ledger_id = Column(Integer, ForeignKey('user_discounts.id'), nullable=True)
 
     # Отношения
     user = relationship("User", back_populates="appointments")
 
+    __table_args__ = (
+        # Выборки по дню/периоду с фильтром по статусу - range scan по индексу
+        Index('ix_appointments_starts_at_status', 'starts_at', 'status'),
+        # Очередь заявок: страницы по ключу (created_at, id) внутри статуса
+        Index('ix_appointments_status_created_id', 'status', 'created_at', 'id'),
+    )
+
+    @property
+    def date_str(self):
+        """Дата записи в формате ДД.ММ.ГГГГ"""
+        return self.starts_at.strftime("%d.%m.%Y")
+
+    @property
+    def time_str(self):
+        """Время записи в формате ЧЧ:ММ"""
+        return self.starts_at.strftime("%H:%M")
+
+class AppointmentSlot(Base):
+    """Ячейка сетки, занятая активной записью.
+
+    Уникальность slot_at гарантирует на уровне БД, что две активные записи
+    не пересекаются по времени."""
+    __tablename__ = 'appointment_slots'
+    id = Column(Integer, primary_key=True)
+    appointment_id = Column(Integer, ForeignKey('appointments.id'), nullable=False, index=True)
+    slot_at = Column(DateTime, nullable=False, unique=True)
+
+class SlotTakenError(Exception):
+    """Время уже занято другой записью"""
+
+class StatusConflictError(Exception):
+    """Запись уже в статусе, из которого нужный переход невозможен"""
+
 class Review(Base):
     __tablename__ = 'reviews'
     id = Column(Integer, primary_key=True)
@@ -62,17 +125,25 @@ class Review(Base):
     rating = Column(Integer)  # 1-5
     text = Column(Text)
     photo_path = Column(String(500), nullable=True)
+    photo_file_id = Column(String(200), nullable=True)  # file_id Telegram: повторная отправка без загрузки
     created_at = Column(DateTime, default=datetime.now)
     is_approved = Column(Boolean, default=True)
 
     # Отношения
     user = relationship("User", back_populates="reviews")
 
+    __table_args__ = (
+        # Лента одобренных отзывов по ключу (created_at, id)
+        Index('ix_reviews_approved_created_id', 'is_approved', 'created_at', 'id'),
+    )
+
 class ServiceImage(Base):
     __tablename__ = 'service_images'
     id = Column(Integer, primary_key=True)
-    service_type = Column(String(50))
+    service_type = Column(String(50), index=True)
     image_path = Column(String(500))
+    file_id = Column(String(200), nullable=True)  # file_id Telegram: повторная отправка без загрузки
+    content_hash = Column(String(64), nullable=True, unique=True, index=True)  # SHA-256 файла
     uploaded_at = Column(DateTime, default=datetime.now)
 
 class UserDiscount(Base):
@@ -92,15 +163,22 @@ class Reminder(Base):
     __tablename__ = 'reminders'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), index=True)
-    appointment_id = Column(Integer, ForeignKey('appointments.id'), nullable=True)
+    appointment_id = Column(Integer, ForeignKey('appointments.id'), nullable=True, index=True)
     reminder_type = Column(String(50))  # 24h_before, 3h_before, after_visit, birthday
     scheduled_for = Column(DateTime)
+    status = Column(String(20), default="scheduled", nullable=False)  # scheduled, sent, skipped, cancelled, failed
+    attempts = Column(Integer, default=0, nullable=False)  # Неудачных попыток отправки
     sent_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.now)
 
     # Отношения
     user = relationship("User", back_populates="reminders")
 
+    __table_args__ = (
+        # Частичный индекс: в нем только ожидающие отправки напоминания
+        Index('ix_reminders_due', 'scheduled_for', sqlite_where=text("status = 'scheduled'")),
+    )
+
 class AdminMessage(Base):
     __tablename__ = 'admin_messages'
     id = Column(Integer, primary_key=True)
@@ -113,6 +191,994 @@ class AdminMessage(Base):
     created_at = Column(DateTime, default=datetime.now)
     sent_at = Column(DateTime, nullable=True)
 
+    # Прогресс фоновой рассылки
+    status = Column(String(20), default="done")  # running, done, failed
+    total_count = Column(Integer, default=0)
+    failed_count = Column(Integer, default=0)
+    last_user_id = Column(Integer, default=0)  # Курсор: рассылка дошла до users.id включительно
+    progress_chat_id = Column(Integer, nullable=True)
+    progress_message_id = Column(Integer, nullable=True)
+
+class FSMRecord(Base):
+    """Состояние диалога (FSM) пользователя"""
+    __tablename__ = 'fsm_records'
+    key = Column(String(100), primary_key=True)  # bot:chat:user:thread:destiny
+    state = Column(String(100), nullable=True)
+    data = Column(JSON, nullable=True)
+    updated_at = Column(DateTime, default=datetime.now, index=True)
+
+class Lease(Base):
+    """Аренда роли (например, лидера, отправляющего напоминания) между процессами"""
+    __tablename__ = 'leases'
+    name = Column(String(50), primary_key=True)
+    holder = Column(String(100), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class StatCounter(Base):
+    """Счетчик для панели администратора, обновляется в одной транзакции с данными.
+
+    Ключи: users, appointments, status:<статус>, day:<ГГГГ-ММ-ДД>:<статус>."""
+    __tablename__ = 'stat_counters'
+    key = Column(String(50), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+class DailyServiceRollup(Base):
+    """Итоги дня по услуге для аналитики; день - дата начала записи.
+
+    Записи учитываются при создании и при каждой смене статуса: bookings -
+    все созданные, выручка и скидки - по подтвержденным, booked_minutes -
+    занятое время активных (pending и confirmed) записей и неявок: время
+    было закрыто для других клиентов."""
+    __tablename__ = 'daily_service_rollups'
+    day = Column(Date, primary_key=True)
+    service = Column(String(50), primary_key=True)
+    bookings = Column(Integer, nullable=False, default=0)
+    confirmed = Column(Integer, nullable=False, default=0)
+    cancelled = Column(Integer, nullable=False, default=0)
+    noshows = Column(Integer, nullable=False, default=0)
+    revenue = Column(Integer, nullable=False, default=0)
+    discount_given = Column(Integer, nullable=False, default=0)
+    booked_minutes = Column(Integer, nullable=False, default=0)
+
+def service_ends_at(service: str, starts_at: datetime) -> datetime:
+    """Время окончания услуги по её длительности"""
+    duration = config.SERVICES.get(service, {}).get('duration', 60)
+    return starts_at + timedelta(minutes=duration)
+
+def slot_cells(starts_at: datetime, ends_at: datetime):
+    """Ячейки сетки бронирования, которые покрывает интервал [starts_at, ends_at)"""
+    step = timedelta(minutes=config.SLOT_STEP_MINUTES)
+    cell = starts_at.replace(second=0, microsecond=0)
+    cell -= timedelta(minutes=cell.minute % config.SLOT_STEP_MINUTES)
+    cells = []
+    while cell < ends_at:
+        cells.append(cell)
+        cell += step
+    return cells
+
+def day_range(day: date):
+    """Полуинтервал [начало дня, начало следующего дня) для индексных выборок"""
+    start = datetime.combine(day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
 def init_db():
     Base.metadata.create_all(engine)
+    migrate_db()
+    with Session() as session:
+        if not session.query(StatCounter).first() or (
+                session.get(StatCounter, 'reviews:count') is None and session.query(Review.id).first()):
+            # Счетчики (или счетчики отзывов) появились в уже работающей БД
+            rebuild_stats(session)
+        if not session.query(DailyServiceRollup).first():
+            rebuild_rollups(session)
     print("✅ База данных инициализирована")
+
+# ==================== МИГРАЦИИ ====================
+
+def _columns(connection, table: str):
+    return {column['name'] for column in inspect(connection).get_columns(table)}
+
+def _add_columns(connection, table: str, columns: dict):
+    """Добавляет недостающие колонки {name: DDL}"""
+    existing = _columns(connection, table)
+    for name, ddl in columns.items():
+        if name not in existing:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+def _migrate_appointment_datetimes(connection):
+    """Строковые date/time ("ДД.ММ.ГГГГ"/"ЧЧ:ММ") -> starts_at/ends_at"""
+    columns = _columns(connection, 'appointments')
+    if 'starts_at' in columns:
+        return
+
+    connection.execute(text("ALTER TABLE appointments ADD COLUMN starts_at DATETIME"))
+    connection.execute(text("ALTER TABLE appointments ADD COLUMN ends_at DATETIME"))
+
+    table = Appointment.__table__
+    rows = connection.execute(text("SELECT id, service, date, time, created_at FROM appointments")).all()
+    for row in rows:
+        try:
+            starts_at = datetime.strptime(f"{row.date} {row.time}", "%d.%m.%Y %H:%M")
+        except (TypeError, ValueError):
+            logger.warning(f"Запись #{row.id}: не удалось разобрать дату '{row.date} {row.time}'")
+            starts_at = row.created_at if isinstance(row.created_at, datetime) else datetime.now()
+        connection.execute(
+            table.update().where(table.c.id == row.id).values(
+                starts_at=starts_at,
+                ends_at=service_ends_at(row.service, starts_at)
+            )
+        )
+
+    # DROP COLUMN поддерживается SQLite начиная с 3.35
+    for legacy_column in ('date', 'time'):
+        connection.execute(text(f"ALTER TABLE appointments DROP COLUMN {legacy_column}"))
+
+    logger.info(f"Миграция appointments: перенесено {len(rows)} записей на starts_at/ends_at")
+
+def _backfill_appointment_slots(connection):
+    """Занимает ячейки сетки для активных записей, созданных до появления appointment_slots"""
+    if connection.execute(text("SELECT 1 FROM appointment_slots LIMIT 1")).first():
+        return
+
+    table = Appointment.__table__
+    rows = connection.execute(
+        table.select().with_only_columns(table.c.id, table.c.starts_at, table.c.ends_at)
+        .where(table.c.status.in_(["pending", "confirmed"]), table.c.starts_at >= datetime.now())
+    ).all()
+    for row in rows:
+        cells = [{'appointment_id': row.id, 'slot_at': cell} for cell in slot_cells(row.starts_at, row.ends_at)]
+        # Уже существующие пересечения не ломают миграцию: вторая запись просто не получит ячейку
+        connection.execute(sqlite_insert(AppointmentSlot.__table__).on_conflict_do_nothing(), cells)
+
+def _migrate_reminder_status(connection):
+    """Статус напоминаний вместо признака sent_at IS NULL"""
+    if 'status' in _columns(connection, 'reminders'):
+        return
+
+    connection.execute(text("ALTER TABLE reminders ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'scheduled'"))
+    connection.execute(text("UPDATE reminders SET status = 'sent' WHERE sent_at IS NOT NULL"))
+    # Напоминания отмененных и неподтвержденных прошедших записей больше не нужны
+    connection.execute(text("""
+        UPDATE reminders SET status = 'cancelled'
+        WHERE status = 'scheduled' AND appointment_id IN (
+            SELECT id FROM appointments WHERE status NOT IN ('pending', 'confirmed')
+        )
+    """))
+
+def _backfill_birthdays(connection):
+    """Разбирает строки birthday (ДД.ММ.ГГГГ) в birth_month/birth_day"""
+    rows = connection.execute(text(
+        "SELECT id, birthday FROM users WHERE birthday IS NOT NULL AND birth_month IS NULL"
+    )).all()
+    params = []
+    for user_id, birthday in rows:
+        parsed = parse_birthday(birthday)
+        if parsed:
+            params.append({'id': user_id, 'month': parsed[0], 'day': parsed[1]})
+    if params:
+        connection.execute(text("UPDATE users SET birth_month = :month, birth_day = :day WHERE id = :id"), params)
+
+def migrate_db():
+    """Приводит существующую БД к текущей схеме"""
+    with engine.begin() as connection:
+        _migrate_appointment_datetimes(connection)
+        _backfill_appointment_slots(connection)
+        _migrate_reminder_status(connection)
+        _add_columns(connection, 'admin_messages', {
+            'status': "VARCHAR(20) DEFAULT 'done'",
+            'total_count': "INTEGER DEFAULT 0",
+            'failed_count': "INTEGER DEFAULT 0",
+            'last_user_id': "INTEGER DEFAULT 0",
+            'progress_chat_id': "INTEGER",
+            'progress_message_id': "INTEGER",
+        })
+        _add_columns(connection, 'reviews', {'photo_file_id': "VARCHAR(200)"})
+        _add_columns(connection, 'users', {'birth_month': "INTEGER", 'birth_day': "INTEGER"})
+        _add_columns(connection, 'appointments', {'discount_ledger_id': "INTEGER"})
+        _add_columns(connection, 'reminders', {'attempts': "INTEGER NOT NULL DEFAULT 0"})
+        _backfill_birthdays(connection)
+        _add_columns(connection, 'service_images', {'file_id': "VARCHAR(200)", 'content_hash': "VARCHAR(64)"})
+        _add_columns(connection, 'daily_service_rollups', {'noshows': "INTEGER NOT NULL DEFAULT 0"})
+        for table in (Appointment.__table__, Reminder.__table__, Review.__table__, ServiceImage.__table__):
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+# ==================== АСИНХРОННЫЙ ДОСТУП К БД ====================
+
+def _call_in_session(func, args, kwargs):
+    session = Session()
+    try:
+        return func(session, *args, **kwargs)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет func(session, *args, **kwargs) в потоке БД и возвращает результат"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _db_executor, functools.partial(_call_in_session, func, args, kwargs)
+    )
+
+# ==================== ЗАПРОСЫ ====================
+
+# ---------- Счетчики ----------
+
+STAT_BUMP = text("""
+    INSERT INTO stat_counters (key, value) VALUES (:key, :delta)
+    ON CONFLICT (key) DO UPDATE SET value = stat_counters.value + excluded.value
+""")
+
+def _appointment_stat_keys(appointment, status: str):
+    return [f"status:{status}", f"day:{appointment.starts_at:%Y-%m-%d}:{status}"]
+
+def _review_stat_deltas(rating: int, sign: int = 1):
+    """Изменения счетчиков рейтинга при появлении (sign=1) или снятии (sign=-1) одобренного отзыва"""
+    return {'reviews:count': sign, 'reviews:rating_sum': sign * rating, f"reviews:stars:{rating}": sign}
+
+def bump_stats(session, deltas: dict):
+    """Прибавляет {ключ: изменение} к счетчикам в текущей транзакции"""
+    params = [{'key': key, 'delta': delta} for key, delta in deltas.items() if delta]
+    if params:
+        session.execute(STAT_BUMP, params)
+
+ROLLUP_BUMP = text("""
+    INSERT INTO daily_service_rollups
+        (day, service, bookings, confirmed, cancelled, noshows, revenue, discount_given, booked_minutes)
+    VALUES (:day, :service, :bookings, :confirmed, :cancelled, :noshows, :revenue, :discount_given, :booked_minutes)
+    ON CONFLICT (day, service) DO UPDATE SET
+        bookings = daily_service_rollups.bookings + excluded.bookings,
+        confirmed = daily_service_rollups.confirmed + excluded.confirmed,
+        cancelled = daily_service_rollups.cancelled + excluded.cancelled,
+        noshows = daily_service_rollups.noshows + excluded.noshows,
+        revenue = daily_service_rollups.revenue + excluded.revenue,
+        discount_given = daily_service_rollups.discount_given + excluded.discount_given,
+        booked_minutes = daily_service_rollups.booked_minutes + excluded.booked_minutes
+""")
+
+ROLLUP_FIELDS = ('bookings', 'confirmed', 'cancelled', 'noshows', 'revenue', 'discount_given', 'booked_minutes')
+
+def _rollup_contribution(appointment, status: str):
+    """Вклад записи с данным статусом в итоги её дня"""
+    confirmed = status == "confirmed"
+    booked = status in ("pending", "confirmed", "noshow")
+    return {
+        'bookings': 1,
+        'confirmed': int(confirmed),
+        'cancelled': int(status == "cancelled"),
+        'noshows': int(status == "noshow"),
+        'revenue': appointment.final_price if confirmed else 0,
+        'discount_given': appointment.original_price - appointment.final_price if confirmed else 0,
+        'booked_minutes': int((appointment.ends_at - appointment.starts_at).total_seconds() // 60) if booked else 0,
+    }
+
+def _bump_rollup(session, appointment, old_status: str = None, new_status: str = None):
+    new = _rollup_contribution(appointment, new_status) if new_status else dict.fromkeys(ROLLUP_FIELDS, 0)
+    old = _rollup_contribution(appointment, old_status) if old_status else dict.fromkeys(ROLLUP_FIELDS, 0)
+    params = {field: new[field] - old[field] for field in ROLLUP_FIELDS}
+    if any(params.values()):
+        session.execute(ROLLUP_BUMP, {'day': appointment.starts_at.date().isoformat(), 'service': appointment.service, **params})
+
+# Допустимые переходы статусов записи
+STATUS_TRANSITIONS = {
+    'pending': {'confirmed', 'cancelled'},
+    'confirmed': {'cancelled', 'noshow'},
+}
+
+def set_appointment_status(session, appointment, status: str):
+    """Меняет статус записи вместе со счетчиками и итогами дня (без commit).
+
+    Статус меняется условным UPDATE ... WHERE status = <прежний>: если переход
+    недопустим или запись успели изменить параллельно, поднимается StatusConflictError."""
+    if status not in STATUS_TRANSITIONS.get(appointment.status, ()):
+        raise StatusConflictError(f"#{appointment.id}: {appointment.status} -> {status}")
+    updated = session.query(Appointment)\
+        .filter(Appointment.id == appointment.id, Appointment.status == appointment.status)\
+        .update({'status': status}, synchronize_session=False)
+    if not updated:
+        raise StatusConflictError(f"#{appointment.id}: статус изменен параллельно")
+    deltas = Counter()
+    for key in _appointment_stat_keys(appointment, appointment.status):
+        deltas[key] -= 1
+    for key in _appointment_stat_keys(appointment, status):
+        deltas[key] += 1
+    _bump_rollup(session, appointment, appointment.status, status)
+    appointment.status = status
+    bump_stats(session, deltas)
+
+def get_stats(session, keys):
+    """Значения счетчиков по первичному ключу: {ключ: значение}"""
+    values = dict(session.query(StatCounter.key, StatCounter.value).filter(StatCounter.key.in_(keys)))
+    return {key: values.get(key, 0) for key in keys}
+
+def rebuild_stats(session):
+    """Пересчитывает счетчики по таблицам. Возвращает расхождения {ключ: (было, стало)}"""
+    counts = Counter()
+    counts['users'] = session.query(func.count(User.id)).scalar()
+    counts['appointments'] = session.query(func.count(Appointment.id)).scalar()
+    for status, count in session.query(Appointment.status, func.count()).group_by(Appointment.status):
+        counts[f"status:{status}"] = count
+    day = func.date(Appointment.starts_at)
+    for day_str, status, count in session.query(day, Appointment.status, func.count())\
+            .group_by(day, Appointment.status):
+        counts[f"day:{day_str}:{status}"] = count
+    for rating, count in session.query(Review.rating, func.count())\
+            .filter(Review.is_approved.is_(True)).group_by(Review.rating):
+        for key, delta in _review_stat_deltas(rating).items():
+            counts[key] += delta * count
+
+    previous = dict(session.query(StatCounter.key, StatCounter.value))
+    session.query(StatCounter).delete()
+    session.add_all([StatCounter(key=key, value=value) for key, value in counts.items() if value])
+    session.commit()
+    return {
+        key: (previous.get(key, 0), counts.get(key, 0))
+        for key in previous.keys() | counts.keys()
+        if previous.get(key, 0) != counts.get(key, 0)
+    }
+
+def rebuild_rollups(session):
+    """Пересчитывает итоги по дням одним INSERT ... SELECT по appointments"""
+    session.query(DailyServiceRollup).delete()
+    session.execute(text("""
+        INSERT INTO daily_service_rollups
+            (day, service, bookings, confirmed, cancelled, noshows, revenue, discount_given, booked_minutes)
+        SELECT date(starts_at), service,
+               count(*),
+               sum(status = 'confirmed'),
+               sum(status = 'cancelled'),
+               sum(status = 'noshow'),
+               coalesce(sum(CASE WHEN status = 'confirmed' THEN final_price END), 0),
+               coalesce(sum(CASE WHEN status = 'confirmed' THEN original_price - final_price END), 0),
+               coalesce(sum(CASE WHEN status IN ('pending', 'confirmed', 'noshow')
+                            THEN CAST(round((julianday(ends_at) - julianday(starts_at)) * 1440) AS INTEGER) END), 0)
+        FROM appointments
+        GROUP BY date(starts_at), service
+    """))
+    session.commit()
+
+def get_service_report(session, since: date, until: date):
+    """Итоги по услугам за дни [since, until]: агрегация по daily_service_rollups"""
+    return session.query(
+        DailyServiceRollup.service,
+        *[func.sum(getattr(DailyServiceRollup, field)).label(field) for field in ROLLUP_FIELDS]
+    ).filter(
+        DailyServiceRollup.day >= since,
+        DailyServiceRollup.day <= until
+    ).group_by(DailyServiceRollup.service).all()
+
+# ---------- Пользователи ----------
+
+def get_user(session, telegram_id: int):
+    """Пользователь по telegram_id"""
+    return session.query(User).filter_by(telegram_id=telegram_id).first()
+
+# Диалект SQLite в SQLAlchemy не кэширует компиляцию INSERT ... ON CONFLICT,
+# поэтому частый upsert пользователя написан готовым SQL
+# Колонки в RETURNING перечислены явно: в старых БД добавленные миграцией колонки стоят в конце
+USER_UPSERT = select(User).from_statement(text(f"""
+    INSERT INTO users (telegram_id, username, first_name, last_name, phone,
+                       visits_count, total_spent, discount_percent, created_at)
+    VALUES (:telegram_id, :username, :first_name, :last_name, :phone,
+            0, 0, 0, :created_at)
+    ON CONFLICT (telegram_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        phone = coalesce(excluded.phone, users.phone)
+    RETURNING {', '.join(column.name for column in User.__table__.columns)}
+""").columns(*User.__table__.columns))
+DISCOUNT_INSERT = UserDiscount.__table__.insert()
+
+def find_referrer(session, code: str):
+    """Владелец реферального кода"""
+    user_id = decode_referral_code(code)
+    if user_id is not None:
+        # Код получается из id - ищем по первичному ключу
+        user = session.get(User, user_id)
+        if user and user.referral_code == encode_referral_code(user_id):
+            return user
+    # Коды, выданные до перехода на коды из id
+    return session.query(User).filter_by(referral_code=code.strip().upper()).first()
+
+def save_user(session, telegram_id: int, username: str, first_name: str, last_name: str,
+              phone: str = None, referrer_code: str = None):
+    """Создает пользователя со скидкой на первую запись или обновляет контакты существующего.
+
+    Одна транзакция: INSERT ... ON CONFLICT по telegram_id с RETURNING и, для
+    нового пользователя, реферальный код, строки скидок и, если он пришел
+    по коду referrer_code, привязка к пригласившему. Возвращает
+    (user, created, referred): referred - привязка сделана этим вызовом."""
+    now = datetime.now()
+    user = session.scalars(USER_UPSERT, {
+        'telegram_id': telegram_id,
+        'username': username,
+        'first_name': first_name,
+        'last_name': last_name,
+        'phone': phone,
+        'created_at': now,
+    }, execution_options={'populate_existing': True}).one()
+    # created_at задается только вставкой
+    created = user.created_at == now
+    referred = False
+
+    if created:
+        user.referral_code = encode_referral_code(user.id)
+        # Скидка на первую запись
+        discounts = [{
+            'user_id': user.id,
+            'discount_type': 'first_visit',
+            'discount_percent': config.LOYALTY_SYSTEM['first_visit_discount'],
+            'valid_until': now + timedelta(days=30),
+        }]
+
+        referrer = find_referrer(session, referrer_code) if referrer_code else None
+        if referrer and referrer.id != user.id:
+            # Бонус получают оба
+            user.referred_by = referrer.id
+            referred = True
+            discounts += [{
+                'user_id': user_id,
+                'discount_type': 'referral',
+                'discount_percent': config.LOYALTY_SYSTEM['referral_bonus'],
+                'valid_until': None,
+            } for user_id in (user.id, referrer.id)]
+
+        session.execute(DISCOUNT_INSERT, discounts)
+        bump_stats(session, {'users': 1})
+    session.commit()
+    return user, created, referred
+
+def get_admin_stats(session):
+    """Счетчики для панели администратора"""
+    today = f"day:{date.today():%Y-%m-%d}"
+    stats = get_stats(session, ['users', 'appointments', 'status:pending',
+                                f"{today}:pending", f"{today}:confirmed"])
+    return {
+        'users': stats['users'],
+        'appointments': stats['appointments'],
+        'pending': stats['status:pending'],
+        'today': stats[f"{today}:pending"] + stats[f"{today}:confirmed"],
+    }
+
+def get_upcoming_appointments(session, user_id: int, limit: int = 3):
+    """Ближайшие активные записи пользователя"""
+    return session.query(Appointment).filter(
+        Appointment.user_id == user_id,
+        Appointment.status.in_(["pending", "confirmed"])
+    ).order_by(Appointment.starts_at).limit(limit).all()
+
+def get_user_appointments(session, user_id: int, limit: int = 10):
+    """Последние записи пользователя"""
+    return session.query(Appointment).filter_by(user_id=user_id)\
+        .order_by(Appointment.starts_at.desc()).limit(limit).all()
+
+def get_user_appointment(session, user_id: int, appointment_id: int):
+    """Запись пользователя по id"""
+    return session.query(Appointment).filter_by(id=appointment_id, user_id=user_id).first()
+
+def get_used_discounts(session, user_id: int):
+    """Использованные скидки пользователя"""
+    return session.query(UserDiscount).filter_by(user_id=user_id, is_used=True).all()
+
+def get_discount_ledger(session, user_id: int = None):
+    """Строки журнала скидок для сверки с правилами (discounts.DiscountRules).
+
+    Неиспользованные строки и использования скидки ко дню рождения;
+    без user_id - по всем пользователям."""
+    query = session.query(
+        UserDiscount.user_id, UserDiscount.discount_type, UserDiscount.discount_percent,
+        UserDiscount.is_used, UserDiscount.valid_until, UserDiscount.created_at
+    ).filter(or_(UserDiscount.is_used.is_(False), UserDiscount.discount_type == 'birthday'))
+    if user_id is not None:
+        query = query.filter(UserDiscount.user_id == user_id)
+    return query.all()
+
+def get_discount_subjects(session):
+    """Поля пользователей, по которым считаются скидки: [(id, visits_count, birth_month, birth_day)]"""
+    return session.query(User.id, User.visits_count, User.birth_month, User.birth_day).all()
+
+def create_appointment(session, user_id: int, service: str, service_name: str, original_price: int,
+                       final_price: int, discount_applied: int, starts_at: datetime,
+                       discount_id: str = None):
+    """Создает заявку и, если была применена скидка, помечает её использованной.
+
+    Ячейки времени занимаются в той же транзакции; если время уже занято,
+    поднимается SlotTakenError и ничего не сохраняется."""
+    appointment = Appointment(
+        user_id=user_id,
+        service=service,
+        service_name=service_name,
+        original_price=original_price,
+        final_price=final_price,
+        discount_applied=discount_applied,
+        starts_at=starts_at,
+        ends_at=service_ends_at(service, starts_at),
+        status="pending"
+    )
+    session.add(appointment)
+    try:
+        session.flush()
+        session.add_all([
+            AppointmentSlot(appointment_id=appointment.id, slot_at=cell)
+            for cell in slot_cells(appointment.starts_at, appointment.ends_at)
+        ])
+        session.flush()
+    except IntegrityError:
+        session.rollback()
+        raise SlotTakenError(f"{starts_at:%d.%m.%Y %H:%M} уже занято")
+
+    bump_stats(session, Counter(['appointments'] + _appointment_stat_keys(appointment, "pending")))
+    _bump_rollup(session, appointment, new_status="pending")
+
+    if discount_id:
+        if discount_id in LEDGER_TYPES:
+            # Погашаем выданную строку, которая истекает раньше других
+            discount = session.query(UserDiscount).filter(
+                UserDiscount.user_id == user_id,
+                UserDiscount.discount_type == discount_id,
+                UserDiscount.is_used.is_(False),
+                or_(UserDiscount.valid_until.is_(None), UserDiscount.valid_until >= datetime.now())
+            ).order_by(UserDiscount.valid_until.is_(None), UserDiscount.valid_until).first()
+        elif discount_id == 'birthday':
+            # Использование закрывает скидку до следующего дня рождения
+            discount = UserDiscount(
+                user_id=user_id,
+                discount_type='birthday',
+                discount_percent=discount_applied
+            )
+            session.add(discount)
+        else:
+            discount = None
+        if discount:
+            discount.is_used = True
+            session.flush()
+            appointment.discount_ledger_id = discount.id
+        # Обновляем общий процент скидки пользователя
+        user = session.get(User, user_id)
+        user.discount_percent = max(user.discount_percent, discount_applied)
+
+    session.commit()
+    return appointment
+
+def get_active_intervals(session, since: datetime):
+    """Занятое время активных записей начиная с since: [(id, starts_at, ends_at)]"""
+    return session.query(Appointment.id, Appointment.starts_at, Appointment.ends_at).filter(
+        Appointment.starts_at >= since,
+        Appointment.status.in_(["pending", "confirmed"])
+    ).all()
+
+def create_reminders(session, user_id: int, appointment_id: int, scheduled: dict):
+    """Создает напоминания {reminder_type: scheduled_for}"""
+    reminders = [
+        Reminder(
+            user_id=user_id,
+            appointment_id=appointment_id,
+            reminder_type=reminder_type,
+            scheduled_for=scheduled_for
+        )
+        for reminder_type, scheduled_for in scheduled.items()
+    ]
+    session.add_all(reminders)
+    session.commit()
+    return reminders
+
+def get_pending_reminders(session, until: datetime):
+    """Ожидающие отправки напоминания со временем до until: [(id, scheduled_for)]"""
+    return session.query(Reminder.id, Reminder.scheduled_for).filter(
+        Reminder.status == "scheduled",
+        Reminder.scheduled_for <= until
+    ).all()
+
+def get_reminder_batch(session, reminder_ids):
+    """Ожидающие напоминания вместе с записями и клиентами одним запросом: [(reminder, appointment, user)]"""
+    if not reminder_ids:
+        return []
+    return session.query(Reminder, Appointment, User)\
+        .join(Appointment, Reminder.appointment_id == Appointment.id)\
+        .join(User, Reminder.user_id == User.id)\
+        .filter(Reminder.id.in_(reminder_ids), Reminder.status == "scheduled")\
+        .all()
+
+def finish_reminders(session, sent_ids, skipped_ids, failed_ids=(), retry_ids=()):
+    """Отмечает итоги отправки пачкой.
+
+    failed_ids - постоянные ошибки (бот заблокирован, чат не найден),
+    retry_ids - временные: напоминание остается в очереди, пока не исчерпает
+    REMINDER_MAX_ATTEMPTS попыток, затем тоже помечается failed."""
+    if sent_ids:
+        session.query(Reminder).filter(Reminder.id.in_(sent_ids))\
+            .update({'status': "sent", 'sent_at': datetime.now()}, synchronize_session=False)
+    if skipped_ids:
+        session.query(Reminder).filter(Reminder.id.in_(skipped_ids), Reminder.status == "scheduled")\
+            .update({'status': "skipped"}, synchronize_session=False)
+    if failed_ids:
+        session.query(Reminder).filter(Reminder.id.in_(failed_ids), Reminder.status == "scheduled")\
+            .update({'status': "failed", 'attempts': Reminder.attempts + 1}, synchronize_session=False)
+    if retry_ids:
+        session.query(Reminder).filter(Reminder.id.in_(retry_ids), Reminder.status == "scheduled")\
+            .update({
+                'attempts': Reminder.attempts + 1,
+                'status': case((Reminder.attempts + 1 >= config.REMINDER_MAX_ATTEMPTS, "failed"), else_="scheduled"),
+            }, synchronize_session=False)
+    session.commit()
+
+def cancel_appointment_reminders(session, appointment_id: int):
+    """Отменяет все ожидающие напоминания записи (без commit)"""
+    session.query(Reminder).filter_by(appointment_id=appointment_id, status="scheduled")\
+        .update({'status': "cancelled"}, synchronize_session=False)
+
+def release_appointment_slots(session, appointment_id: int):
+    """Освобождает ячейки времени записи (без commit)"""
+    session.query(AppointmentSlot).filter_by(appointment_id=appointment_id).delete()
+
+def _restore_discount(session, appointment):
+    """Возвращает скидку, погашенную отмененной записью (без commit)"""
+    if not appointment.discount_ledger_id:
+        return
+    discount = session.get(UserDiscount, appointment.discount_ledger_id)
+    if discount and discount.discount_type == 'birthday':
+        # Строка только отмечала использование - без нее скидка снова доступна
+        session.delete(discount)
+    elif discount:
+        discount.is_used = False
+    appointment.discount_ledger_id = None
+
+def cancel_user_appointment(session, telegram_id: int, appointment_id: int):
+    """Отмена записи пользователем. Возвращает (appointment, user, error)"""
+    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    appointment = None
+    if user:
+        appointment = session.query(Appointment).filter_by(id=appointment_id, user_id=user.id).first()
+
+    if not appointment:
+        return None, user, "❌ Запись не найдена"
+
+    # Можно отменять только pending и confirmed записи
+    if appointment.status not in ["pending", "confirmed"]:
+        return appointment, user, f"❌ Нельзя отменить запись со статусом {appointment.status}"
+
+    try:
+        set_appointment_status(session, appointment, "cancelled")
+    except StatusConflictError:
+        session.rollback()
+        return appointment, user, "❌ Запись уже изменена, обновите список"
+    appointment.cancelled_at = datetime.now()
+    release_appointment_slots(session, appointment.id)
+    cancel_appointment_reminders(session, appointment.id)
+    _restore_discount(session, appointment)
+    session.commit()
+    return appointment, user, None
+
+def _status_conflict_message(session, appointment) -> str:
+    session.rollback()
+    if appointment.status == "cancelled":
+        return "❌ Запись уже отменена"
+    if appointment.status == "confirmed":
+        return "✅ Запись уже подтверждена"
+    if appointment.status == "pending":
+        return "⏳ Запись еще не подтверждена"
+    if appointment.status == "noshow":
+        return "🚫 Неявка уже отмечена"
+    return f"❌ Запись в статусе {appointment.status}"
+
+def confirm_appointment(session, appointment_id: int):
+    """Подтверждение заявки (только pending): обновляет визиты и скидки клиента.
+
+    Возвращает (appointment, user, error)."""
+    appointment = session.query(Appointment).filter_by(id=appointment_id).first()
+    if not appointment:
+        return None, None, "❌ Запись не найдена"
+
+    try:
+        set_appointment_status(session, appointment, "confirmed")
+    except StatusConflictError:
+        return appointment, None, _status_conflict_message(session, appointment)
+    appointment.confirmed_at = datetime.now()
+
+    user = session.query(User).filter_by(id=appointment.user_id).first()
+
+    # Увеличиваем счетчик визитов пользователя
+    user.visits_count += 1
+    user.total_spent += appointment.final_price
+    user.last_visit = datetime.now()
+
+    # Проверяем достижения по визитам для скидок
+    for milestone, discount in config.LOYALTY_SYSTEM['visit_milestones'].items():
+        if user.visits_count == milestone:
+            user.discount_percent = max(user.discount_percent, discount)
+            session.add(UserDiscount(
+                user_id=user.id,
+                discount_type='milestone',
+                discount_percent=discount
+            ))
+
+    session.commit()
+    return appointment, user, None
+
+def reject_appointment(session, appointment_id: int):
+    """Отклонение заявки администратором. Возвращает (appointment, user, error)"""
+    appointment = session.query(Appointment).filter_by(id=appointment_id).first()
+    if not appointment:
+        return None, None, "❌ Запись не найдена"
+
+    try:
+        set_appointment_status(session, appointment, "cancelled")
+    except StatusConflictError:
+        return appointment, None, _status_conflict_message(session, appointment)
+    appointment.cancelled_at = datetime.now()
+    release_appointment_slots(session, appointment.id)
+    cancel_appointment_reminders(session, appointment.id)
+    _restore_discount(session, appointment)
+    session.commit()
+
+    user = session.query(User).filter_by(id=appointment.user_id).first()
+    return appointment, user, None
+
+def mark_noshow(session, appointment_id: int):
+    """Неявка клиента на подтвержденную запись: визит, засчитанный при
+    подтверждении, снимается. Возвращает (appointment, user, error)."""
+    appointment = session.query(Appointment).filter_by(id=appointment_id).first()
+    if not appointment:
+        return None, None, "❌ Запись не найдена"
+    if appointment.starts_at > datetime.now():
+        return appointment, None, "❌ Время записи еще не наступило"
+
+    try:
+        set_appointment_status(session, appointment, "noshow")
+    except StatusConflictError:
+        return appointment, None, _status_conflict_message(session, appointment)
+    cancel_appointment_reminders(session, appointment.id)
+
+    user = session.query(User).filter_by(id=appointment.user_id).first()
+    user.visits_count = max(user.visits_count - 1, 0)
+    user.total_spent = max(user.total_spent - appointment.final_price, 0)
+    session.commit()
+    return appointment, user, None
+
+def _keyset_page(query, columns, limit: int, after: tuple = None, before: tuple = None, descending: bool = False):
+    """Страница выборки по ключу columns в порядке выдачи (descending - новые первыми).
+
+    after/before - ключ последней/первой строки соседней страницы.
+    Возвращает (rows, has_prev, has_next)."""
+    key = tuple_(*columns)
+    forward = [column.desc() for column in columns] if descending else list(columns)
+    backward = list(columns) if descending else [column.desc() for column in columns]
+
+    if before:
+        rows = query.filter(key > before if descending else key < before)\
+            .order_by(*backward).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        return list(reversed(rows[:limit])), has_more, True
+
+    if after:
+        query = query.filter(key < after if descending else key > after)
+    rows = query.order_by(*forward).limit(limit + 1).all()
+    return rows[:limit], after is not None, len(rows) > limit
+
+def get_pending_page(session, limit: int, after: tuple = None, before: tuple = None):
+    """Страница очереди заявок с клиентами по ключу (created_at, id).
+
+    after/before - ключ последней/первой заявки соседней страницы.
+    Возвращает ([(appointment, user)], has_prev, has_next)."""
+    query = session.query(Appointment, User).join(User, Appointment.user_id == User.id)\
+        .filter(Appointment.status == "pending")
+    return _keyset_page(query, (Appointment.created_at, Appointment.id), limit, after, before)
+
+def get_reviews_page(session, limit: int, after: tuple = None, before: tuple = None):
+    """Страница ленты одобренных отзывов, новые первыми, по ключу (created_at, id).
+
+    Возвращает ([(review, first_name)], has_prev, has_next)."""
+    query = session.query(Review, User.first_name).outerjoin(User, Review.user_id == User.id)\
+        .filter(Review.is_approved.is_(True))
+    return _keyset_page(query, (Review.created_at, Review.id), limit, after, before, descending=True)
+
+def get_review_summary(session):
+    """Рейтинг по счетчикам: (количество, средняя оценка, {звезды: количество})"""
+    keys = ['reviews:count', 'reviews:rating_sum'] + [f"reviews:stars:{stars}" for stars in range(1, 6)]
+    values = get_stats(session, keys)
+    count = values['reviews:count']
+    average = values['reviews:rating_sum'] / count if count else 0.0
+    return count, average, {stars: values[f"reviews:stars:{stars}"] for stars in range(1, 6)}
+
+def create_review(session, user_id: int, rating: int, text: str, photo_path: str = None,
+                  photo_file_id: str = None):
+    """Сохраняет отзыв"""
+    review = Review(
+        user_id=user_id,
+        rating=rating,
+        text=text,
+        photo_path=photo_path,
+        photo_file_id=photo_file_id,
+        is_approved=True
+    )
+    session.add(review)
+    bump_stats(session, _review_stat_deltas(rating))
+    session.commit()
+    return review
+
+def set_review_photo_ids(session, file_ids: dict):
+    """Запоминает file_id фото отзывов {review_id: file_id}"""
+    session.bulk_update_mappings(Review, [
+        {'id': review_id, 'photo_file_id': file_id} for review_id, file_id in file_ids.items()
+    ])
+    session.commit()
+
+def get_gallery_images(session):
+    """Каталог галереи: [(id, service_type, image_path, file_id)] в порядке загрузки"""
+    return session.query(
+        ServiceImage.id, ServiceImage.service_type, ServiceImage.image_path, ServiceImage.file_id
+    ).order_by(ServiceImage.id).all()
+
+def get_gallery_version(session):
+    """(количество, максимальный id) фото галереи - дешевая проверка изменений"""
+    return tuple(session.query(func.count(ServiceImage.id), func.max(ServiceImage.id)).one())
+
+def add_gallery_image(session, service_type: str, image_path: str, content_hash: str, file_id: str = None):
+    """Добавляет фото в галерею. Возвращает id или None, если такое фото уже есть"""
+    image_id = session.execute(
+        sqlite_insert(ServiceImage.__table__).values(
+            service_type=service_type,
+            image_path=image_path,
+            content_hash=content_hash,
+            file_id=file_id,
+            uploaded_at=datetime.now()
+        ).on_conflict_do_nothing(index_elements=['content_hash']).returning(ServiceImage.__table__.c.id)
+    ).scalar()
+    session.commit()
+    return image_id
+
+def set_image_file_ids(session, file_ids: dict):
+    """Запоминает file_id фото галереи {image_id: file_id}"""
+    session.bulk_update_mappings(ServiceImage, [
+        {'id': image_id, 'file_id': file_id} for image_id, file_id in file_ids.items()
+    ])
+    session.commit()
+
+def create_broadcast(session, admin_id: int, message_text: str):
+    """Создает рассылку всем пользователям в статусе running"""
+    broadcast = AdminMessage(
+        admin_id=admin_id,
+        message_type='broadcast_all',
+        message_text=message_text,
+        status="running",
+        total_count=session.query(User).count(),
+        sent_count=0,
+        failed_count=0,
+        last_user_id=0
+    )
+    session.add(broadcast)
+    session.commit()
+    return broadcast
+
+def set_broadcast_progress_message(session, broadcast_id: int, chat_id: int, message_id: int):
+    """Запоминает сообщение, в котором показывается прогресс рассылки"""
+    session.query(AdminMessage).filter_by(id=broadcast_id)\
+        .update({'progress_chat_id': chat_id, 'progress_message_id': message_id})
+    session.commit()
+
+def get_broadcast_recipients(session, after_user_id: int, limit: int):
+    """Следующая пачка получателей по возрастанию users.id: [(id, telegram_id)]"""
+    return session.query(User.id, User.telegram_id)\
+        .filter(User.id > after_user_id)\
+        .order_by(User.id).limit(limit).all()
+
+def save_broadcast_progress(session, broadcast_id: int, last_user_id: int, sent: int, failed: int):
+    """Сдвигает курсор рассылки и прибавляет счетчики пачки"""
+    session.query(AdminMessage).filter_by(id=broadcast_id).update({
+        'last_user_id': last_user_id,
+        'sent_count': AdminMessage.sent_count + sent,
+        'failed_count': AdminMessage.failed_count + failed,
+    }, synchronize_session=False)
+    session.commit()
+
+def finish_broadcast(session, broadcast_id: int, status: str = "done"):
+    """Завершает рассылку"""
+    session.query(AdminMessage).filter_by(id=broadcast_id)\
+        .update({'status': status, 'sent_at': datetime.now()})
+    session.commit()
+    return session.get(AdminMessage, broadcast_id)
+
+def get_broadcast(session, broadcast_id: int):
+    """Рассылка по id"""
+    return session.get(AdminMessage, broadcast_id)
+
+def get_running_broadcasts(session):
+    """Рассылки, прерванные перезапуском"""
+    return session.query(AdminMessage).filter_by(status="running").all()
+
+def load_fsm_record(session, key: str, not_older_than: datetime):
+    """Состояние и данные диалога; просроченные записи считаются пустыми"""
+    record = session.get(FSMRecord, key)
+    if not record or record.updated_at < not_older_than:
+        return None, {}
+    return record.state, record.data or {}
+
+def save_fsm_records(session, records):
+    """Сохраняет пачку состояний [(key, state, data, updated_at)]; пустые удаляются"""
+    to_delete = [key for key, state, data, _ in records if state is None and not data]
+    to_upsert = [
+        {'key': key, 'state': state, 'data': data, 'updated_at': updated_at}
+        for key, state, data, updated_at in records
+        if state is not None or data
+    ]
+    if to_delete:
+        session.query(FSMRecord).filter(FSMRecord.key.in_(to_delete)).delete(synchronize_session=False)
+    if to_upsert:
+        statement = sqlite_insert(FSMRecord.__table__)
+        session.execute(
+            statement.on_conflict_do_update(
+                index_elements=['key'],
+                set_={
+                    'state': statement.excluded.state,
+                    'data': statement.excluded.data,
+                    'updated_at': statement.excluded.updated_at,
+                }
+            ),
+            to_upsert
+        )
+    session.commit()
+
+def purge_fsm_records(session, older_than: datetime):
+    """Удаляет брошенные диалоги"""
+    deleted = session.query(FSMRecord).filter(FSMRecord.updated_at < older_than)\
+        .delete(synchronize_session=False)
+    session.commit()
+    return deleted
+
+def _lease_upsert(name: str, holder: str, expires_at: datetime, now: datetime):
+    statement = sqlite_insert(Lease.__table__).values(name=name, holder=holder, expires_at=expires_at)
+    # Перехватить можно только истекшую аренду; свою - продлить
+    return statement.on_conflict_do_update(
+        index_elements=['name'],
+        set_={'holder': statement.excluded.holder, 'expires_at': statement.excluded.expires_at},
+        where=(Lease.__table__.c.expires_at < now) | (Lease.__table__.c.holder == holder)
+    )
+
+def acquire_lease(session, name: str, holder: str, ttl_seconds: int) -> bool:
+    """Захватывает или продлевает аренду. True - аренда у holder"""
+    now = datetime.now()
+    session.execute(_lease_upsert(name, holder, now + timedelta(seconds=ttl_seconds), now))
+    session.commit()
+    return session.query(Lease.holder).filter_by(name=name).scalar() == holder
+
+def release_lease(session, name: str, holder: str):
+    """Освобождает аренду, если она у holder"""
+    session.query(Lease).filter_by(name=name, holder=holder).delete()
+    session.commit()
+
+def hold_slot_cells(session, holder: str, starts_at: datetime, ends_at: datetime, ttl_seconds: int) -> bool:
+    """Удерживает ячейки времени [starts_at, ends_at) за holder арендами slot:<ячейка>.
+
+    Удержание видно всем процессам. Прежние удержания holder снимаются;
+    если хоть одна ячейка удерживается другим, ничего не меняется и возвращается False."""
+    now = datetime.now()
+    names = [f"slot:{cell:%Y-%m-%dT%H:%M}" for cell in slot_cells(starts_at, ends_at)]
+    session.query(Lease).filter(
+        Lease.name.like("slot:%"), (Lease.holder == holder) | (Lease.expires_at < now)
+    ).delete(synchronize_session=False)
+    for name in names:
+        session.execute(_lease_upsert(name, holder, now + timedelta(seconds=ttl_seconds), now))
+    owned = session.query(func.count(Lease.name)).filter(Lease.name.in_(names), Lease.holder == holder).scalar()
+    if owned != len(names):
+        session.rollback()
+        return False
+    session.commit()
+    return True
+
+def release_slot_holds(session, holder: str):
+    """Снимает удержания времени holder"""
+    session.query(Lease).filter(Lease.name.like("slot:%"), Lease.holder == holder)\
+        .delete(synchronize_session=False)
+    session.commit()
+
+def get_day_intervals(session, day: date):
+    """Занятое время активных записей дня: [(id, starts_at, ends_at)]"""
+    day_start, day_end = day_range(day)
+    return session.query(Appointment.id, Appointment.starts_at, Appointment.ends_at).filter(
+        Appointment.starts_at >= day_start,
+        Appointment.starts_at < day_end,
+        Appointment.status.in_(["pending", "confirmed"])
+    ).all()
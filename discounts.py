@@ -0,0 +1,105 @@
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+BIRTHDAY_WINDOW_DAYS = 15  # Скидка действует за столько дней до и после дня рождения
+
+# Скидки, которые выдаются строкой в user_discounts и действуют, пока строка не использована
+LEDGER_TYPES = ('first_visit', 'referral')
+
+def parse_birthday(birthday: str):
+    """(месяц, день) из строки ДД.ММ.ГГГГ или None"""
+    try:
+        day = datetime.strptime(birthday, "%d.%m.%Y")
+    except (TypeError, ValueError):
+        return None
+    return day.month, day.day
+
+@lru_cache(maxsize=2)
+def birthday_window(today: date, days: int = BIRTHDAY_WINDOW_DAYS) -> frozenset:
+    """Дни рождения (месяц, день), для которых сегодня действует скидка.
+
+    29 февраля в невисокосный год празднуется 28-го."""
+    window = set()
+    for shift in range(-days, days + 1):
+        day = today + timedelta(days=shift)
+        window.add((day.month, day.day))
+        if (day.month, day.day) == (2, 28) and (day + timedelta(days=1)).month == 3:
+            window.add((2, 29))
+    return frozenset(window)
+
+class DiscountRules:
+    """Правила скидок, собранные из config.LOYALTY_SYSTEM один раз.
+
+    Пользователь - любой объект с id, visits_count, birth_month, birth_day
+    (модель User или строка выборки). Записи журнала user_discounts сверяются
+    с правилами: скидки на первую запись и за друга доступны, только пока в
+    журнале есть неиспользованная и не просроченная строка, скидка ко дню
+    рождения - если в журнале нет ее использования в текущем окне.
+    Скидка за визиты постоянная и считается по visits_count.
+    """
+
+    def __init__(self, loyalty: dict):
+        self.birthday_percent = loyalty['birthday_discount']
+        milestones = sorted(loyalty['visit_milestones'].items())
+        self._thresholds = [visits for visits, _ in milestones]
+        self._milestones = [{
+            'id': f'milestone_{visits}',
+            'name': f'За {visits} визитов',
+            'percent': percent,
+            'type': 'milestone'
+        } for visits, percent in milestones]
+
+    def evaluate(self, user, ledger=(), today: date = None) -> list:
+        """Доступные скидки пользователя: [{'id', 'name', 'percent', 'type'}]
+
+        ledger - строки user_discounts пользователя (см. database.get_discount_ledger)."""
+        today = today or date.today()
+        return self._evaluate(user, ledger, today, birthday_window(today))
+
+    def evaluate_batch(self, users, ledger=(), today: date = None) -> dict:
+        """Скидки всех пользователей за один проход: {user_id: [скидки]}"""
+        today = today or date.today()
+        window = birthday_window(today)
+        by_user = defaultdict(list)
+        for row in ledger:
+            by_user[row.user_id].append(row)
+        return {user.id: self._evaluate(user, by_user.get(user.id, ()), today, window) for user in users}
+
+    def _evaluate(self, user, ledger, today: date, window: frozenset) -> list:
+        active = {}
+        birthday_used = False
+        for row in ledger:
+            if row.discount_type == 'birthday':
+                # Использование в пределах одного окна закрывает скидку до следующего года
+                birthday_used |= bool(row.is_used) and row.created_at.date() > today - timedelta(
+                    days=2 * BIRTHDAY_WINDOW_DAYS + 1)
+            elif row.discount_type in LEDGER_TYPES and not row.is_used \
+                    and (row.valid_until is None or row.valid_until.date() >= today):
+                active[row.discount_type] = max(active.get(row.discount_type, 0), row.discount_percent)
+
+        discounts = []
+        if 'first_visit' in active and not user.visits_count:
+            discounts.append({
+                'id': 'first_visit',
+                'name': 'Первая запись',
+                'percent': active['first_visit'],
+                'type': 'first_visit'
+            })
+        if 'referral' in active:
+            discounts.append({
+                'id': 'referral',
+                'name': 'Приглашение друга',
+                'percent': active['referral'],
+                'type': 'referral'
+            })
+        discounts += self._milestones[:bisect_right(self._thresholds, user.visits_count or 0)]
+        if not birthday_used and (user.birth_month, user.birth_day) in window:
+            discounts.append({
+                'id': 'birthday',
+                'name': 'День рождения',
+                'percent': self.birthday_percent,
+                'type': 'birthday'
+            })
+        return discounts
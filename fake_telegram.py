@@ -0,0 +1,151 @@
+"""Заглушка Bot API для замеров (bench_*.py): бот работает без Telegram.
+
+FakeSession подставляется вместо сессии бота в том же процессе,
+FakeBotAPI - HTTP-сервер на aiohttp для бота в отдельном процессе
+(TELEGRAM_API_URL). Оба отвечают одинаково: getMe - пользователь-бот,
+send*/edit* - сообщение, остальное - True.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+from aiohttp import ClientSession, web
+from aiogram.client.session.base import BaseSession
+
+from webhook import SECRET_HEADER
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+_message_ids = itertools.count(1)
+
+def fake_result(api_method: str, params: dict):
+    """Ответ Bot API на вызов api_method с параметрами params"""
+    if api_method == "getMe":
+        return BOT_USER
+    if api_method == "getFile":
+        return {"file_id": params.get("file_id") or "", "file_unique_id": "bench", "file_path": "photos/bench.jpg"}
+    if not api_method.startswith(("send", "edit", "copy", "forward")):
+        return True
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+        "from": BOT_USER,
+        "text": params.get("text") or ""
+    }
+    if api_method == "sendMediaGroup":
+        return [message]
+    return message
+
+def user_message(update_id: int, user_id: int, text: str) -> dict:
+    """Обновление: пользователь user_id написал text"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text
+        }
+    }
+
+class FakeSession(BaseSession):
+    """Сессия без сети: каждый запрос ждет latency секунд и получает fake_result"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.requests = Counter()
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests[method.__api_method__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = {name: getattr(method, name, None) for name in ("chat_id", "text", "file_id")}
+        content = json.dumps({"ok": True, "result": fake_result(method.__api_method__, params)})
+        return self.check_response(bot, method, 200, content).result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+class FakeBotAPI:
+    """HTTP-заглушка Bot API.
+
+    Обновления из push() отдаются через getUpdates, а после setWebhook -
+    отправляются POST-запросом на адрес вебхука. Для каждого ответа бота
+    (send*/edit*) вызывается on_reply(chat_id, api_method).
+    """
+
+    def __init__(self, latency: float = 0.0, on_reply=None):
+        self.latency = latency
+        self.on_reply = on_reply
+        self.requests = Counter()
+        self._updates = []
+        self._arrived = asyncio.Event()
+        self._webhook = None
+        self._secret = None
+        self._client = None
+        self._runner = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> str:
+        """Запускает сервер и возвращает адрес для TELEGRAM_API_URL"""
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._client = ClientSession()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._client:
+            await self._client.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def push(self, update: dict):
+        """Передает обновление боту: в очередь getUpdates или на вебхук"""
+        if self._webhook is None:
+            self._updates.append(update)
+            self._arrived.set()
+            return
+        headers = {SECRET_HEADER: self._secret} if self._secret else {}
+        async with self._client.post(self._webhook, json=update, headers=headers) as response:
+            await response.read()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.requests[method] += 1
+        if method == "getUpdates":
+            result = await self._get_updates(params)
+        else:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if method == "setWebhook":
+                self._webhook = params.get("url")
+                self._secret = params.get("secret_token")
+            elif method == "deleteWebhook":
+                self._webhook = None
+            result = fake_result(method, params)
+            if isinstance(result, (dict, list)) and self.on_reply:
+                self.on_reply(int(params.get("chat_id") or 0), method)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get("limit") or 100)]
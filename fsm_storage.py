@@ -0,0 +1,115 @@
+import asyncio
+import copy
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+import database as db
+from database import run_db
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять просроченные диалоги из БД и кэша
+PURGE_INTERVAL = 600
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в таблице fsm_records с write-behind кэшем.
+
+    Чтения и записи обслуживаются из словаря в памяти, как в MemoryStorage;
+    в БД идет только первый промах по ключу. Измененные ключи сбрасываются
+    в БД фоновой задачей пачкой раз в flush_interval секунд и при закрытии
+    хранилища, поэтому незавершенные записи и отзывы переживают перезапуск.
+    Диалоги без активности дольше ttl считаются брошенными и удаляются.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, ttl: timedelta = timedelta(hours=24)):
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._cache = {}    # key -> [state, data, updated_at]
+        self._dirty = set()
+        self._flusher = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _entry(self, key: StorageKey):
+        str_key = self._key(key)
+        entry = self._cache.get(str_key)
+        if entry is not None and entry[2] < datetime.now() - self.ttl:
+            # Брошенный диалог начинается заново
+            entry = self._cache[str_key] = [None, {}, datetime.now()]
+        if entry is None:
+            state, data = await run_db(db.load_fsm_record, str_key, datetime.now() - self.ttl)
+            # Пока шел запрос, ключ мог быть записан другим обработчиком
+            entry = self._cache.setdefault(str_key, [state, data, datetime.now()])
+        return str_key, entry
+
+    def _touch(self, str_key: str, entry):
+        entry[2] = datetime.now()
+        self._dirty.add(str_key)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        str_key, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(str_key, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        str_key, entry = await self._entry(key)
+        entry[1] = copy.copy(data)
+        self._touch(str_key, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, entry = await self._entry(key)
+        return copy.copy(entry[1])
+
+    async def flush(self):
+        """Сбрасывает измененные ключи в БД"""
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        records = [
+            (key, self._cache[key][0], self._cache[key][1], self._cache[key][2])
+            for key in keys if key in self._cache
+        ]
+        try:
+            await run_db(db.save_fsm_records, records)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояний FSM: {e}")
+            self._dirty |= keys
+
+    async def purge(self):
+        """Забывает брошенные диалоги в БД и в кэше"""
+        cutoff = datetime.now() - self.ttl
+        for key in [key for key, entry in self._cache.items() if entry[2] < cutoff and key not in self._dirty]:
+            del self._cache[key]
+        deleted = await run_db(db.purge_fsm_records, cutoff)
+        if deleted:
+            logger.info(f"FSM: удалено брошенных диалогов: {deleted}")
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        next_purge = loop.time() + PURGE_INTERVAL
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if loop.time() >= next_purge:
+                next_purge = loop.time() + PURGE_INTERVAL
+                try:
+                    await self.purge()
+                except Exception as e:
+                    logger.error(f"Ошибка очистки состояний FSM: {e}")
+
+    async def close(self) -> None:
+        if self._flusher:
+            self._flusher.cancel()
+        await self.flush()
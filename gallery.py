@@ -0,0 +1,81 @@
+import hashlib
+import os
+import random
+import uuid
+from contextlib import suppress
+
+import aiofiles
+import aiofiles.os
+
+# Хранилище по содержимому: images/gallery/ab/cd/<sha256>.jpg
+GALLERY_ROOT = "images/gallery"
+
+def content_path(content_hash: str, root: str = GALLERY_ROOT) -> str:
+    """Путь файла в хранилище по SHA-256 содержимого"""
+    return os.path.join(root, content_hash[:2], content_hash[2:4], f"{content_hash}.jpg")
+
+async def store_stream(chunks, root: str = GALLERY_ROOT):
+    """Записывает поток байтов в хранилище по хэшу содержимого. Возвращает (hash, path).
+
+    Файл пишется через aiofiles во временный и переименовывается в итоговый;
+    повторная запись того же содержимого просто заменяет файл таким же."""
+    digest = hashlib.sha256()
+    tmp_path = os.path.join(root, f".incoming-{uuid.uuid4().hex}")
+    try:
+        async with aiofiles.open(tmp_path, "wb") as file:
+            async for chunk in chunks:
+                digest.update(chunk)
+                await file.write(chunk)
+        content_hash = digest.hexdigest()
+        path = content_path(content_hash, root)
+        await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+        await aiofiles.os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            await aiofiles.os.remove(tmp_path)
+        raise
+    return content_hash, path
+
+class GalleryIndex:
+    """Каталог фото работ в памяти: списки по service_type и общий список.
+
+    Загружается из service_images при старте и пополняется при загрузке фото
+    админом, поэтому листание галереи не обращается к БД. Случайная работа
+    выбирается по индексу в общем списке без ORDER BY RANDOM().
+    Элемент каталога - словарь {'id', 'service_type', 'image_path', 'file_id'}.
+    """
+
+    def __init__(self):
+        self._by_service = {}
+        self._all = []
+        self.version = None  # (количество, максимальный id) - для сверки с БД
+
+    def load(self, rows, version=None):
+        """Заменяет каталог строками (id, service_type, image_path, file_id)"""
+        self._by_service = {}
+        self._all = []
+        for row in rows:
+            self.add(*row)
+        self.version = version
+
+    def add(self, image_id: int, service_type: str, image_path: str, file_id: str = None):
+        """Добавляет фото в каталог"""
+        image = {'id': image_id, 'service_type': service_type, 'image_path': image_path, 'file_id': file_id}
+        self._by_service.setdefault(service_type, []).append(image)
+        self._all.append(image)
+        if self.version is not None:
+            count, max_id = self.version
+            self.version = (count + 1, max(max_id or 0, image_id))
+
+    def count(self, service_type: str) -> int:
+        return len(self._by_service.get(service_type, ()))
+
+    def page(self, service_type: str, offset: int, size: int):
+        """Фото услуги с offset, не больше size (новые первыми)"""
+        images = self._by_service.get(service_type, [])
+        end = len(images) - offset
+        return list(reversed(images[max(end - size, 0):max(end, 0)]))
+
+    def random(self):
+        """Случайное фото или None"""
+        return random.choice(self._all) if self._all else None
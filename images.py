@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DISPLAY_SIZE = 1280  # Длинная сторона версии для показа
+JPEG_QUALITY = 82
+
+def _save_jpeg(image: Image.Image, path: str, size: int):
+    image.thumbnail((size, size), Image.LANCZOS)
+    tmp_path = f"{path}.tmp"
+    # exif и icc_profile не передаются - метаданные (в том числе геометка) не сохраняются
+    image.save(tmp_path, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    os.replace(tmp_path, path)
+
+def render(source: str, target: str):
+    """Готовит версию для показа target; исходник удаляется.
+
+    Выполняется в процессе пула: поворот по EXIF, перевод в RGB, уменьшение,
+    сжатие в JPEG без метаданных."""
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        _save_jpeg(image, target, DISPLAY_SIZE)
+    if os.path.abspath(source) != os.path.abspath(target):
+        os.remove(source)
+    return os.path.getsize(target)
+
+class ImagePipeline:
+    """Обработка изображений в пуле процессов, чтобы Pillow не блокировал цикл событий"""
+
+    def __init__(self, workers: int = 2):
+        self.workers = workers
+        self._executor = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: дочерние процессы не наследуют потоки и соединения бота
+            # (главный модуль в них импортируется заново, запуск защищен __main__)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def process(self, source: str, target: str) -> int:
+        """Обрабатывает source в target; возвращает размер результата в байтах"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool(), render, source, target)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -1,10 +1,23 @@
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.types import InlineKeyboardButton, KeyboardButton, ReplyKeyboardMarkup, WebAppInfo
 import config
-from datetime import datetime, timedelta
-import random
-import string
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 
+# Клавиатуры без параметров строятся один раз (warm_up при старте) и
+# переиспользуются; клавиатуры с параметрами кэшируются в ограниченном LRU.
+# Разметка из кэша общая для всех сообщений - изменять ее нельзя.
+_STATIC = []
+
+def static(func):
+    """Клавиатура без параметров: строится один раз"""
+    cached = lru_cache(maxsize=None)(func)
+    _STATIC.append(cached)
+    return cached
+
+parameterized = lru_cache(maxsize=config.KEYBOARD_CACHE_SIZE)
+
+@static
 def main_menu():
     builder = ReplyKeyboardBuilder()
     builder.button(text="💅 Услуги и цены")
@@ -17,6 +30,7 @@ def main_menu():
     builder.adjust(2, 2, 1, 1, 1)
     return builder.as_markup(resize_keyboard=True)
 
+@static
 def services_menu():
     builder = InlineKeyboardBuilder()
     for service_id, service in config.SERVICES.items():
@@ -28,8 +42,12 @@ def services_menu():
     return builder.as_markup()
 
 def booking_dates_keyboard():
+    return _booking_dates_keyboard(datetime.now().date())
+
+@lru_cache(maxsize=2)
+def _booking_dates_keyboard(today: date):
+    """Даты на неделю вперед; строится один раз за календарный день"""
     builder = InlineKeyboardBuilder()
-    today = datetime.now().date()
 
     for i in range(1, 8):
         date_obj = today + timedelta(days=i)
@@ -46,16 +64,23 @@ def booking_dates_keyboard():
     builder.adjust(2)
     return builder.as_markup()
 
-def booking_times_keyboard():
+def booking_times_keyboard(time_slots=None):
+    if time_slots is None:
+        time_slots = config.TIME_SLOTS
+    return _booking_times_keyboard(tuple(time_slots))
+
+@parameterized
+def _booking_times_keyboard(time_slots: tuple):
     builder = InlineKeyboardBuilder()
 
-    for time_slot in config.TIME_SLOTS:
+    for time_slot in time_slots:
         builder.button(text=time_slot, callback_data=f"time_{time_slot}")
 
     builder.button(text="🔙 Выбрать другую дату", callback_data="back_to_dates")
     builder.adjust(3)
     return builder.as_markup()
 
+@static
 def confirm_booking_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Да, всё верно!", callback_data="confirm_booking")
@@ -64,6 +89,7 @@ def confirm_booking_keyboard():
     builder.adjust(1)
     return builder.as_markup()
 
+@static
 def contact_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="📞 Позвонить", url=f"tel:{config.SALON_INFO['phone_formatted']}")
@@ -73,6 +99,7 @@ def contact_keyboard():
     builder.adjust(1)
     return builder.as_markup()
 
+@static
 def gallery_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="💅 Маникюр", callback_data="gallery_manicure")
@@ -83,6 +110,24 @@ def gallery_keyboard():
     builder.adjust(2)
     return builder.as_markup()
 
+@parameterized
+def gallery_page_keyboard(service_type: str, next_offset: int = None):
+    builder = InlineKeyboardBuilder()
+    if next_offset is not None:
+        builder.button(text="➡️ Еще работы", callback_data=f"gallery_{service_type}_{next_offset}")
+    builder.button(text="🔙 К категориям", callback_data="gallery_menu")
+    builder.adjust(1)
+    return builder.as_markup()
+
+@static
+def gallery_random_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🎲 Еще случайная", callback_data="gallery_random")
+    builder.button(text="🔙 К категориям", callback_data="gallery_menu")
+    builder.adjust(1)
+    return builder.as_markup()
+
+@static
 def share_contact_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.button(text="📱 Отправить мой номер", request_contact=True)
@@ -90,6 +135,7 @@ def share_contact_keyboard():
     builder.adjust(1)
     return builder.as_markup(resize_keyboard=True, one_time_keyboard=True)
 
+@static
 def profile_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="📋 Мои записи", callback_data="my_appointments")
@@ -102,6 +148,7 @@ def profile_keyboard():
     builder.adjust(2)
     return builder.as_markup()
 
+@static
 def admin_menu_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="📊 Статистика", callback_data="admin_stats")
@@ -115,6 +162,44 @@ def admin_menu_keyboard():
     builder.adjust(2)
     return builder.as_markup()
 
+@static
+def admin_gallery_keyboard():
+    builder = InlineKeyboardBuilder()
+    for service_id, service in config.SERVICES.items():
+        builder.button(text=f"{service['emoji']} {service['name']}", callback_data=f"admin_gallery_{service_id}")
+    builder.adjust(1)
+    return builder.as_markup()
+
+@static
+def admin_stats_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="📅 Неделя", callback_data="admin_stats_week")
+    builder.button(text="🗓 Месяц", callback_data="admin_stats_month")
+    builder.button(text="📈 Год", callback_data="admin_stats_year")
+    builder.adjust(3)
+    return builder.as_markup()
+
+REFRESH_BUTTON = "🔄 Обновить"
+
+def pending_queue_keyboard(appointment_ids, prev_data: str = None, next_data: str = None,
+                           refresh_data: str = "admin_pending"):
+    """Очередь заявок: действия по каждой заявке и листание страниц"""
+    builder = InlineKeyboardBuilder()
+    for appointment_id in appointment_ids:
+        builder.row(
+            InlineKeyboardButton(text=f"✅ #{appointment_id}", callback_data=f"admin_approve_{appointment_id}"),
+            InlineKeyboardButton(text=f"❌ #{appointment_id}", callback_data=f"admin_reject_{appointment_id}")
+        )
+    navigation = []
+    if prev_data:
+        navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=prev_data))
+    navigation.append(InlineKeyboardButton(text=REFRESH_BUTTON, callback_data=refresh_data))
+    if next_data:
+        navigation.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=next_data))
+    builder.row(*navigation)
+    return builder.as_markup()
+
+@parameterized
 def admin_appointment_actions(appointment_id: int):
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Подтвердить", callback_data=f"admin_approve_{appointment_id}")
@@ -122,9 +207,11 @@ def admin_appointment_actions(appointment_id: int):
     builder.button(text="📞 Позвонить клиенту", callback_data=f"admin_call_{appointment_id}")
     builder.button(text="💬 Написать клиенту", callback_data=f"admin_message_{appointment_id}")
     builder.button(text="✏️ Комментарий", callback_data=f"admin_comment_{appointment_id}")
-    builder.adjust(2, 2, 1)
+    builder.button(text="🚫 Не пришел", callback_data=f"admin_noshow_{appointment_id}")
+    builder.adjust(2, 2, 2)
     return builder.as_markup()
 
+@static
 def review_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="⭐ Оставить отзыв", callback_data="leave_review")
@@ -134,6 +221,22 @@ def review_keyboard():
     builder.adjust(1)
     return builder.as_markup()
 
+def reviews_feed_keyboard(prev_data: str = None, next_data: str = None, photos_data: str = None):
+    """Лента отзывов: фото страницы и листание"""
+    builder = InlineKeyboardBuilder()
+    if photos_data:
+        builder.row(InlineKeyboardButton(text="📷 Фото со страницы", callback_data=photos_data))
+    navigation = []
+    if prev_data:
+        navigation.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=prev_data))
+    if next_data:
+        navigation.append(InlineKeyboardButton(text="Старее ➡️", callback_data=next_data))
+    if navigation:
+        builder.row(*navigation)
+    builder.row(InlineKeyboardButton(text="🔙 К отзывам", callback_data="reviews_menu"))
+    return builder.as_markup()
+
+@static
 def rating_keyboard():
     builder = InlineKeyboardBuilder()
     for i in range(1, 6):
@@ -152,6 +255,7 @@ def discount_keyboard(available_discounts):
     builder.adjust(1)
     return builder.as_markup()
 
+@parameterized
 def appointment_actions_keyboard(appointment_id: int):
     builder = InlineKeyboardBuilder()
     builder.button(text="🔄 Перенести", callback_data=f"reschedule_{appointment_id}")
@@ -160,6 +264,7 @@ def appointment_actions_keyboard(appointment_id: int):
     builder.adjust(2)
     return builder.as_markup()
 
+@static
 def admin_broadcast_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="📢 Всем пользователям", callback_data="broadcast_all")
@@ -169,46 +274,7 @@ def admin_broadcast_keyboard():
     builder.adjust(1)
     return builder.as_markup()
 
-def generate_referral_code():
-    """Генерация уникального реферального кода"""
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-
-def get_discounts_for_user(user):
-    """Получение доступных скидок для пользователя"""
-    discounts = []
-
-    # Скидка на первую запись
-    if user.visits_count == 0:
-        discounts.append({
-            'id': 'first_visit',
-            'name': 'Первая запись',
-            'percent': config.LOYALTY_SYSTEM['first_visit_discount'],
-            'type': 'first_visit'
-        })
-
-    # Скидки за количество визитов
-    for milestone, discount in config.LOYALTY_SYSTEM['visit_milestones'].items():
-        if user.visits_count >= milestone:
-            discounts.append({
-                'id': f'milestone_{milestone}',
-                'name': f'За {milestone} визитов',
-                'percent': discount,
-                'type': 'milestone'
-            })
-
-    # Скидка на день рождения
-    if user.birthday:
-        today = datetime.now().date()
-        bday = datetime.strptime(user.birthday, "%d.%m.%Y").date()
-        bday_this_year = bday.replace(year=today.year)
-
-        # Проверяем день рождения в течение месяца
-        if abs((bday_this_year - today).days) <= 15:
-            discounts.append({
-                'id': 'birthday',
-                'name': 'День рождения',
-                'percent': config.LOYALTY_SYSTEM['birthday_discount'],
-                'type': 'birthday'
-            })
-
-    return discounts
+def warm_up():
+    """Строит клавиатуры без параметров заранее, при старте процесса"""
+    for keyboard in _STATIC:
+        keyboard()
@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    TelegramMethod, Response, SendMessage, SendPhoto, SendMediaGroup, SendDocument,
+    CopyMessage, ForwardMessage, EditMessageText, EditMessageCaption, EditMessageMedia,
+    EditMessageReplyMarkup
+)
+
+logger = logging.getLogger(__name__)
+
+# Методы, на которые распространяются лимиты Telegram на отправку
+LIMITED_METHODS = (
+    SendMessage, SendPhoto, SendMediaGroup, SendDocument, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup
+)
+
+class Priority(IntEnum):
+    """Классы отправки: меньше значение - раньше получает очередь"""
+    INTERACTIVE = 0  # Ответы на действия пользователя
+    ALERT = 1        # Уведомления админам и клиентам о решениях админов
+    REMINDER = 2     # Напоминания о записях
+    BROADCAST = 3    # Массовые рассылки
+
+_current_priority = ContextVar("outbound_priority", default=Priority.INTERACTIVE)
+
+@contextmanager
+def priority(level: Priority):
+    """Отправки внутри блока (и созданных в нем задач) идут с указанным приоритетом"""
+    token = _current_priority.set(level)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Общий планировщик исходящих сообщений бота.
+
+    Подключается как middleware сессии бота, поэтому через него проходят все
+    отправки, включая message.answer() в обработчиках. Ограничения:
+    - глобально не больше rate сообщений в секунду; при конкуренции раньше
+      обслуживается более высокий приоритет;
+    - в один чат не чаще раза в chat_interval секунд с допустимым всплеском chat_burst.
+    На TelegramRetryAfter отправки приостанавливаются на retry_after и запрос
+    повторяется до max_retries раз.
+    """
+
+    def __init__(self, rate: float = 30, chat_interval: float = 1.0, chat_burst: int = 3,
+                 max_retries: int = 3):
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self._tat = 0.0        # Теоретическое время следующей отправки (GCRA)
+        self._chat_tat = {}    # chat_id -> то же для чата
+        self._waiters = []     # (priority, seq, future)
+        self._seq = itertools.count()
+        self._granter = None
+        self._wakeup = asyncio.Event()  # Будит granter, когда пауза flood control сдвигает _tat
+
+        self.sent = 0
+        self.retries = 0
+        self.depth = {level: 0 for level in Priority}
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot,
+                       method: TelegramMethod) -> Response:
+        if not isinstance(method, LIMITED_METHODS):
+            return await make_request(bot, method)
+
+        level = _current_priority.get()
+        chat_id = getattr(method, 'chat_id', None)
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(level, chat_id)
+            try:
+                response = await make_request(bot, method)
+                self.sent += 1
+                return response
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                logger.warning(f"Flood control ({method.__api_method__}), пауза {e.retry_after} с")
+                self._pause(e.retry_after)
+
+    def stats(self):
+        """Метрики очереди"""
+        return {
+            'queued': sum(self.depth.values()),
+            'by_priority': {level.name: count for level, count in self.depth.items()},
+            'sent': self.sent,
+            'retries': self.retries,
+        }
+
+    async def _acquire(self, level: Priority, chat_id):
+        self.depth[level] += 1
+        try:
+            if chat_id is not None:
+                await self._wait_chat(chat_id)
+
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            heapq.heappush(self._waiters, (level, next(self._seq), future))
+            if self._granter is None or self._granter.done():
+                self._granter = asyncio.create_task(self._grant())
+            await future
+        finally:
+            self.depth[level] -= 1
+
+    async def _wait_chat(self, chat_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        tat = max(self._chat_tat.get(chat_id, now), now) + self.chat_interval
+        self._chat_tat[chat_id] = tat
+        wait = tat - self.chat_burst * self.chat_interval - now
+        if len(self._chat_tat) > 10000:
+            self._chat_tat = {chat: t for chat, t in self._chat_tat.items() if t > now}
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _grant(self):
+        """Выдает разрешения на отправку по одному с шагом interval, старшим приоритетам первым"""
+        loop = asyncio.get_running_loop()
+        while self._waiters:
+            wait = self._tat - loop.time()
+            if wait > 0:
+                # Пока ждем, могут прийти более приоритетные запросы или пауза
+                # flood control; после пробуждения _tat проверяется заново
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._tat = max(self._tat, loop.time()) + self.interval
+            future.set_result(None)
+
+    def _pause(self, seconds: float):
+        """Приостанавливает все отправки на seconds (flood control)"""
+        loop = asyncio.get_running_loop()
+        self._tat = max(self._tat, loop.time() + seconds)
+        self._wakeup.set()
@@ -0,0 +1,41 @@
+from typing import Optional
+
+# Без похожих символов 0/O и 1/I
+ALPHABET = "23456789ABCDEFGHJKLMNPQRSTUVWXYZ"
+BODY_LENGTH = 6
+MODULUS = len(ALPHABET) ** BODY_LENGTH  # 2^30 - хватит на миллиард пользователей
+
+# Аффинная перестановка id -> число, чтобы соседние коды не выглядели похоже.
+# Множитель нечетный, поэтому перестановка обратима по модулю 2^30
+MULTIPLIER = 0x2F3A9D5B
+OFFSET = 0x1B4E7C2
+INVERSE = pow(MULTIPLIER, -1, MODULUS)
+
+def _check_char(body: str) -> str:
+    total = sum((i + 1) * ALPHABET.index(ch) for i, ch in enumerate(body))
+    return ALPHABET[total % len(ALPHABET)]
+
+def encode_referral_code(user_id: int) -> str:
+    """Реферальный код пользователя: 6 символов номера и контрольный символ.
+
+    Код взаимно однозначно получается из users.id, поэтому совпадений не бывает."""
+    value = (user_id * MULTIPLIER + OFFSET) % MODULUS
+    chars = []
+    for _ in range(BODY_LENGTH):
+        value, digit = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    body = ''.join(reversed(chars))
+    return body + _check_char(body)
+
+def decode_referral_code(code: str) -> Optional[int]:
+    """users.id по реферальному коду или None, если код не нашего формата"""
+    code = code.strip().upper()
+    if len(code) != BODY_LENGTH + 1 or any(ch not in ALPHABET for ch in code):
+        return None
+    body = code[:BODY_LENGTH]
+    if _check_char(body) != code[-1]:
+        return None
+    value = 0
+    for ch in body:
+        value = value * len(ALPHABET) + ALPHABET.index(ch)
+    return (value - OFFSET) * INVERSE % MODULUS
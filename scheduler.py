@@ -0,0 +1,121 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+class ReminderScheduler:
+    """Очередь напоминаний с приоритетом по времени отправки.
+
+    Держит в куче (scheduled_for, reminder_id) напоминания ближайшего горизонта
+    и спит ровно до ближайшего из них. Новые напоминания добавляются через push()
+    без обращения к БД; раз в resync_interval секунд очередь сверяется с БД,
+    чтобы подхватить то, что было создано в обход push() или не отправилось.
+    Пока run() не запущен (процесс не лидер), push() ничего не делает:
+    такие напоминания подхватит сверка у лидера.
+
+    dispatch(reminder_ids) - корутина отправки наступивших напоминаний,
+    load_pending(until) - корутина, возвращающая [(reminder_id, scheduled_for)]
+    неотправленных напоминаний со временем до until.
+    """
+
+    def __init__(self, dispatch, load_pending, resync_interval: int = 300):
+        self._dispatch = dispatch
+        self._load_pending = load_pending
+        self.resync_interval = resync_interval
+        self._heap = []
+        self._queued = set()
+        self._dispatches = set()  # Идущие отправки: ссылки держат задачи до завершения
+        self._wakeup = asyncio.Event()
+        self._running = False
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, reminder_id: int, scheduled_for: datetime):
+        """Добавляет напоминание в очередь"""
+        if not self._running or reminder_id in self._queued:
+            return
+        if scheduled_for > datetime.now() + self._horizon():
+            # Далекие напоминания подхватит следующая сверка с БД
+            return
+        self._queued.add(reminder_id)
+        heapq.heappush(self._heap, (scheduled_for, reminder_id))
+        if self._heap[0][1] == reminder_id:
+            self._wakeup.set()
+
+    async def resync(self):
+        """Сверяет очередь с БД"""
+        pending = await self._load_pending(datetime.now() + self._horizon())
+        for reminder_id, scheduled_for in pending:
+            self.push(reminder_id, scheduled_for)
+        logger.info(f"Напоминания: в очереди {len(self._heap)}")
+
+    async def run(self):
+        """Основной цикл: спит до ближайшего напоминания или до сверки с БД.
+
+        При отмене дожидается начатых отправок, чтобы их итоги попали в БД."""
+        self._running = True
+        try:
+            await self._loop()
+        except asyncio.CancelledError:
+            await self.drain()
+            raise
+        finally:
+            # Очередь собирается заново при следующем запуске
+            self._running = False
+            self._heap.clear()
+            self._queued.clear()
+
+    async def drain(self):
+        """Дожидается начатых отправок"""
+        if self._dispatches:
+            await asyncio.gather(*self._dispatches, return_exceptions=True)
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        next_resync = 0.0
+
+        while True:
+            if loop.time() >= next_resync:
+                try:
+                    await self.resync()
+                except Exception as e:
+                    logger.error(f"Ошибка сверки напоминаний с БД: {e}")
+                next_resync = loop.time() + self.resync_interval
+
+            due = self._pop_due(datetime.now())
+            if due:
+                task = asyncio.create_task(self._run_dispatch(due))
+                self._dispatches.add(task)
+                task.add_done_callback(self._dispatches.discard)
+
+            timeout = next_resync - loop.time()
+            if self._heap:
+                timeout = min(timeout, (self._heap[0][0] - datetime.now()).total_seconds())
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def _horizon(self) -> timedelta:
+        return timedelta(seconds=self.resync_interval * 2)
+
+    def _pop_due(self, now: datetime):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, reminder_id = heapq.heappop(self._heap)
+            due.append(reminder_id)
+        return due
+
+    async def _run_dispatch(self, reminder_ids):
+        try:
+            await self._dispatch(reminder_ids)
+        except Exception as e:
+            logger.error(f"Ошибка отправки напоминаний: {e}")
+        finally:
+            # Неотправленные вернутся в очередь при следующей сверке
+            self._queued.difference_update(reminder_ids)
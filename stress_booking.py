@@ -0,0 +1,84 @@
+"""Нагрузочная проверка бронирования: одно время - ровно одна запись.
+
+Запуск: python stress_booking.py [процессов] [попыток на процесс]
+
+Работает на временной БД (DATABASE_URL задается до импорта database).
+Процессы одновременно бронируют одно и то же время и пересекающиеся с ним
+интервалы; затем проверяется сценарий «клиент отменил, время занял другой,
+админ подтверждает старую заявку». Код выхода 1 - если гарантия нарушена.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+SLOT = (datetime.now() + timedelta(days=3)).replace(hour=12, minute=0, second=0, microsecond=0)
+# Все варианты пересекаются с маникюром в 12:00 (90 минут)
+STARTS = [SLOT, SLOT + timedelta(minutes=30), SLOT - timedelta(minutes=60)]
+
+def _book(args):
+    start_event, user_ids = args
+    import database as db
+    start_event.wait()
+    won = 0
+    for i, user_id in enumerate(user_ids):
+        session = db.Session()
+        try:
+            db.create_appointment(session, user_id, 'manicure', 'Маникюр', 1500, 1500, 0, STARTS[i % len(STARTS)])
+            won += 1
+        except db.SlotTakenError:
+            pass
+        finally:
+            session.close()
+    return won
+
+def _check_stale_confirm(db) -> bool:
+    """Подтверждение отмененной заявки не должно возвращать занятое время"""
+    slot = SLOT + timedelta(days=1)
+    with db.Session() as session:
+        first, *_ = db.save_user(session, 10 ** 9, None, "first", None)
+        second, *_ = db.save_user(session, 10 ** 9 + 1, None, "second", None)
+        old = db.create_appointment(session, first.id, 'manicure', 'Маникюр', 1500, 1500, 0, slot)
+        _, _, error = db.cancel_user_appointment(session, first.telegram_id, old.id)
+        assert error is None, error
+        db.create_appointment(session, second.id, 'manicure', 'Маникюр', 1500, 1500, 0, slot)
+        _, _, error = db.confirm_appointment(session, old.id)
+        active = session.query(db.Appointment).filter(
+            db.Appointment.starts_at == slot, db.Appointment.status.in_(["pending", "confirmed"])
+        ).count()
+    print(f"подтверждение отмененной заявки: {error!r}, активных записей на время: {active}")
+    return error is not None and active == 1
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    attempts = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+    workdir = tempfile.mkdtemp(prefix="stress_booking_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'stress.db')}"
+    import database as db
+
+    db.init_db()
+    with db.Session() as session:
+        user_ids = [db.save_user(session, 1000 + i, None, f"client{i}", None)[0].id
+                    for i in range(processes * attempts)]
+
+    # spawn: дочерние процессы получают DATABASE_URL из окружения
+    context = multiprocessing.get_context("spawn")
+    start_event = context.Manager().Event()
+    chunks = [(start_event, user_ids[i::processes]) for i in range(processes)]
+    with context.Pool(processes) as pool:
+        result = pool.map_async(_book, chunks)
+        start_event.set()
+        won = sum(result.get())
+
+    with db.Session() as session:
+        active = session.query(db.Appointment).filter(db.Appointment.status == "pending").count()
+    print(f"попыток: {len(user_ids)}, успешных: {won}, записей в БД: {active}")
+
+    ok = won == 1 and active == 1 and _check_stale_confirm(db)
+    print("OK" if ok else "НАРУШЕНИЕ: время занято несколькими записями")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict
+
+class UserCache:
+    """LRU-кэш пользователей по telegram_id с ограниченным временем жизни.
+
+    Хранит отсоединенные от сессии объекты User (Session создается с
+    expire_on_commit=False), поэтому их атрибуты читаются без обращения к БД.
+    Записи, меняющие пользователя, должны вызывать put() со свежим объектом
+    или invalidate(). Изменения из других процессов видны не позже чем через ttl.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._users = OrderedDict()  # telegram_id -> (user, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id: int):
+        """Пользователь из кэша или None"""
+        entry = self._users.get(telegram_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._users[telegram_id]
+            self.misses += 1
+            return None
+        self._users.move_to_end(telegram_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, user):
+        """Кладет свежую версию пользователя"""
+        if user is None:
+            return
+        self._users[user.telegram_id] = (user, time.monotonic() + self.ttl)
+        self._users.move_to_end(user.telegram_id)
+        if len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+
+    def invalidate(self, telegram_id: int):
+        """Забывает пользователя"""
+        self._users.pop(telegram_id, None)
+
+    def stats(self):
+        """Метрики кэша"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._users),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
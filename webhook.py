@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import secrets
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookServer:
+    """Прием обновлений от Telegram через webhook.
+
+    Запрос проверяется по секретному заголовку, обновление ставится в фоновую
+    задачу и Telegram сразу получает 200. Одновременно обрабатывается не больше
+    max_concurrent обновлений; когда лимит исчерпан, ответ задерживается до
+    освобождения места, и Telegram сам притормаживает доставку.
+
+    route(raw) - если задан, сырое обновление сразу передается ему, а не
+    обрабатывается здесь (прием в одном процессе, обработка в других).
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str, max_concurrent: int = 100, route=None):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.route = route
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._tasks = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+
+        try:
+            raw = await request.json()
+            if self.route:
+                self.route(raw)
+                return web.Response()
+            update = Update.model_validate(raw, context={"bot": self.bot})
+        except Exception as e:
+            logger.warning(f"Некорректное обновление от webhook: {e}")
+            return web.Response(status=400)
+
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            self._semaphore.release()
+
+    async def drain(self):
+        """Дожидается обработки принятых обновлений"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def app(self, path: str) -> web.Application:
+        application = web.Application()
+        application.router.add_post(path, self.handle)
+        return application
+
+async def run_webhook(dp: Dispatcher, bot: Bot, base_url: str, path: str, secret: str,
+                      host: str, port: int, max_concurrent: int, route=None):
+    """Запускает aiohttp-сервер, регистрирует webhook и работает до остановки.
+
+    С route обновления только принимаются и передаются ему (см. WebhookServer)."""
+    server = WebhookServer(dp, bot, secret, max_concurrent, route)
+    runner = web.AppRunner(server.app(path))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+
+    await bot.set_webhook(
+        f"{base_url.rstrip('/')}{path}",
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=max_concurrent
+    )
+    logger.info(f"Webhook слушает {host}:{port}{path}")
+
+    if not route:
+        await dp.emit_startup(bot=bot)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await server.drain()
+        if not route:
+            await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+
+import bot as app
+import config
+import database as db
+from database import run_db
+from webhook import run_webhook
+
+logger = logging.getLogger(__name__)
+
+# Аренда роли лидера: напоминания и возобновление рассылок
+LEADER_LEASE = "leader"
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash: номер корзины для ключа, при изменении числа корзин переезжает минимум ключей"""
+    bucket, j = -1, 0
+    key &= 0xFFFFFFFFFFFFFFFF
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def update_user_id(raw: dict) -> int:
+    """Пользователь, от которого пришло обновление (для обновлений без пользователя - чат или update_id)"""
+    for key, value in raw.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return raw.get("update_id", 0)
+
+class Router:
+    """Раздает обновления процессам-обработчикам: все обновления пользователя попадают в один процесс"""
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    def route(self, raw: dict):
+        user_id = update_user_id(raw)
+        self.queues[jump_hash(user_id, len(self.queues))].put((user_id, raw))
+
+# ---------- Процесс-обработчик ----------
+
+def run_worker(index: int, queue):
+    """Точка входа процесса-обработчика"""
+    # Останавливается по сигналу от процесса приема, дообработав очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker(index, queue))
+
+async def _worker(index: int, queue):
+    holder = f"worker-{index}:{os.getpid()}"
+    # Лимит Telegram общий на бота - делим его между процессами
+    app.outbound_limiter.interval = config.WORKERS / config.OUTBOUND_RATE
+    # Напоминания, созданные другими процессами, лидер находит только сверкой с БД
+    app.reminder_scheduler.resync_interval = config.REMINDER_WORKERS_RESYNC_SECONDS
+    app.broadcasts.holder = holder
+
+    await app.prepare()
+    await app.dp.emit_startup(bot=app.bot)
+    leader = asyncio.create_task(_lead(holder))
+    logger.info(f"Обработчик {holder} запущен")
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(config.WEBHOOK_MAX_CONCURRENT)
+    tails = {}  # user_id -> последняя задача пользователя
+
+    def forget(user_id, task):
+        if tails.get(user_id) is task:
+            del tails[user_id]
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            user_id, raw = item
+            await semaphore.acquire()
+            # Обновления одного пользователя обрабатываются по очереди
+            task = asyncio.create_task(_process(raw, tails.get(user_id), semaphore))
+            tails[user_id] = task
+            task.add_done_callback(lambda t, user_id=user_id: forget(user_id, t))
+    finally:
+        leader.cancel()
+        await asyncio.gather(leader, *tails.values(), return_exceptions=True)
+        await app.dp.emit_shutdown(bot=app.bot)
+        await app.dp.storage.close()
+        await app.bot.session.close()
+
+async def _process(raw: dict, previous, semaphore: asyncio.Semaphore):
+    try:
+        if previous is not None:
+            await asyncio.wait([previous])
+        await app.dp.feed_raw_update(app.bot, raw)
+    except Exception as e:
+        logger.error(f"Ошибка обработки обновления {raw.get('update_id')}: {e}")
+    finally:
+        semaphore.release()
+
+async def _lead(holder: str):
+    """Держит аренду лидера; фоновые задачи работают только у лидера"""
+    jobs = None
+    try:
+        while True:
+            try:
+                leading = await run_db(db.acquire_lease, LEADER_LEASE, holder, config.LEADER_LEASE_SECONDS)
+            except Exception as e:
+                logger.error(f"Ошибка продления аренды лидера: {e}")
+                leading = False
+
+            if leading and jobs is None:
+                logger.info(f"{holder} стал лидером")
+                jobs = await app.start_background_jobs()
+            elif not leading and jobs is not None:
+                logger.warning(f"{holder} потерял роль лидера")
+                jobs.cancel()
+                jobs = None
+
+            await asyncio.sleep(config.LEADER_LEASE_SECONDS / 3)
+    finally:
+        if jobs is not None:
+            jobs.cancel()
+        # Аренда могла быть захвачена запросом, прерванным остановкой
+        await run_db(db.release_lease, LEADER_LEASE, holder)
+
+# ---------- Процесс приема обновлений ----------
+
+async def _poll(bot, router: Router, allowed_updates):
+    # Polling не работает, пока зарегистрирован webhook
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            router.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+async def _front(router: Router):
+    allowed_updates = app.dp.resolve_used_update_types()
+    try:
+        if config.RUN_MODE == "webhook":
+            if not config.WEBHOOK_URL or not config.WEBHOOK_SECRET:
+                raise RuntimeError("Для режима webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+            # Обновления только принимаются и раздаются обработчикам
+            await run_webhook(
+                app.dp, app.bot,
+                base_url=config.WEBHOOK_URL,
+                path=config.WEBHOOK_PATH,
+                secret=config.WEBHOOK_SECRET,
+                host=config.WEBAPP_HOST,
+                port=config.WEBAPP_PORT,
+                max_concurrent=config.WEBHOOK_MAX_CONCURRENT,
+                route=router.route
+            )
+        else:
+            await _poll(app.bot, router, allowed_updates)
+    finally:
+        await app.bot.session.close()
+
+def main():
+    """Прием обновлений в этом процессе и их обработка в config.WORKERS процессах"""
+    db.init_db()
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(config.WORKERS)]
+    processes = [
+        context.Process(target=run_worker, args=(index, queue), name=f"worker-{index}")
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+
+    logger.info(f"🤖 Бот запускается: обработчиков {config.WORKERS}")
+    try:
+        asyncio.run(_front(Router(queues)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join()
+
+if __name__ == "__main__":
+    main()